@@ -1,36 +1,189 @@
 from http.server import BaseHTTPRequestHandler
+import hashlib
+import importlib
 import json
 import os
-import requests
 import logging
+import queue
+import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, wraps
+from importlib.util import find_spec
 from urllib.parse import parse_qs, urlparse
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class LazyModule:
+    """Stand-in for a module that is only imported on first attribute access.
+
+    Keeps heavy dependencies off the cold-start path of webhook hits that
+    never use them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+requests = LazyModule("requests")
+
 # Get environment variables
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "-1002063224194")
 TELEGRAM_TOPIC_ID = os.environ.get("TELEGRAM_TOPIC_ID", "3189")
 
-# Try to import Groq for AI functionality
-try:
-    from groq import Groq
-    AI_AVAILABLE = True
-    if GROQ_API_KEY:
-        groq_client = Groq(api_key=GROQ_API_KEY)
-    else:
-        groq_client = None
-        logger.warning("GROQ_API_KEY not set - AI features disabled")
-except ImportError:
-    AI_AVAILABLE = False
-    groq_client = None
+# Bot API connection pool settings
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_POOL_CONNECTIONS = int(os.environ.get("TELEGRAM_POOL_CONNECTIONS", "4"))
+TELEGRAM_POOL_MAXSIZE = int(os.environ.get("TELEGRAM_POOL_MAXSIZE", "16"))
+
+# Outbound rate limits (Telegram allows ~30 msg/s overall, ~1 msg/s per chat, 20 msg/min per group)
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.environ.get("RATE_LIMIT_GLOBAL_PER_SECOND", "30"))
+RATE_LIMIT_PRIVATE_PER_SECOND = float(os.environ.get("RATE_LIMIT_PRIVATE_PER_SECOND", "1"))
+RATE_LIMIT_PRIVATE_BURST = float(os.environ.get("RATE_LIMIT_PRIVATE_BURST", "3"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.environ.get("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+RATE_LIMIT_LEAD_PER_MINUTE = float(os.environ.get("RATE_LIMIT_LEAD_PER_MINUTE", "20"))
+
+# Bot API retry settings
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "8"))
+
+# Time one webhook invocation may spend (Vercel's default function limit is 10s)
+INVOCATION_BUDGET_SECONDS = float(os.environ.get("INVOCATION_BUDGET_SECONDS", "10"))
+
+# Typing indicator refresh (Telegram shows a chat action for about 5 seconds)
+TYPING_REFRESH_SECONDS = float(os.environ.get("TYPING_REFRESH_SECONDS", "4"))
+
+# Webhook delivery settings
+WEBHOOK_REPLY_IN_RESPONSE = os.environ.get("WEBHOOK_REPLY_IN_RESPONSE", "false").lower() in ("1", "true", "yes")
+WEBHOOK_ACK_FIRST = os.environ.get("WEBHOOK_ACK_FIRST", "false").lower() in ("1", "true", "yes")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "100"))
+WEBHOOK_QUEUE_FULL_POLICY = os.environ.get("WEBHOOK_QUEUE_FULL_POLICY", "wait").lower()
+WEBHOOK_QUEUE_WAIT = float(os.environ.get("WEBHOOK_QUEUE_WAIT", "5"))
+CHAT_BACKLOG_LIMIT = int(os.environ.get("CHAT_BACKLOG_LIMIT", "20"))
+
+# Update deduplication settings
+DEDUP_TTL_SECONDS = float(os.environ.get("DEDUP_TTL_SECONDS", "3600"))
+DEDUP_MAX_SIZE = int(os.environ.get("DEDUP_MAX_SIZE", "10000"))
+DEDUP_REDIS_URL = os.environ.get("DEDUP_REDIS_URL")
+
+# Session store for lead collection state: memory, sqlite or redis
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory").lower()
+SESSION_SQLITE_PATH = os.environ.get("SESSION_SQLITE_PATH", "/tmp/telegram_sessions.db")
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL") or DEDUP_REDIS_URL
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", "86400"))
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "3600"))
+SESSION_TABLE_SIZE = int(os.environ.get("SESSION_TABLE_SIZE", "100000"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL_SECONDS = float(os.environ.get("SESSION_CACHE_TTL_SECONDS", "2"))
+
+# Lead outbox: leads are saved to disk first, then posted to the sales group.
+# /tmp is not durable on serverless hosts (Vercel): the file goes away with the
+# instance, so pending leads are also attempted within the webhook invocation.
+LEAD_OUTBOX_PATH = os.environ.get("LEAD_OUTBOX_PATH", "/tmp/telegram_leads.db")
+LEAD_RETRY_BASE_DELAY = float(os.environ.get("LEAD_RETRY_BASE_DELAY", "5"))
+LEAD_RETRY_MAX_DELAY = float(os.environ.get("LEAD_RETRY_MAX_DELAY", "600"))
+LEAD_MAX_ATTEMPTS = int(os.environ.get("LEAD_MAX_ATTEMPTS", "20"))
+
+# Per-chat language preference cache
+LANGUAGE_CACHE_SIZE = int(os.environ.get("LANGUAGE_CACHE_SIZE", "10000"))
+LANGUAGE_CACHE_TTL_SECONDS = float(os.environ.get("LANGUAGE_CACHE_TTL_SECONDS", "604800"))
+
+# Character n-gram language model
+LANGUAGE_MODEL_PATH = os.environ.get(
+    "LANGUAGE_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "language_model.npy")
+)
+LANGUAGE_MODEL_MIN_CONFIDENCE = float(os.environ.get("LANGUAGE_MODEL_MIN_CONFIDENCE", "0.9"))
+
+# AI response cache
+AI_CACHE_ENABLED = os.environ.get("AI_CACHE_ENABLED", "true").lower() == "true"
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "1000"))
+AI_CACHE_TTL_SECONDS = float(os.environ.get("AI_CACHE_TTL_SECONDS", "86400"))
+
+# Semantic (paraphrase) answer cache
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "256"))
+
+# Knowledge-base retrieval for AI prompts
+KB_RETRIEVAL_ENABLED = os.environ.get("KB_RETRIEVAL_ENABLED", "true").lower() == "true"
+KB_TOP_K = int(os.environ.get("KB_TOP_K", "3"))
+
+# Streaming AI replies
+AI_STREAMING_ENABLED = os.environ.get("AI_STREAMING_ENABLED", "false").lower() == "true"
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get("AI_STREAM_EDIT_INTERVAL", "1.5"))
+
+# Groq call deadline
+AI_DEADLINE_SECONDS = float(os.environ.get("AI_DEADLINE_SECONDS", "7"))
+AI_REPLY_RESERVE_SECONDS = float(os.environ.get("AI_REPLY_RESERVE_SECONDS", "2"))
+AI_REQUEST_TIMEOUT = float(os.environ.get("AI_REQUEST_TIMEOUT", "30"))
+AI_WORKERS = int(os.environ.get("AI_WORKERS", "8"))
+
+# Latency histograms and counters served at /api/telegram/metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+# Long polling settings (self-hosted deployments)
+POLLING_LIMIT = int(os.environ.get("POLLING_LIMIT", "100"))
+POLLING_TIMEOUT = int(os.environ.get("POLLING_TIMEOUT", "30"))
+POLLING_WORKERS = int(os.environ.get("POLLING_WORKERS", "8"))
+
+# Groq is only imported, and its client only built, when the AI is first asked
+AI_AVAILABLE = find_spec("groq") is not None
+groq_client = None
+_groq_client_attempted = False
+_groq_client_lock = threading.Lock()
+if not AI_AVAILABLE:
     logger.warning("Groq not installed - AI features disabled")
+elif not GROQ_API_KEY:
+    logger.warning("GROQ_API_KEY not set - AI features disabled")
+
+def get_groq_client():
+    """Return the Groq client, creating it on first use; None when AI is unavailable."""
+    global groq_client, _groq_client_attempted
+    if groq_client is None and not _groq_client_attempted and AI_AVAILABLE and GROQ_API_KEY:
+        with _groq_client_lock:
+            if groq_client is None and not _groq_client_attempted:
+                _groq_client_attempted = True
+                try:
+                    from groq import Groq
+                    groq_client = Groq(api_key=GROQ_API_KEY)
+                except Exception as e:
+                    logger.error(f"Error creating Groq client: {e}")
+    return groq_client
+
+def ai_enabled():
+    """Whether AI replies are available, without importing Groq."""
+    if groq_client is not None:
+        return True
+    return AI_AVAILABLE and bool(GROQ_API_KEY) and not _groq_client_attempted
 
-# User state management for lead generation
-user_states = {}
+# NumPy powers the character n-gram language model
+if find_spec("numpy") is not None:
+    np = LazyModule("numpy")
+else:
+    np = None
+    logger.warning("NumPy not installed - language model disabled")
 
 class UserState:
     NORMAL = "normal"
@@ -39,6 +192,947 @@ class UserState:
     COLLECTING_PHONE = "collecting_phone"
     COLLECTING_EMAIL = "collecting_email"
 
+class SessionStore:
+    """Per-chat session state (lead collection step, counters) keyed by chat_id.
+
+    Sessions are plain dicts. Backends only need get_many, set and delete;
+    callers that change a session must set() it again to persist it.
+    """
+
+    def get(self, chat_id):
+        """Session of one chat, or None."""
+        return self.get_many([chat_id]).get(chat_id)
+
+    def get_many(self, chat_ids):
+        """{chat_id: session} for the chats that have one."""
+        raise NotImplementedError
+
+    def set(self, chat_id, data):
+        """Store a chat's session."""
+        raise NotImplementedError
+
+    def delete(self, chat_id):
+        """Forget a chat's session."""
+        raise NotImplementedError
+
+    def record_message(self, chat_id):
+        """Count a message from a chat; returns its updated session."""
+        data = self.get(chat_id) or {'state': UserState.NORMAL}
+        data['message_count'] = data.get('message_count', 0) + 1
+        data['last_interaction'] = time.time()
+        self.set(chat_id, data)
+        return data
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class SessionRecord:
+    """Compact per-chat session: the state as a small int, counters and lead fields."""
+
+    __slots__ = ("state", "message_count", "last_seen", "project", "name", "phone", "email")
+
+    STATES = (
+        UserState.NORMAL,
+        UserState.COLLECTING_PROJECT,
+        UserState.COLLECTING_NAME,
+        UserState.COLLECTING_PHONE,
+        UserState.COLLECTING_EMAIL,
+    )
+    CODES = {state: code for code, state in enumerate(STATES)}
+    LEAD_FIELDS = ("project", "name", "phone", "email")
+
+    def __init__(self):
+        self.state = 0
+        self.message_count = 0
+        self.last_seen = 0.0
+        self.project = None
+        self.name = None
+        self.phone = None
+        self.email = None
+
+    def update(self, data):
+        """Replace the state and lead fields from a session dict; counters are kept unless given."""
+        self.state = self.CODES.get(data.get('state', UserState.NORMAL), 0)
+        for field in self.LEAD_FIELDS:
+            setattr(self, field, data.get(field))
+        if 'message_count' in data:
+            self.message_count = data['message_count']
+
+    def to_dict(self):
+        """Session dict as seen by the handlers."""
+        data = {'state': self.STATES[self.state]}
+        for field in self.LEAD_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                data[field] = value
+        if self.message_count:
+            data['message_count'] = self.message_count
+            data['last_interaction'] = self.last_seen
+        return data
+
+class SessionTable(SessionStore):
+    """In-memory session store of SessionRecords, bounded in size and idle time.
+
+    Idle chats are evicted after idle_ttl and, oldest first, whenever the
+    table is over max_size. A chat in the middle of an order is never evicted
+    for size and is kept for lead_ttl, so a lead is not lost to busy traffic.
+    Also answers dict-style access (user_states[chat_id]) with session dicts.
+    """
+
+    def __init__(self, max_size=SESSION_TABLE_SIZE, idle_ttl=SESSION_IDLE_SECONDS,
+                 lead_ttl=SESSION_TTL_SECONDS, clock=time.time):
+        self.max_size = max(1, max_size)
+        self.idle_ttl = idle_ttl
+        self.lead_ttl = lead_ttl
+        self.clock = clock
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _expired(self, record, now):
+        return now - record.last_seen >= (self.lead_ttl if record.state else self.idle_ttl)
+
+    def _live(self, chat_id, now):
+        record = self._records.get(chat_id)
+        if record is not None and self._expired(record, now):
+            del self._records[chat_id]
+            self.evictions += 1
+            return None
+        return record
+
+    def _touch(self, chat_id, now):
+        record = self._live(chat_id, now)
+        if record is None:
+            record = self._records[chat_id] = SessionRecord()
+        else:
+            self._records.move_to_end(chat_id)
+        record.last_seen = now
+        return record
+
+    def _evict(self, now):
+        checked = 0
+        while self._records and checked < len(self._records):
+            chat_id, record = next(iter(self._records.items()))
+            if self._expired(record, now):
+                pass
+            elif record.state:
+                # Leads in progress only leave through the lead TTL
+                self._records.move_to_end(chat_id)
+                checked += 1
+                continue
+            elif len(self._records) <= self.max_size:
+                break
+            del self._records[chat_id]
+            self.evictions += 1
+
+    def get_many(self, chat_ids):
+        now = self.clock()
+        found = {}
+        with self._lock:
+            for chat_id in chat_ids:
+                record = self._live(chat_id, now)
+                if record is not None:
+                    found[chat_id] = record.to_dict()
+        return found
+
+    def set(self, chat_id, data):
+        now = self.clock()
+        with self._lock:
+            self._touch(chat_id, now).update(data)
+            self._evict(now)
+
+    def record_message(self, chat_id):
+        now = self.clock()
+        with self._lock:
+            record = self._touch(chat_id, now)
+            record.message_count += 1
+            self._evict(now)
+            return record.to_dict()
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._records.pop(chat_id, None)
+
+    def pop(self, chat_id, default=None):
+        """Remove a chat's session and return it as a dict."""
+        with self._lock:
+            record = self._records.pop(chat_id, None)
+        return default if record is None else record.to_dict()
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._records),
+                "leads": sum(1 for record in self._records.values() if record.state),
+                "evictions": self.evictions,
+            }
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        data = self.get(chat_id)
+        if data is None:
+            raise KeyError(chat_id)
+        return data
+
+    def __setitem__(self, chat_id, data):
+        self.set(chat_id, data)
+
+    def __len__(self):
+        return len(self._records)
+
+# User state management for lead generation
+user_states = SessionTable()
+
+class LatencyHistogram:
+    """Log-linear (HDR-style) histogram of durations at microsecond resolution.
+
+    Durations under 2**(SUB_BUCKET_BITS + 1) microseconds get exact buckets;
+    above that each power of two is split into 2**SUB_BUCKET_BITS equal
+    buckets, so quantiles are within about 6% at any scale. Recording is a
+    bit_length and a list increment.
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def index(cls, micros):
+        """Bucket index of a duration in whole microseconds."""
+        shift = micros.bit_length() - cls.SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            return micros
+        return shift * cls.SUB_BUCKETS + (micros >> shift)
+
+    @classmethod
+    def upper_bound(cls, index):
+        """Exclusive upper bound of a bucket, in microseconds."""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index + 1
+        shift = (index >> cls.SUB_BUCKET_BITS) - 1
+        return (index - shift * cls.SUB_BUCKETS + 1) << shift
+
+    def record(self, seconds):
+        """Add one duration in seconds."""
+        index = self.index(int(seconds * 1e6) if seconds > 0 else 0)
+        with self._lock:
+            counts = self.counts
+            if index >= len(counts):
+                counts.extend([0] * (index + 1 - len(counts)))
+            counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        """(counts, count, sum, max) taken under the lock."""
+        with self._lock:
+            return list(self.counts), self.count, self.sum, self.max
+
+    @classmethod
+    def quantile(cls, counts, count, maximum, q):
+        """Duration in seconds below which a fraction q of the recorded values fall."""
+        if not count:
+            return 0.0
+        rank = max(1, q * count)
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return min(cls.upper_bound(index) / 1e6, maximum)
+        return maximum
+
+    @classmethod
+    def cumulative(cls, counts, bounds):
+        """Counts of values below each bound in seconds, for Prometheus buckets."""
+        result, seen, index = [], 0, 0
+        for bound in bounds:
+            limit = bound * 1e6
+            while index < len(counts) and cls.upper_bound(index) <= limit:
+                seen += counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+class Span:
+    """Context manager that records the time spent in a block."""
+
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.record(time.perf_counter() - self.started)
+        return False
+
+_NO_SPAN = nullcontext()
+
+def escape_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_sample(name, labels, value):
+    """One Prometheus sample line."""
+    if labels:
+        label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+class Metrics:
+    """Per-stage latency histograms and labelled counters in Prometheus text format.
+
+    Each family has a single label (stage, method, command, intent). Timing a
+    block costs two perf_counter calls and one histogram update, so it stays
+    on in production; METRICS_ENABLED=false turns every call into a no-op.
+    """
+
+    FAMILIES = {
+        "telegram_stage_duration_seconds": ("histogram", "stage", "Time spent in each webhook stage."),
+        "telegram_bot_api_duration_seconds": ("histogram", "method", "Bot API call latency per method."),
+        "telegram_commands_total": ("counter", "command", "Messages handled per command."),
+        "telegram_intents_total": ("counter", "intent", "Messages handled per detected intent."),
+    }
+    EXPORT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, family, value):
+        """The histogram for one label value of a family, created on first use."""
+        key = (family, value)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def span(self, stage, family="telegram_stage_duration_seconds"):
+        """Time a block as one observation of a stage."""
+        if not self.enabled:
+            return _NO_SPAN
+        return Span(self.histogram(family, stage))
+
+    def observe(self, value, seconds, family="telegram_stage_duration_seconds"):
+        """Record a duration measured elsewhere."""
+        if self.enabled:
+            self.histogram(family, value).record(seconds)
+
+    def timed(self, stage):
+        """Decorator that times every call of a function as a stage."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, family, value, amount=1):
+        """Increase a labelled counter."""
+        if not self.enabled:
+            return
+        key = (family, value)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, family, value):
+        """Current value of a labelled counter."""
+        return self._counters.get((family, value), 0)
+
+    def reset(self):
+        """Forget every observation."""
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    def render(self):
+        """Histograms, quantiles and counters as Prometheus text lines."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        for family, (kind, label, help_text) in self.FAMILIES.items():
+            if kind == "histogram":
+                series = [(value, histogram.snapshot()) for (name, value), histogram in histograms if name == family]
+                if not series:
+                    continue
+                lines += [f"# HELP {family} {help_text}", f"# TYPE {family} histogram"]
+                for value, (counts, count, total, _) in series:
+                    for bound, seen in zip(self.EXPORT_BUCKETS, LatencyHistogram.cumulative(counts, self.EXPORT_BUCKETS)):
+                        lines.append(format_sample(f"{family}_bucket", {label: value, "le": bound}, seen))
+                    lines.append(format_sample(f"{family}_bucket", {label: value, "le": "+Inf"}, count))
+                    lines.append(format_sample(f"{family}_sum", {label: value}, round(total, 6)))
+                    lines.append(format_sample(f"{family}_count", {label: value}, count))
+
+                quantile_family = family.replace("_seconds", "_quantile_seconds")
+                lines += [f"# HELP {quantile_family} Quantiles of {family} from the full-resolution histogram.",
+                          f"# TYPE {quantile_family} gauge"]
+                for value, (counts, count, _, maximum) in series:
+                    for q in self.QUANTILES:
+                        seconds = LatencyHistogram.quantile(counts, count, maximum, q)
+                        lines.append(format_sample(quantile_family, {label: value, "quantile": q}, round(seconds, 6)))
+            else:
+                series = [(value, total) for (name, value), total in counters if name == family]
+                if not series:
+                    continue
+                lines += [f"# HELP {family} {help_text}", f"# TYPE {family} counter"]
+                lines += [format_sample(family, {label: value}, total) for value, total in series]
+        return lines
+
+# Process-wide latency and traffic metrics
+metrics = Metrics()
+
+# Deadline of the invocation being processed on this thread
+_invocation = threading.local()
+
+class invocation_budget:
+    """Context manager that sets the processing deadline for the current thread.
+
+    Nested budgets keep the outer (earlier) deadline, so the webhook request
+    start is what counts even when processing code opens its own budget.
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = INVOCATION_BUDGET_SECONDS if seconds is None else seconds
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = getattr(_invocation, "deadline", None)
+        deadline = time.monotonic() + self.seconds
+        if self._outer is None or deadline < self._outer:
+            _invocation.deadline = deadline
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _invocation.deadline = self._outer
+        return False
+
+def remaining_budget():
+    """Seconds left in the current invocation, or None outside of one."""
+    deadline = getattr(_invocation, "deadline", None)
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+def run_within_budget(budget, func, *args):
+    """Call func with a budget carried over from the submitting thread; None means no deadline."""
+    with invocation_budget(budget) if budget is not None else nullcontext():
+        return func(*args)
+
+class RetryPolicy:
+    """Which Bot API failures are retried, and how long to wait between attempts.
+
+    429 responses are retried after exactly `parameters.retry_after` seconds;
+    Telegram refused those calls, so retrying is safe for every method.
+    Transient 5xx and network errors are only retried for methods where a
+    duplicate call is harmless, because a sendMessage that timed out may still
+    have been delivered. Connect timeouts never reached Telegram, so they are
+    retried for every method. Other delays use exponential backoff with full
+    jitter, and no retry is started past the invocation deadline.
+    """
+
+    IDEMPOTENT_METHODS = frozenset([
+        "getMe", "getUpdates", "getWebhookInfo", "setWebhook", "deleteWebhook",
+        "sendChatAction", "editMessageText",
+    ])
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retry number `attempt` (1-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def delay_for_result(self, method, result, attempt):
+        """Delay before retrying a failed Bot API response, or None to give up."""
+        error_code = result.get("error_code")
+        if error_code == 429:
+            return float(result.get("parameters", {}).get("retry_after", self.backoff(attempt)))
+        if isinstance(error_code, int) and error_code >= 500 and method in self.IDEMPOTENT_METHODS:
+            return self.backoff(attempt)
+        return None
+
+    def delay_for_error(self, method, error, attempt):
+        """Delay before retrying a network error, or None to give up."""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return self.backoff(attempt)
+        if method in self.IDEMPOTENT_METHODS and isinstance(error, (requests.exceptions.ConnectionError,
+                                                                    requests.exceptions.Timeout)):
+            return self.backoff(attempt)
+        return None
+
+    def can_retry(self, attempt, delay):
+        """Check the attempt limit and whether the delay fits the remaining budget."""
+        if attempt >= self.max_attempts:
+            return False
+        remaining = remaining_budget()
+        return remaining is None or delay < remaining
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of refusing excess calls.
+
+    Tokens may go negative: each caller reserves the next free slot and is
+    told how long to wait for it, so bursts are queued in arrival order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """Take one token and return the seconds to wait before using it."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+class OutboundRateLimiter:
+    """Global plus per-chat token buckets in front of every outgoing message.
+
+    Private chats, group chats and the lead topic each get their own budget.
+    Sends over budget wait for their slot instead of being dropped, and the
+    time spent waiting is reported per bucket kind. Inside an invocation a
+    send whose slot is past the deadline is refused rather than slept for,
+    since the function would be killed before it could go out.
+    """
+
+    THROTTLED_METHODS = frozenset(["sendMessage", "sendLocation", "editMessageText"])
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_per_second=RATE_LIMIT_GLOBAL_PER_SECOND,
+                 private_per_second=RATE_LIMIT_PRIVATE_PER_SECOND, private_burst=RATE_LIMIT_PRIVATE_BURST,
+                 group_per_minute=RATE_LIMIT_GROUP_PER_MINUTE, lead_per_minute=RATE_LIMIT_LEAD_PER_MINUTE,
+                 sleep=time.sleep):
+        self.global_per_second = global_per_second
+        self.private_per_second = private_per_second
+        self.private_burst = private_burst
+        self.group_per_minute = group_per_minute
+        self.lead_per_minute = lead_per_minute
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all bucket state and statistics."""
+        with self._lock:
+            self._global = TokenBucket(self.global_per_second, self.global_per_second)
+            self._chats = OrderedDict()
+            self._stats = {}
+
+    @staticmethod
+    def is_group_chat_id(chat_id):
+        """Group and channel ids are negative."""
+        return str(chat_id).startswith("-")
+
+    def _bucket_for(self, chat_id, message_thread_id):
+        if str(chat_id) == str(TELEGRAM_CHAT_ID) and message_thread_id and str(message_thread_id) == str(TELEGRAM_TOPIC_ID):
+            kind, key = "lead", ("lead", str(chat_id), str(message_thread_id))
+            rate, capacity = self.lead_per_minute / 60.0, 3
+        elif self.is_group_chat_id(chat_id):
+            kind, key = "group", ("group", str(chat_id))
+            rate, capacity = self.group_per_minute / 60.0, 3
+        else:
+            kind, key = "private", ("private", str(chat_id))
+            rate, capacity = self.private_per_second, self.private_burst
+
+        bucket = self._chats.get(key)
+        if bucket is None:
+            bucket = self._chats[key] = TokenBucket(rate, capacity)
+            # Forget the least recently used chats
+            while len(self._chats) > self.MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(key)
+        return kind, bucket
+
+    def acquire(self, method, payload):
+        """Wait for send capacity for a Bot API call.
+
+        Returns the seconds waited, or None if the wait does not fit in the
+        remaining invocation budget; the slot is then given back.
+        """
+        if method not in self.THROTTLED_METHODS or not payload:
+            return 0.0
+
+        now = time.monotonic()
+        remaining = remaining_budget()
+        with self._lock:
+            kind, bucket = self._bucket_for(payload.get("chat_id"), payload.get("message_thread_id"))
+            wait = max(bucket.reserve(now), self._global.reserve(now))
+
+            stats = self._stats.get(kind)
+            if stats is None:
+                stats = self._stats[kind] = {"sends": 0, "throttled": 0, "dropped": 0,
+                                             "wait_total_seconds": 0.0, "wait_max_seconds": 0.0}
+            if remaining is not None and wait > remaining:
+                # Nobody reserved after us while the lock is held
+                bucket.tokens += 1
+                self._global.tokens += 1
+                stats["dropped"] += 1
+                dropped = True
+            else:
+                stats["sends"] += 1
+                dropped = False
+                if wait > 0:
+                    stats["throttled"] += 1
+                    stats["wait_total_seconds"] += wait
+                    if wait > stats["wait_max_seconds"]:
+                        stats["wait_max_seconds"] = wait
+
+        if dropped:
+            logger.error(f"Dropping {method} to {kind} chat: rate limit wait {wait:.2f}s exceeds the remaining {remaining:.2f}s")
+            return None
+        if wait > 0:
+            logger.info(f"Throttling {method} to {kind} chat for {wait:.2f}s")
+            self.sleep(wait)
+        return wait
+
+    def stats(self):
+        """Get send and throttle-wait statistics per bucket kind."""
+        with self._lock:
+            return {kind: dict(stats) for kind, stats in self._stats.items()}
+
+# Shared outbound rate limiter
+outbound_limiter = OutboundRateLimiter()
+
+class TelegramBotClient:
+    """Shared Bot API client with a pooled keep-alive session and per-method stats.
+
+    A single instance lives at module level so warm serverless invocations reuse
+    the same TCP/TLS connections to api.telegram.org instead of reconnecting
+    for every call.
+    """
+
+    DEFAULT_TIMEOUT = 10
+    METHOD_TIMEOUTS = {
+        "sendChatAction": 5,
+        "sendMessage": 10,
+        "sendLocation": 10,
+        "setWebhook": 10,
+        "getMe": 10,
+    }
+
+    def __init__(self, pool_connections=TELEGRAM_POOL_CONNECTIONS, pool_maxsize=TELEGRAM_POOL_MAXSIZE,
+                 rate_limiter=None, retry_policy=None, sleep=time.sleep):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(max_attempts=1)
+        self.sleep = sleep
+        self.session = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _ensure_session(self):
+        """Create the pooled session on first use."""
+        if self.session is None:
+            with self._lock:
+                if self.session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                            pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self.session = session
+        return self.session
+
+    def method_url(self, method):
+        """Build the Bot API URL for a method using the current bot token."""
+        return f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/{method}"
+
+    def timeout_for(self, method):
+        """Get the request timeout (seconds) for a Bot API method."""
+        return self.METHOD_TIMEOUTS.get(method, self.DEFAULT_TIMEOUT)
+
+    def call(self, method, payload=None, http_method="post", timeout=None):
+        """Call a Bot API method and return the decoded JSON response.
+
+        Failures the retry policy considers safe are retried; otherwise the
+        last response is returned and network errors are re-raised so callers
+        keep their own error handling.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = self._call_once(method, payload, http_method, timeout)
+            except requests.exceptions.RequestException as e:
+                delay = self.retry_policy.delay_for_error(method, e, attempt)
+                if delay is None or not self.retry_policy.can_retry(attempt, delay):
+                    raise
+                logger.warning(f"Retrying {method} in {delay:.2f}s after network error: {e}")
+            else:
+                if result.get("ok"):
+                    return result
+                delay = self.retry_policy.delay_for_result(method, result, attempt)
+                if delay is None or not self.retry_policy.can_retry(attempt, delay):
+                    return result
+                logger.warning(f"Retrying {method} in {delay:.2f}s after error {result.get('error_code')}")
+
+            self._record_retry(method)
+            self.sleep(delay)
+
+    def _call_once(self, method, payload, http_method, timeout):
+        """Make a single HTTP request for a Bot API method."""
+        session = self._ensure_session()
+        url = self.method_url(method)
+        if timeout is None:
+            timeout = self.timeout_for(method)
+            # Never let one request outlive the invocation
+            remaining = remaining_budget()
+            if remaining is not None:
+                timeout = max(0.5, min(timeout, remaining))
+
+        if self.rate_limiter is not None and self.rate_limiter.acquire(method, payload) is None:
+            # No error_code: waiting longer would not help, so this is never retried
+            return {"ok": False, "description": "Rate limit wait exceeds the invocation budget"}
+
+        started = time.perf_counter()
+        ok = False
+        try:
+            if http_method == "get":
+                response = session.get(url, params=payload, timeout=timeout)
+            else:
+                response = session.post(url, json=payload, timeout=timeout)
+            result = self._decode(response)
+            ok = bool(result.get("ok"))
+            return result
+        finally:
+            self._record(method, time.perf_counter() - started, ok)
+
+    @staticmethod
+    def _decode(response):
+        """Decode a Bot API response, mapping non-JSON error pages to an error result."""
+        try:
+            return response.json()
+        except ValueError:
+            status = getattr(response, "status_code", 0)
+            return {"ok": False, "error_code": status, "description": f"HTTP {status} with non-JSON body"}
+
+    def _method_stats(self, method):
+        stats = self._stats.get(method)
+        if stats is None:
+            stats = self._stats[method] = {"calls": 0, "errors": 0, "retries": 0,
+                                           "total_seconds": 0.0, "max_seconds": 0.0}
+        return stats
+
+    def _record(self, method, elapsed, ok):
+        """Record call count and latency for a method."""
+        metrics.observe(method, elapsed, "telegram_bot_api_duration_seconds")
+        with self._lock:
+            stats = self._method_stats(method)
+            stats["calls"] += 1
+            if not ok:
+                stats["errors"] += 1
+            stats["total_seconds"] += elapsed
+            if elapsed > stats["max_seconds"]:
+                stats["max_seconds"] = elapsed
+
+    def _record_retry(self, method):
+        """Count a retry for a method."""
+        with self._lock:
+            self._method_stats(method)["retries"] += 1
+
+    def stats(self):
+        """Get a snapshot of per-method call counts and latency."""
+        with self._lock:
+            snapshot = {}
+            for method, stats in self._stats.items():
+                entry = dict(stats)
+                entry["avg_seconds"] = stats["total_seconds"] / stats["calls"] if stats["calls"] else 0.0
+                snapshot[method] = entry
+            return snapshot
+
+    def reset_stats(self):
+        """Clear collected per-method statistics."""
+        with self._lock:
+            self._stats = {}
+
+# Shared Bot API client, reused across warm invocations
+bot_api = TelegramBotClient(rate_limiter=outbound_limiter if RATE_LIMIT_ENABLED else None,
+                            retry_policy=RetryPolicy())
+
+class ResponsePlan:
+    """Outgoing Bot API calls produced while handling one message.
+
+    Calls are grouped into stages. Calls added normally each get their own
+    stage and are sent in order; calls added inside `concurrent()` share a
+    stage because their relative order does not matter, and are sent at the
+    same time.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.leads_queued = False
+        self._group = None
+
+    def add(self, method, payload):
+        """Append a call to the plan."""
+        if self._group is not None:
+            self._group.append((method, payload))
+        else:
+            self.stages.append([(method, payload)])
+
+    @contextmanager
+    def concurrent(self):
+        """Group the calls added inside the block into one concurrent stage."""
+        if self._group is not None:
+            yield self
+            return
+        self._group = []
+        try:
+            yield self
+        finally:
+            if self._group:
+                self.stages.append(self._group)
+            self._group = None
+
+    def calls(self):
+        """All calls in send order."""
+        return [call for stage in self.stages for call in stage]
+
+    def pop_last(self):
+        """Remove and return the last call, or None if the plan is empty."""
+        if not self.stages:
+            return None
+        call = self.stages[-1].pop()
+        if not self.stages[-1]:
+            self.stages.pop()
+        return call
+
+    def __len__(self):
+        return sum(len(stage) for stage in self.stages)
+
+# Plan collecting user-facing calls for the message handled on this thread
+_outgoing = threading.local()
+
+# Threads used to send the calls of one concurrent stage
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", "8"))
+_fanout_executor = ThreadPoolExecutor(max_workers=max(1, FANOUT_WORKERS), thread_name_prefix="bot-fanout")
+
+def send_bot_call(method, payload):
+    """Send a user-facing Bot API call, or add it to the plan being collected."""
+    plan = getattr(_outgoing, "plan", None)
+    if plan is not None:
+        plan.add(method, payload)
+        return {"ok": True}
+    return bot_api.call(method, payload)
+
+@contextmanager
+def concurrent_calls():
+    """Let the calls made inside the block be sent concurrently."""
+    plan = getattr(_outgoing, "plan", None)
+    if plan is None:
+        yield None
+    else:
+        with plan.concurrent():
+            yield plan
+
+def _send_planned_call(method, payload, budget=None):
+    """Send one planned call, logging instead of raising on failure."""
+    try:
+        with invocation_budget(budget) if budget is not None else nullcontext():
+            response_json = bot_api.call(method, payload)
+        if not response_json.get("ok"):
+            logger.error(f"Telegram API error {response_json.get('error_code', 'unknown')}: "
+                         f"{response_json.get('description', 'unknown error')}")
+            return False
+        return True
+    except Exception as e:
+        logger.error(f"Error sending {method}: {e}")
+        return False
+
+@metrics.timed("dispatch")
+def dispatch_plan(plan):
+    """Send a plan's calls: stages in order, calls within a stage concurrently."""
+    for stage in plan.stages:
+        if len(stage) == 1:
+            _send_planned_call(*stage[0])
+            continue
+        # Worker threads inherit the caller's deadline
+        budget = remaining_budget()
+        futures = [_fanout_executor.submit(_send_planned_call, method, payload, budget)
+                   for method, payload in stage]
+        for future in futures:
+            future.result()
+
+def plan_message(message):
+    """Handle a message and return the outgoing calls it produced, unsent."""
+    plan = ResponsePlan()
+    previous = getattr(_outgoing, "plan", None)
+    _outgoing.plan = plan
+    try:
+        with metrics.span("route"):
+            route_message(message)
+    except Exception:
+        _outgoing.plan = previous
+        # Deliver whatever was produced before the failure
+        dispatch_plan(plan)
+        raise
+    _outgoing.plan = previous
+    return plan
+
+def handle_message_with_reply(message):
+    """Handle a message and return its last outgoing call as a webhook reply payload.
+
+    Telegram executes a method returned in the webhook response after the
+    request completes, so any earlier calls are sent through the shared client
+    first and the reply is still delivered last. Returns None when the message
+    produced no outgoing calls, or when it saved a lead: then every call is
+    sent directly so the lead can be posted after the user's confirmation.
+    """
+    plan = plan_message(message)
+    if plan.leads_queued:
+        # The confirmation must not wait for the group post behind the webhook response
+        dispatch_plan(plan)
+        deliver_queued_leads(plan)
+        return None
+
+    last = plan.pop_last()
+    dispatch_plan(plan)
+
+    if last is None:
+        return None
+
+    method, payload = last
+    # The reply is still a message Telegram counts against the chat's limits
+    if bot_api.rate_limiter is not None and bot_api.rate_limiter.acquire(method, payload) is None:
+        return None
+    reply = dict(payload)
+    reply["method"] = method
+    return reply
+
 def send_telegram_message(chat_id, text, parse_mode=None, message_thread_id=None):
     """Send a message to a Telegram chat, optionally to a specific topic/thread."""
     if not BOT_TOKEN:
@@ -49,7 +1143,6 @@ def send_telegram_message(chat_id, text, parse_mode=None, message_thread_id=None
         logger.error("No chat_id provided")
         return False
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text
@@ -64,8 +1157,7 @@ def send_telegram_message(chat_id, text, parse_mode=None, message_thread_id=None
 
     try:
         logger.info(f"Sending message to chat {chat_id}" + (f" in thread {message_thread_id}" if message_thread_id else ""))
-        response = requests.post(url, json=payload, timeout=10)
-        response_json = response.json()
+        response_json = send_bot_call("sendMessage", payload)
 
         if not response_json.get("ok"):
             error_code = response_json.get("error_code", "unknown")
@@ -91,7 +1183,6 @@ def send_telegram_location(chat_id, latitude, longitude, message_thread_id=None)
         logger.error("No chat_id provided")
         return False
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendLocation"
     payload = {
         "chat_id": chat_id,
         "latitude": latitude,
@@ -103,8 +1194,7 @@ def send_telegram_location(chat_id, latitude, longitude, message_thread_id=None)
 
     try:
         logger.info(f"Sending location to chat {chat_id}")
-        response = requests.post(url, json=payload, timeout=10)
-        response_json = response.json()
+        response_json = send_bot_call("sendLocation", payload)
 
         if not response_json.get("ok"):
             error_code = response_json.get("error_code", "unknown")
@@ -122,7 +1212,6 @@ def send_typing_action(chat_id, message_thread_id=None):
     if not BOT_TOKEN or not chat_id:
         return False
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendChatAction"
     payload = {
         "chat_id": chat_id,
         "action": "typing"
@@ -132,21 +1221,183 @@ def send_typing_action(chat_id, message_thread_id=None):
         payload["message_thread_id"] = message_thread_id
 
     try:
-        requests.post(url, json=payload, timeout=5)
+        bot_api.call("sendChatAction", payload)
         return True
     except:
         return False
 
-def get_user_stats(chat_id):
-    """Get user interaction statistics."""
-    if chat_id not in user_states:
-        user_states[chat_id] = {'state': UserState.NORMAL, 'message_count': 0, 'last_interaction': None}
+class TypingIndicator:
+    """Keeps the "typing..." chat action alive in the background while a reply is prepared.
 
-    import datetime
-    user_states[chat_id]['message_count'] = user_states[chat_id].get('message_count', 0) + 1
-    user_states[chat_id]['last_interaction'] = datetime.datetime.now()
+    The first chat action goes out on a background thread at the same moment
+    the caller starts its own work, and is refreshed every few seconds until
+    the indicator is stopped, so nothing on the reply path waits on it.
+    """
+
+    def __init__(self, chat_id, message_thread_id=None, interval=TYPING_REFRESH_SECONDS, max_duration=None):
+        self.chat_id = chat_id
+        self.message_thread_id = message_thread_id
+        self.interval = interval
+        # Stop refreshing when the invocation ends even if stop() is never reached
+        remaining = remaining_budget()
+        self.max_duration = max_duration if max_duration is not None else (remaining if remaining is not None else 60)
+        self.sent = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        with invocation_budget(self.max_duration):
+            while not self._stop.is_set() and remaining_budget() > 0:
+                send_typing_action(self.chat_id, self.message_thread_id)
+                self.sent += 1
+                self._stop.wait(min(self.interval, remaining_budget()))
+
+    def start(self):
+        """Start sending the chat action in the background."""
+        self._thread = threading.Thread(target=self._run, name="typing-indicator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop refreshing the chat action."""
+        self._stop.set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
 
-    return user_states[chat_id]
+class StreamingReply:
+    """A Telegram message filled in while an AI answer is being generated.
+
+    The text is shown up to its last finished sentence: the first sentence
+    is sent as a new message, later text is applied with editMessageText at
+    most every `interval` seconds, and finish() makes the final edit. These
+    calls go straight to the Bot API because edits need the message_id.
+    One call is in flight at a time and the lock is never held during it;
+    nothing is shown after finish(), and a sendMessage still in flight when
+    finish() is called is edited instead of being followed by a second message.
+    finish() waits for that call only until the invocation deadline; past it
+    the final text is left for the in-flight call to apply when it returns.
+    """
+
+    SENTENCE_END = re.compile(r"[.!?…](?=\s)|\n")
+
+    def __init__(self, chat_id, message_thread_id=None, interval=AI_STREAM_EDIT_INTERVAL, clock=time.monotonic):
+        self.chat_id = chat_id
+        self.message_thread_id = message_thread_id
+        self.interval = interval
+        self.clock = clock
+        self.message_id = None
+        self.shown = ""
+        self.edits = 0
+        self._last_update = 0.0
+        self._failed = False
+        self._finished = False
+        self._sending = False
+        self._final = None
+        self._idle = threading.Condition()
+
+    def _visible(self, text):
+        """Text up to the end of its last finished sentence."""
+        end = 0
+        for match in self.SENTENCE_END.finditer(text):
+            end = match.end()
+        return text[:end].strip()
+
+    def _call(self, method, payload):
+        try:
+            response_json = bot_api.call(method, payload)
+        except Exception as e:
+            logger.error(f"Error streaming reply with {method}: {e}")
+            return None
+        if not response_json.get("ok"):
+            logger.error(f"Telegram API error {response_json.get('error_code', 'unknown')}: "
+                         f"{response_json.get('description', 'unknown error')}")
+            return None
+        return response_json
+
+    def _send(self, text):
+        """sendMessage; returns the new message_id or None."""
+        payload = {"chat_id": self.chat_id, "text": text}
+        if self.message_thread_id:
+            payload["message_thread_id"] = self.message_thread_id
+        response_json = self._call("sendMessage", payload)
+        if response_json is None:
+            return None
+        return response_json.get("result", {}).get("message_id")
+
+    def _edit(self, message_id, text):
+        payload = {"chat_id": self.chat_id, "message_id": message_id, "text": text}
+        return self._call("editMessageText", payload) is not None
+
+    def update(self, text):
+        """Show the generated text so far, within the edit cadence."""
+        visible = self._visible(text)
+        with self._idle:
+            if self._failed or self._finished or self._sending:
+                return
+            if not visible or visible == self.shown:
+                return
+            message_id = self.message_id
+            if message_id is not None and self.clock() - self._last_update < self.interval:
+                return
+            self._sending = True
+
+        editing = message_id is not None
+        if editing:
+            ok = self._edit(message_id, visible)
+        else:
+            message_id = self._send(visible)
+            ok = message_id is not None
+
+        with self._idle:
+            self._sending = False
+            if ok:
+                self.message_id = message_id
+                self.shown = visible
+                self.edits += editing
+                self._last_update = self.clock()
+            elif not editing:
+                # Stop streaming; finish() delivers the whole answer instead
+                self._failed = True
+            final, self._final = self._final, None
+            message_id, shown = self.message_id, self.shown
+            self._idle.notify_all()
+
+        if final is not None:
+            # finish() gave up waiting for this call
+            self._show_final(message_id, shown, final)
+
+    def finish(self, text):
+        """Show the complete reply, sending it as a new message if nothing was shown yet."""
+        with self._idle:
+            self._finished = True
+            # A sendMessage in flight decides whether there is a message to edit
+            if self._sending and not self._idle.wait_for(lambda: not self._sending, remaining_budget()):
+                logger.warning("Streamed reply still sending at the deadline; its call will show the final text")
+                self._final = text
+                return True
+            message_id, shown = self.message_id, self.shown
+        return self._show_final(message_id, shown, text)
+
+    def _show_final(self, message_id, shown, text):
+        if message_id is None:
+            return send_telegram_message(self.chat_id, text, message_thread_id=self.message_thread_id)
+        if text == shown:
+            return True
+        if not self._edit(message_id, text):
+            return False
+        with self._idle:
+            self.shown = text
+            self.edits += 1
+        return True
+
+def get_user_stats(chat_id):
+    """Get user interaction statistics."""
+    return session_store.record_message(chat_id)
 
 def is_business_hours():
     """Check if it's business hours in Uzbekistan (UTC+5)."""
@@ -176,7 +1427,6 @@ def send_to_group(message, topic_id=None):
         logger.error("Bot token or chat ID not configured for group messaging")
         return False
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
     payload = {
         "chat_id": TELEGRAM_CHAT_ID,
         "text": message,
@@ -187,8 +1437,7 @@ def send_to_group(message, topic_id=None):
         payload["message_thread_id"] = int(topic_id)
 
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        response_json = response.json()
+        response_json = bot_api.call("sendMessage", payload)
 
         if response_json.get("ok"):
             logger.info(f"Message sent to group successfully")
@@ -242,6 +1491,211 @@ def format_lead_message(user_data, telegram_user):
 """
     return message.strip()
 
+class LeadOutbox:
+    """Append-only SQLite log of leads waiting to be posted to the sales group.
+
+    Every add is committed with synchronous=FULL, so a lead is on disk before
+    the user is told it was received. Entries are never deleted; delivery
+    only stamps them, which keeps a record of every lead.
+    """
+
+    def __init__(self, path, retry_base_delay=LEAD_RETRY_BASE_DELAY,
+                 retry_max_delay=LEAD_RETRY_MAX_DELAY, max_attempts=LEAD_MAX_ATTEMPTS):
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leads ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL, topic_id TEXT, "
+            "created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL, delivered REAL)"
+        )
+
+    def add(self, message, topic_id=None):
+        """Durably record a lead; returns its id."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO leads (message, topic_id, created, next_attempt) VALUES (?, ?, ?, ?)",
+                (message, None if topic_id is None else str(topic_id), now, now),
+            )
+            return cursor.lastrowid
+
+    def due(self, limit=20):
+        """[(id, message, topic_id, attempts)] of undelivered leads ready for an attempt."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, message, topic_id, attempts FROM leads "
+                "WHERE delivered IS NULL AND attempts < ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (self.max_attempts, time.time(), limit),
+            ).fetchall()
+
+    def next_attempt(self):
+        """Epoch time of the earliest pending retry, or None when nothing is pending."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT MIN(next_attempt) FROM leads WHERE delivered IS NULL AND attempts < ?",
+                (self.max_attempts,),
+            ).fetchone()[0]
+
+    def mark_delivered(self, lead_id):
+        with self._lock:
+            self._conn.execute("UPDATE leads SET delivered = ? WHERE id = ?", (time.time(), lead_id))
+
+    def mark_failed(self, lead_id, attempts):
+        """Count a failed attempt and schedule the next one with exponential backoff."""
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** (attempts - 1)))
+        with self._lock:
+            self._conn.execute(
+                "UPDATE leads SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts, time.time() + delay, lead_id),
+            )
+        if attempts >= self.max_attempts:
+            logger.error(f"Lead {lead_id} could not be delivered after {attempts} attempts")
+
+    def stats(self):
+        with self._lock:
+            total, delivered, failed = self._conn.execute(
+                "SELECT COUNT(*), COUNT(delivered), "
+                "SUM(CASE WHEN delivered IS NULL AND attempts >= ? THEN 1 ELSE 0 END) FROM leads",
+                (self.max_attempts,),
+            ).fetchone()
+        return {
+            "total": total,
+            "delivered": delivered,
+            "pending": total - delivered - (failed or 0),
+            "failed": failed or 0,
+        }
+
+    def close(self):
+        self._conn.close()
+
+class LeadDrainer:
+    """Background thread that posts outbox leads to the group and retries failures.
+
+    The thread starts on the first wake() and sleeps until it is woken again
+    or the next retry is due. Unless `background` is set by a long-lived
+    runner, new leads are also attempted inline, since a serverless instance
+    is frozen as soon as the webhook has answered.
+    """
+
+    def __init__(self, outbox, send=None, batch_size=20):
+        self.outbox = outbox
+        self.send = send
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self.background = False
+        self.delivered = 0
+        self.failures = 0
+
+    def drain_once(self):
+        """Attempt every due lead once; returns how many were delivered."""
+        send = self.send or send_to_group
+        delivered = 0
+        # The thread and an inline drain must not post the same lead twice
+        with self._drain_lock:
+            for lead_id, message, topic_id, attempts in self.outbox.due(self.batch_size):
+                try:
+                    ok = send(message, topic_id)
+                except Exception as e:
+                    logger.error(f"Error delivering lead {lead_id}: {e}")
+                    ok = False
+                if ok:
+                    self.outbox.mark_delivered(lead_id)
+                    self.delivered += 1
+                    delivered += 1
+                else:
+                    self.outbox.mark_failed(lead_id, attempts + 1)
+                    self.failures += 1
+        return delivered
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                while self.outbox.due(1):
+                    self.drain_once()
+                next_attempt = self.outbox.next_attempt()
+            except Exception as e:
+                logger.error(f"Lead outbox error: {e}")
+                next_attempt = time.time() + LEAD_RETRY_BASE_DELAY
+            timeout = None if next_attempt is None else max(0.0, next_attempt - time.time())
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def wake(self):
+        """Start the drainer if needed and have it look for due leads now."""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="lead-drainer", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """Stop the drainer thread after its current attempt."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {"delivered": self.delivered, "failures": self.failures, **self.outbox.stats()}
+
+def create_lead_outbox(path=LEAD_OUTBOX_PATH):
+    """Open the lead outbox, or None to post leads synchronously."""
+    try:
+        return LeadOutbox(path)
+    except Exception as e:
+        logger.error(f"Error opening lead outbox {path}, leads will be sent directly: {e}")
+        return None
+
+# Leads waiting for delivery to the sales group
+lead_outbox = create_lead_outbox()
+lead_drainer = LeadDrainer(lead_outbox) if lead_outbox is not None else None
+
+def queue_lead(message, topic_id=None):
+    """Save a lead for delivery to the group; falls back to sending it now.
+
+    In webhook mode the lead is posted within this invocation, but only after
+    the user's reply has been sent (see deliver_queued_leads); the outbox keeps
+    it for retries if that fails.
+    """
+    if lead_drainer is None:
+        return send_to_group(message, topic_id)
+    try:
+        lead_drainer.outbox.add(message, topic_id)
+    except Exception as e:
+        logger.error(f"Error saving lead to outbox: {e}")
+        return send_to_group(message, topic_id)
+
+    if lead_drainer.background:
+        lead_drainer.wake()
+        return True
+    plan = getattr(_outgoing, "plan", None)
+    if plan is not None:
+        plan.leads_queued = True
+    else:
+        deliver_queued_leads()
+    return True
+
+def deliver_queued_leads(plan=None):
+    """Post the leads saved while handling a message, once its reply has been sent."""
+    if lead_drainer is None or (plan is not None and not plan.leads_queued):
+        return
+    try:
+        lead_drainer.drain_once()
+    except Exception as e:
+        logger.error(f"Error delivering leads: {e}")
+    # Failed posts are retried from the outbox
+    lead_drainer.wake()
+
 def add_cta_to_message(message):
     """Add call-to-action to any bot response."""
     cta = "\n\n🤝 *Agar bizning xizmatlarimizga muhtoj bo'lsangiz, biz bilan bog'lanishdan tortinmang!*"
@@ -298,114 +1752,418 @@ def is_reply_to_bot(message):
     replied_from = reply_to_message.get('from', {})
     return replied_from.get('is_bot', False) and replied_from.get('username', '').lower() == 'optimuspremiumbot'
 
+# Phrases that always switch the reply to English
+EXPLICIT_ENGLISH_REQUESTS = (
+    'english', 'ingliz', 'inglizcha', 'in english', 'speak english',
+    'can you speak english', 'switch to english', 'ingliz tilida',
+    'please respond in english', 'answer in english'
+)
+
+# Very specific English phrases that indicate clear English intent
+STRONG_ENGLISH_PHRASES = (
+    'hello there', 'thank you very much', 'could you please tell me',
+    'i would like to know', 'can you tell me about', 'i need information about',
+    'what can you do for me', 'how can you help me with', 'please provide information'
+)
+
+# Any of these (even common ones) keeps the reply in Uzbek
+UZBEK_WORDS = (
+    'salom', 'rahmat', 'iltimos', 'kerak', 'nima', 'qanday', 'qachon', 'qayerda',
+    'loyiha', 'xizmat', 'dastur', 'sayt', 'mobil', 'yordam', 'kompaniya', 'jamoa',
+    'haqida', 'uchun', 'bilan', 'qilish', 'berish', 'olish', 'ko\'rish', 'bo\'lish'
+)
+
+class KeywordMatcher:
+    """Find keywords of several categories in one pass over a text.
+
+    All keywords are compiled into a single regex shaped like a trie, so each
+    position of the text is matched against the keywords sharing its next
+    characters only. The longest keyword matching at a position also reports
+    the categories of the shorter keywords that are its prefixes.
+    """
+
+    def __init__(self, categories):
+        flags = {}
+        for name, keywords in categories.items():
+            for keyword in keywords:
+                flags.setdefault(keyword, set()).add(name)
+        self.flags = {
+            keyword: frozenset().union(*(names for other, names in flags.items() if keyword.startswith(other)))
+            for keyword in flags
+        }
+        self.pattern = re.compile(self._trie_pattern(flags))
+
+    @staticmethod
+    def _trie_pattern(keywords):
+        """Build a regex matching the longest of the keywords at a position."""
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items(), key=lambda item: item[0] or "") if char is not None]
+            if not branches:
+                return ""
+            body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            # Greedy optional group: the longer keyword wins when both match
+            return "(?:" + body + ")?" if None in node else body
+
+        return build(trie)
+
+    def scan(self, text, stop=None):
+        """Return the categories found in text, ending early once `stop` is found."""
+        found = set()
+        search = self.pattern.search
+        match = search(text)
+        while match is not None:
+            found |= self.flags[match.group()]
+            if stop in found:
+                break
+            # Resume one character later so overlapping keywords are seen too
+            match = search(text, match.start() + 1)
+        return found
+
+language_matcher = KeywordMatcher({
+    "explicit": EXPLICIT_ENGLISH_REQUESTS,
+    "strong": STRONG_ENGLISH_PHRASES,
+    "uzbek": UZBEK_WORDS,
+})
+
+def _language_from_signals(found, text):
+    # Explicit English requests always win
+    if "explicit" in found:
+        return "english"
+
+    # Very strict English detection - only if very specific English phrases and NO Uzbek
+    if "strong" in found and "uzbek" not in found and len(text.split()) >= 4:
+        return "english"
+
+    # Default to Uzbek in ALL other cases
+    return "uzbek"
+
 def detect_language(text):
     """Detect if the message is in Uzbek or English based on keywords and patterns."""
     if not text:
         return "uzbek"  # Default to Uzbek
 
-    text_lower = text.lower()
+    return _language_from_signals(language_matcher.scan(text.lower(), stop="explicit"), text)
 
-    # Uzbek indicators
-    uzbek_keywords = [
-    # --- Salomlashish va xayrlashish ---
-    'salom', 'assalomu alaykum', 'alaykum assalom', 'xayr', 'xayrli tong',
-    'xayrli kun', 'xayrli kech', 'omad', 'tabriklayman', 'marhamat',
-
-    # --- Odob va minnatdorchilik ---
-    'rahmat', 'katta rahmat', 'iltimos', 'iltimos qilaman', 'uzr', 'kechirasiz',
-    'afsus', 'rozi', 'marhamat', 'qabul qildim', 'tasdiq',
-
-    # --- Savollar uchun so'zlar ---
-    'nima', 'qanday', 'qachon', 'qayerda', 'qayerdan', 'kim', 'nega', 'qancha',
-    'qaysi', 'qanaqa', 'qanaqasiga', 'nimaga', 'qayerlik', 'qaysi biri',
-
-    # --- Loyiha va xizmatlar ---
-    'loyiha', 'xizmat', 'dastur', 'sayt', 'vebsayt', 'mobil', 'ilova',
-    'ishlab chiqish', 'dasturlash', 'yordam', 'kompaniya', 'firma', 'jamoa',
-    'zakaz', 'buyurtma', 'texnologiya', 'rivojlantirish', 'yaratish',
-    'qilish', 'tuzish', 'platforma', 'raqamlashtirish', 'startap', 'hamkorlik',
-    'maqsad', 'natija', 'funksiya', 'imkoniyat', 'integratsiya', 'backend',
-    'frontend', 'server', 'ma’lumotlar bazasi',
-
-    # --- Moliyaviy va ish jarayoni ---
-    'narx', 'tekinga', 'shartnoma', 'hisob', 'pul', 'to\'lov', 'muddat',
-    'byudjet', 'arzon', 'qimmat', 'daromad', 'foyda', 'investitsiya',
-
-    # --- Foydalanuvchi uchun so'zlar ---
-    'foydalanuvchi', 'mijoz', 'aloqa', 'savol', 'javob', 'fikr', 'taklif',
-    'so\'rov', 'shikoyat', 'profil', 'akkaunt', 'ro\'yxat', 'kirish', 'chiqish',
-
-    # --- Uzbek tiliga xos belgilar ---
-    'o\'', 'g\'', 'sh', 'ch', 'ng', 'ʼ', '‘', '’', 'yo\'q', 'ha'
-    ]
+# Phrases asking to switch back to Uzbek
+EXPLICIT_UZBEK_REQUESTS = (
+    "o'zbekcha", 'oʻzbekcha', 'o‘zbekcha', 'ozbekcha', 'uzbekcha', "o'zbek tilida", 'oʻzbek tilida',
+    'o‘zbek tilida', 'in uzbek', 'speak uzbek', 'switch to uzbek', 'answer in uzbek'
+)
 
-    # English indicators
-    english_keywords = [
-    # --- Greetings & Polite words ---
-    'hello', 'hi', 'hey', 'good morning', 'good evening', 'good night',
-    'bye', 'goodbye', 'thanks', 'thank', 'thank you', 'please', 'welcome',
-
-    # --- Common requests & needs ---
-    'need', 'want', 'require', 'looking for', 'searching', 'help', 'support',
-    'assist', 'guide', 'show', 'tell', 'explain', 'about',
-
-    # --- Question words ---
-    'what', 'how', 'when', 'where', 'who', 'why', 'which', 'whose',
-
-    # --- Project / Business related ---
-    'project', 'service', 'solution', 'product', 'platform', 'system',
-    'app', 'application', 'website', 'web', 'portal', 'software', 'mobile',
-    'development', 'design', 'build', 'create', 'make', 'deploy', 'launch',
-    'technology', 'digital', 'automation', 'integration', 'startup', 'business',
-
-    # --- Company / Team ---
-    'company', 'team', 'group', 'agency', 'enterprise', 'organization',
-    'partner', 'collaboration', 'client', 'customer', 'user', 'profile',
-
-    # --- Finance & Contract ---
-    'price', 'cost', 'budget', 'payment', 'invoice', 'deal', 'contract',
-    'profit', 'income', 'revenue', 'investment', 'free', 'cheap', 'expensive',
-
-    # --- General small words ---
-    'can', 'could', 'will', 'would', 'shall', 'should',
-    'you', 'your', 'me', 'my', 'i', 'we', 'our', 'they', 'their',
-    'with', 'for', 'and', 'the', 'is', 'are', 'was', 'were', 'very', 'much'
-    ]
+request_matcher = KeywordMatcher({
+    "english": EXPLICIT_ENGLISH_REQUESTS,
+    "uzbek": EXPLICIT_UZBEK_REQUESTS,
+})
 
-    # Check for explicit English requests first
-    explicit_english_requests = [
-        'english', 'ingliz', 'inglizcha', 'in english', 'speak english',
-        'can you speak english', 'switch to english', 'ingliz tilida',
-        'please respond in english', 'answer in english'
-    ]
-
-    if any(phrase in text_lower for phrase in explicit_english_requests):
+def requested_language(text):
+    """Return the language a message explicitly asks for, or None."""
+    if not text:
+        return None
+    found = request_matcher.scan(text.lower(), stop="english")
+    if "english" in found:
         return "english"
+    if "uzbek" in found:
+        return "uzbek"
+    return None
 
-    # Very specific English phrases that indicate clear English intent
-    strong_english_phrases = [
-        'hello there', 'thank you very much', 'could you please tell me',
-        'i would like to know', 'can you tell me about', 'i need information about',
-        'what can you do for me', 'how can you help me with', 'please provide information'
-    ]
+class LanguagePreferences:
+    """Bounded LRU cache of each chat's reply language, with a TTL.
 
-    # Only switch to English if there's a very specific English phrase AND no Uzbek words
-    has_strong_english = any(phrase in text_lower for phrase in strong_english_phrases)
+    A preference is stored when a chat explicitly asks for a language or a
+    message is confidently detected, and it sticks for later messages until
+    the chat asks otherwise or the entry expires.
+    """
 
-    # Check for any Uzbek words (even common ones)
-    uzbek_words = [
-        'salom', 'rahmat', 'iltimos', 'kerak', 'nima', 'qanday', 'qachon', 'qayerda',
-        'loyiha', 'xizmat', 'dastur', 'sayt', 'mobil', 'yordam', 'kompaniya', 'jamoa',
-        'haqida', 'uchun', 'bilan', 'qilish', 'berish', 'olish', 'ko\'rish', 'bo\'lish'
-    ]
-    has_uzbek_words = any(word in text_lower for word in uzbek_words)
+    def __init__(self, max_size=LANGUAGE_CACHE_SIZE, ttl=LANGUAGE_CACHE_TTL_SECONDS):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id):
+        """Return the chat's preferred language, or None if unknown or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[chat_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, chat_id, language):
+        """Remember a chat's language, evicting the least recently used chats."""
+        with self._lock:
+            self._entries[chat_id] = (language, time.monotonic() + self.ttl)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget all preferences and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return cache size and hit/miss counters."""
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+language_preferences = LanguagePreferences()
+
+class CharNgramLanguageModel:
+    """Character-trigram language identifier over hashed n-gram counts.
+
+    Trigrams are hashed into a fixed-size count vector and scored against a
+    (languages x buckets) matrix of log-probabilities, one dot product per
+    batch of texts. The matrix is built by train_language_model.py and
+    stored as a float16 .npy file.
+    """
 
-    # Very strict English detection - only if very specific English phrases and NO Uzbek
-    if has_strong_english and not has_uzbek_words and len(text.split()) >= 4:
-        return "english"
+    LANGUAGES = ("uz_latin", "uz_cyrillic", "russian", "english")
+    # The bot answers in Uzbek or English; everything but English gets Uzbek
+    REPLY_LANGUAGES = {"uz_latin": "uzbek", "uz_cyrillic": "uzbek", "russian": "uzbek", "english": "english"}
+    DIMENSION = 4096
+    BATCH_SIZE = 256
+    HASH_MULTIPLIER = 1000003
+    APOSTROPHES = str.maketrans({'ʼ': "'", 'ʻ': "'", '‘': "'", '’': "'", '`': "'"})
+
+    def __init__(self, log_probs):
+        log_probs = np.asarray(log_probs, dtype=np.float32)
+        if log_probs.shape != (len(self.LANGUAGES), self.DIMENSION):
+            raise ValueError(f"Expected a {len(self.LANGUAGES)}x{self.DIMENSION} matrix, got {log_probs.shape}")
+        self.log_probs = log_probs
+
+    @classmethod
+    def load(cls, path):
+        """Load a model saved with save()."""
+        return cls(np.load(path))
+
+    def save(self, path):
+        """Save the log-probability matrix as a compact float16 .npy file."""
+        np.save(path, self.log_probs.astype(np.float16))
+
+    @classmethod
+    def train(cls, corpora, alpha=0.5):
+        """Build a model from {language: [texts]} with additive smoothing."""
+        counts = np.stack([cls.featurize(corpora.get(language, [])).sum(axis=0) for language in cls.LANGUAGES])
+        smoothed = counts + alpha
+        return cls(np.log(smoothed / smoothed.sum(axis=1, keepdims=True)))
+
+    @classmethod
+    def normalize(cls, text):
+        """Lowercase, unify apostrophes and collapse whitespace, padded with spaces."""
+        return " " + " ".join(text.lower().translate(cls.APOSTROPHES).split()) + " "
+
+    @classmethod
+    def hash_trigrams(cls, texts):
+        """Return (row, bucket) arrays for every character trigram of the texts."""
+        normalized = [cls.normalize(text) for text in texts]
+        lengths = np.fromiter(map(len, normalized), dtype=np.int64, count=len(normalized))
+        codes = np.frombuffer("".join(normalized).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        rows = np.repeat(np.arange(len(normalized)), lengths)
+        # Keep only trigrams whose characters all belong to the same text
+        valid = rows[:-2] == rows[2:]
+        multiplier = np.uint64(cls.HASH_MULTIPLIER)
+        hashes = (codes[:-2] * multiplier + codes[1:-1]) * multiplier + codes[2:]
+        return rows[:-2][valid], (hashes[valid] % np.uint64(cls.DIMENSION)).astype(np.int64)
+
+    @classmethod
+    def featurize(cls, texts):
+        """Return a (len(texts), DIMENSION) matrix of hashed trigram counts."""
+        rows, buckets = cls.hash_trigrams(texts)
+        counts = np.bincount(rows * cls.DIMENSION + buckets, minlength=len(texts) * cls.DIMENSION)
+        return counts.reshape(len(texts), cls.DIMENSION).astype(np.float32)
+
+    def log_likelihoods(self, texts):
+        """Return a (len(texts), languages) matrix of log-likelihoods."""
+        texts = list(texts)
+        scores = np.empty((len(texts), len(self.LANGUAGES)), dtype=np.float32)
+        for start in range(0, len(texts), self.BATCH_SIZE):
+            batch = texts[start:start + self.BATCH_SIZE]
+            scores[start:start + len(batch)] = self.featurize(batch) @ self.log_probs.T
+        return scores
+
+    def predict(self, texts):
+        """Classify many texts at once; returns a list of (language, confidence)."""
+        scores = self.log_likelihoods(texts)
+        if not len(scores):
+            return []
+        probs = np.exp(scores - scores.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        best = probs.argmax(axis=1)
+        return [(self.LANGUAGES[index], float(probs[row, index])) for row, index in enumerate(best)]
+
+    def identify(self, text):
+        """Classify a single text; returns (language, confidence)."""
+        return self.predict([text])[0]
+
+def load_language_model(path=LANGUAGE_MODEL_PATH):
+    """Load the n-gram language model, or return None if it is unavailable."""
+    if np is None:
+        return None
+    try:
+        return CharNgramLanguageModel.load(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Language model not loaded from {path}: {e}")
+        return None
 
-    # Default to Uzbek in ALL other cases
-    return "uzbek"
+@lru_cache(maxsize=1)
+def get_language_model():
+    """The n-gram language model, loaded on first use."""
+    return load_language_model()
+
+def identify_languages(texts):
+    """Classify many texts with the n-gram model; returns (language, confidence) pairs.
+
+    Returns None when the model is not available.
+    """
+    model = get_language_model()
+    if model is None:
+        return None
+    return model.predict(texts)
+
+def resolve_language(chat_id, text):
+    """Return the reply language for a chat, remembering explicit and confident choices.
+
+    Chats with a known preference only have the message checked for an
+    explicit request; full detection runs for chats seen for the first time.
+    """
+    requested = requested_language(text)
+    if requested:
+        language_preferences.set(chat_id, requested)
+        return requested
+
+    known = language_preferences.get(chat_id)
+    if known:
+        return known
+
+    if not text:
+        return "uzbek"
+    found = language_matcher.scan(text.lower())
+    language = _language_from_signals(found, text)
+    # Plain messages like "Hello" or "/start" are not evidence either way
+    if language == "english" or "uzbek" in found:
+        language_preferences.set(chat_id, language)
+    elif not text.startswith('/') and get_language_model() is not None:
+        # Cyrillic Uzbek and Russian carry no Uzbek keywords but are still confident
+        label, confidence = get_language_model().identify(text)
+        if confidence >= LANGUAGE_MODEL_MIN_CONFIDENCE and CharNgramLanguageModel.REPLY_LANGUAGES[label] == language:
+            language_preferences.set(chat_id, language)
+    return language
+
+class Intent:
+    """Intents recognized in free-text messages."""
+    LOCATION = 'location'
+    GREETING = 'greeting'
+    THANKS = 'thanks'
+    SERVICE = 'service'
+    ORDER = 'order'
+    STOP = 'stop'
+
+INTENT_KEYWORDS = {
+    Intent.LOCATION: ('location', 'manzil', 'address', 'joylashuv', 'where', 'qayerda', 'qayer'),
+    Intent.GREETING: ('salom', 'assalom', 'hello', 'hi', 'assalomu alaykum', 'good morning', 'good day', 'xayrli'),
+    Intent.THANKS: ('rahmat', 'thank', 'thanks', 'tashakkur', 'grateful'),
+    Intent.SERVICE: (
+        'xizmat', 'service', 'loyiha', 'project', 'dastur', 'app', 'apps', 'sayt', 'vebsayt', 'website',
+        'mobil', 'mobile', 'bot', 'bots', 'botlar', 'dizayn', 'design', 'ishlab chiqish', 'development',
+        'kerak', 'need', 'qilish', 'make', 'yaratish', 'create', 'buyurtma', 'order',
+        'price', 'narx', 'cost', 'qancha', 'how much', 'budget'
+    ),
+    Intent.ORDER: ('buyurtma', 'order'),
+    Intent.STOP: ('stop', 'bekor', 'bekor qilish', 'cancel', 'quit', 'exit', 'chiqish', 'toxta', 'toxtash', 'to\'xta'),
+}
+
+class IntentClassifier:
+    """Tokenizing keyword classifier that returns every intent found in a message.
+
+    Keywords of up to three letters match whole words only, so 'hi' does not
+    fire on 'this'; longer ones also match as word stems ('manzil' in
+    'manzilingiz'). Multi-word phrases are matched first and consume their
+    words, so 'ishlab chiqish' is not read as the stop word 'chiqish'.
+    """
+
+    EXACT_MAX_LENGTH = 3
+    APOSTROPHES = str.maketrans({'ʼ': "'", '‘': "'", '’': "'", '`': "'"})
+    TOKEN_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+
+    def __init__(self, keywords):
+        self.exact = {}
+        self.stems = {}
+        phrases = {}
+        for intent, words in keywords.items():
+            for keyword in words:
+                tokens = tuple(self.tokenize(keyword))
+                if len(tokens) > 1:
+                    phrases.setdefault(tokens[0], {}).setdefault(tokens, set()).add(intent)
+                else:
+                    index = self.exact if len(tokens[0]) <= self.EXACT_MAX_LENGTH else self.stems
+                    index.setdefault(tokens[0], set()).add(intent)
+        # Candidate phrases per first word, longest first
+        self.phrases = {
+            first: sorted(((phrase, frozenset(intents)) for phrase, intents in candidates.items()),
+                          key=lambda item: -len(item[0]))
+            for first, candidates in phrases.items()
+        }
+        self.min_stem = min(map(len, self.stems), default=1)
+
+    def tokenize(self, text):
+        """Lowercase text, unify Uzbek apostrophes and split it into words."""
+        return self.TOKEN_PATTERN.findall(text.lower().translate(self.APOSTROPHES))
+
+    def _word_matches(self, keyword, token):
+        if len(keyword) <= self.EXACT_MAX_LENGTH:
+            return token == keyword
+        return token.startswith(keyword)
+
+    def _lookup(self, token):
+        found = set(self.exact.get(token, ()))
+        for end in range(self.min_stem, len(token) + 1):
+            found.update(self.stems.get(token[:end], ()))
+        return found
+
+    def classify(self, text):
+        """Return the set of intents found in text."""
+        tokens = self.tokenize(text)
+        found = set()
+        i = 0
+        while i < len(tokens):
+            for phrase, intents in self.phrases.get(tokens[i], ()):
+                following = tokens[i + 1:i + len(phrase)]
+                if len(following) == len(phrase) - 1 and all(map(self._word_matches, phrase[1:], following)):
+                    found |= intents
+                    i += len(phrase)
+                    break
+            else:
+                found |= self._lookup(tokens[i])
+                i += 1
+        return found
+
+intent_classifier = IntentClassifier(INTENT_KEYWORDS)
+
+def classify_intents(text):
+    """Return every intent found in a message."""
+    if not text:
+        return set()
+    return intent_classifier.classify(text)
 
 def get_order_prompt(language="uzbek"):
     """Get the order prompt in the specified language."""
@@ -680,27 +2438,20 @@ BUSINESS FOCUS:
 - Interactive citizen engagement platforms
 """
 
-def get_ai_response(user_message, user_name="User", user_language="uzbek"):
-    """Get AI response using Groq API in the user's language."""
-    if not groq_client:
-        if user_language == "english":
-            return "🤖 AI features are currently unavailable. Please use /info for company information or /help for available commands."
-        else:
-            return "🤖 AI xususiyatlari hozircha mavjud emas. Kompaniya ma'lumotlari uchun /info yoki yordam uchun /help dan foydalaning."
+def build_system_prompt(user_name, user_language="uzbek", knowledge=None):
+    """Build the Groq system prompt; `knowledge` defaults to the full knowledge base."""
+    # Language-specific instructions - default to Uzbek
+    if user_language == "english":
+        language_instruction = "The user has explicitly requested English. Respond in English only."
+    else:
+        language_instruction = "FAQAT o'zbek tilida javob bering. Always respond in Uzbek language only. Do not use English unless explicitly requested."
 
-    try:
-        # Language-specific instructions - default to Uzbek
-        if user_language == "english":
-            language_instruction = "The user has explicitly requested English. Respond in English only."
-            fallback_message = "🤖 I'm having trouble processing your request right now. Please try again or use /info for company information."
-        else:
-            language_instruction = "FAQAT o'zbek tilida javob bering. Always respond in Uzbek language only. Do not use English unless explicitly requested."
-            fallback_message = "🤖 Hozir so'rovingizni qayta ishlay olmayapman. Iltimos, qayta urinib ko'ring yoki kompaniya ma'lumotlari uchun /info dan foydalaning."
+    if knowledge is None:
+        knowledge = get_company_knowledge_base()
 
-        # Create context with company information
-        system_prompt = f"""You are an AI assistant for PremiumSoft.uz, a software development company in Uzbekistan.
+    return f"""You are an AI assistant for PremiumSoft.uz, a software development company in Uzbekistan.
 
-{get_company_knowledge_base()}
+{knowledge}
 
 Your role:
 - You talk primarily in Uzbek until someone asks for English
@@ -717,33 +2468,460 @@ Your role:
 User's name: {user_name}
 """
 
-        # Get AI response
-        chat_completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            model="llama3-8b-8192",  # Free model
-            max_tokens=500,
-            temperature=0.7
-        )
+# Uzbek words for each knowledge-base section, whose text is in English
+KNOWLEDGE_BASE_ALIASES = {
+    "COMPANY OVERVIEW": ("kompaniya", "haqida", "tashkil", "tajriba", "yil", "firma", "rasmiy"),
+    "TRACK RECORD & ACHIEVEMENTS": ("statistika", "yutuq", "natija", "nechta", "mijoz", "tajriba"),
+    "CORE SERVICES": ("xizmat", "sayt", "vebsayt", "ilova", "mobil", "bot", "dizayn", "logotip", "hosting",
+                      "domen", "server", "konsalting", "narx", "qancha", "buyurtma", "dastur"),
+    "NOTABLE PROJECTS": ("loyiha", "portfolio", "namuna", "ishlar", "murojaat"),
+    "TEAM MEMBERS": ("jamoa", "xodim", "dasturchi", "rahbar", "a'zo", "kim", "kimlar", "mutaxassis", "dizayner"),
+    "APPROACH AND VALUES": ("qadriyat", "yondashuv", "tamoyil", "mas'uliyat"),
+    "COMPANY VALUES & APPROACH": ("qadriyat", "afzallik", "nega", "ishonch", "yordam"),
+    "CONTACT INFORMATION": ("aloqa", "manzil", "telefon", "raqam", "pochta", "qayer", "qayerda", "ish vaqti",
+                            "soat", "ofis", "bog'lanish"),
+    "BUSINESS FOCUS": ("yo'nalish", "soha", "hukumat", "davlat", "tibbiyot", "fuqaro"),
+}
+
+class KnowledgeBaseIndex:
+    """BM25 index over the titled sections of the knowledge base.
+
+    The text is split on its upper-case section titles. Terms are word stems
+    (the first few letters), so inflected Uzbek and English forms meet, and
+    each section also indexes Uzbek aliases. BM25 weights are precomputed
+    into a (sections x terms) matrix, so ranking a question is one product.
+    """
+
+    STEM_LENGTH = 5
+    K1 = 1.5
+    B = 0.75
+    TITLE_PATTERN = re.compile(r"^([A-Z][A-Z &]+):$", re.MULTILINE)
+
+    def __init__(self, text, aliases=None):
+        aliases = aliases or {}
+        self.text = text
+        parts = self.TITLE_PATTERN.split(text)
+        self.preamble = parts[0].strip()
+        self.sections = [(title, body.strip()) for title, body in zip(parts[1::2], parts[2::2])]
+
+        documents = [self.terms(" ".join([title, body, *aliases.get(title, ())])) for title, body in self.sections]
+        self.vocabulary = {}
+        for document in documents:
+            for term in document:
+                self.vocabulary.setdefault(term, len(self.vocabulary))
+
+        counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, document in enumerate(documents):
+            for term in document:
+                counts[row, self.vocabulary[term]] += 1
+        lengths = counts.sum(axis=1, keepdims=True)
+        document_frequency = (counts > 0).sum(axis=0)
+        idf = np.log1p((len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+        norm = self.K1 * (1 - self.B + self.B * lengths / max(float(lengths.mean()), 1.0))
+        self.weights = (idf * counts * (self.K1 + 1) / (counts + norm)).astype(np.float32)
+
+    @classmethod
+    def terms(cls, text):
+        """Split text into lowercase word stems."""
+        return [token[:cls.STEM_LENGTH] for token in intent_classifier.tokenize(text)]
+
+    def scores(self, question):
+        """Return the BM25 score of every section for a question."""
+        query = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for term in self.terms(question):
+            column = self.vocabulary.get(term)
+            if column is not None:
+                query[column] += 1
+        return self.weights @ query
+
+    def top_sections(self, question, k):
+        """Indexes of the k best-matching sections in knowledge-base order; empty if none match."""
+        scores = self.scores(question)
+        ranked = [index for index in np.argsort(-scores, kind="stable")[:k] if scores[index] > 0]
+        return sorted(ranked)
+
+    def context(self, question, k):
+        """Knowledge-base text limited to the sections relevant to the question.
+
+        Falls back to the whole knowledge base when no section shares a term
+        with the question.
+        """
+        selected = self.top_sections(question, k)
+        if not selected:
+            return self.text
+        sections = [f"{self.sections[index][0]}:\n{self.sections[index][1]}" for index in selected]
+        return "\n\n".join([self.preamble, *sections])
+
+@lru_cache(maxsize=1)
+def get_knowledge_index():
+    """The knowledge-base search index, built on first use; None without NumPy."""
+    if np is None:
+        return None
+    return KnowledgeBaseIndex(get_company_knowledge_base(), KNOWLEDGE_BASE_ALIASES)
+
+def build_knowledge_context(question):
+    """Return the knowledge-base text to send with a question."""
+    if not KB_RETRIEVAL_ENABLED or get_knowledge_index() is None:
+        return get_company_knowledge_base()
+    return get_knowledge_index().context(question, KB_TOP_K)
+
+_knowledge_base_version = None
+
+def knowledge_base_version():
+    """Short hash of the knowledge base, so cached answers expire when it changes."""
+    global _knowledge_base_version
+    if _knowledge_base_version is None:
+        _knowledge_base_version = hashlib.sha256(get_company_knowledge_base().encode()).hexdigest()[:12]
+    return _knowledge_base_version
+
+@lru_cache(maxsize=4)
+def prompt_words(version):
+    """Lowercase words of the system prompt and knowledge base for a knowledge-base version."""
+    text = build_system_prompt("", "english") + build_system_prompt("", "uzbek")
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+def name_in_prompt(user_name):
+    """Whether any word of a user's name also appears in the prompt (team members, the developer)."""
+    words = prompt_words(knowledge_base_version())
+    return any(word in words for word in re.findall(r"\w+", user_name.lower()))
+
+class ResponseCache:
+    """Bounded LRU cache of AI answers with a TTL.
+
+    Entries are keyed by the normalized question, the reply language and the
+    knowledge-base version. The asker's name is swapped for a placeholder so
+    an answer can be reused for other users; answers to users whose name also
+    appears in the knowledge base are not cached, since the greeting cannot be
+    told apart from a team member's name. Each hit adds the generation time of
+    the cached answer to `saved_seconds`.
+    """
 
+    NAME_PLACEHOLDER = "\x00user_name\x00"
+
+    def __init__(self, max_size=AI_CACHE_SIZE, ttl=AI_CACHE_TTL_SECONDS):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def normalize(question):
+        """Lowercase, unify apostrophes, drop punctuation and extra whitespace."""
+        return " ".join(intent_classifier.tokenize(question))
+
+    def key(self, question, language):
+        return (self.normalize(question), language, knowledge_base_version())
+
+    def get(self, question, language, user_name="", count_miss=True):
+        """Return the cached answer personalized for user_name, or None."""
+        key = self.key(question, language)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[1]
+            answer = entry[0]
+        return self.personalize(answer, user_name)
+
+    @classmethod
+    def depersonalize(cls, answer, user_name):
+        """Replace the asker's name in an answer with the placeholder.
+
+        Returns None when the name also occurs in the prompt, so the answer is not cached.
+        """
+        if len(user_name) <= 1:
+            return answer
+        if name_in_prompt(user_name):
+            return None
+        return re.sub(rf"\b{re.escape(user_name)}\b", cls.NAME_PLACEHOLDER, answer)
+
+    @classmethod
+    def personalize(cls, answer, user_name):
+        """Fill the placeholder in a cached answer with the asker's name."""
+        return answer.replace(cls.NAME_PLACEHOLDER, user_name)
+
+    @staticmethod
+    def cacheable(question, answer):
+        """Whether an answer is worth caching."""
+        return isinstance(answer, str) and bool(answer.strip()) and bool(ResponseCache.normalize(question))
+
+    def put(self, question, language, answer, user_name="", seconds=0.0):
+        """Store an answer that took `seconds` to generate."""
+        if not self.cacheable(question, answer):
+            return
+        answer = self.depersonalize(answer, user_name)
+        if answer is None:
+            return
+        key = self.key(question, language)
+        with self._lock:
+            self._entries[key] = (answer, seconds, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.saved_seconds = 0.0
+
+    def stats(self):
+        """Return size, hit/miss counters and the Groq time saved by hits."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+# Answers to repeated questions, served without another Groq call
+ai_response_cache = ResponseCache() if AI_CACHE_ENABLED else None
+
+# Words that do not change what a question asks, ignored when matching paraphrases
+SEMANTIC_CACHE_STOPWORDS = frozenset("""
+a an the is are am be been do does did can could would will should may you your yours we our us i me my
+it its of for to in on at by and or with about please tell know there this that these those have has
+what which who whom where when how why located offer provide any some also
+siz sizning sizlar sizlarda sizda sizni biz bizning bizga menga men mening u bu shu uchun bilan va yoki
+qanday qaysi nima nimalar kim kimlar qayerda qayer qachon nechta bormi bor kerak haqida iltimos ham mi
+edi ekan bo'ladi joylashgan
+""".split())
+
+# Word prefixes that ask the same thing, mapped to one stem
+SEMANTIC_CACHE_SYNONYMS = (
+    (("narx", "qancha", "turadi", "cost", "price", "pricing", "much"), "price"),
+    (("applicat", "app", "ilova"), "app"),
+    (("vebsayt", "sayt", "website", "site", "veb", "web"), "site"),
+    (("develop", "ishlab", "chiqar", "yarat", "build", "make", "creat"), "build"),
+)
+
+class SemanticCache(ResponseCache):
+    """AI answers found again for paraphrased questions.
+
+    Entries are keyed by the content words of the question (`content_key`)
+    instead of its full text: stopwords are dropped, words are cut to their
+    stem and synonyms such as narx/qancha are unified, while word order is
+    kept so "A cheaper than B" and "B cheaper than A" stay apart. Questions
+    with no content words are not cached.
+    """
+
+    def __init__(self, capacity=SEMANTIC_CACHE_SIZE, ttl=AI_CACHE_TTL_SECONDS):
+        super().__init__(capacity, ttl)
+
+    @staticmethod
+    def content_key(question):
+        """Stems of the content words of a question, in order, synonyms unified."""
+        stems = []
+        for token in intent_classifier.tokenize(question):
+            if token in SEMANTIC_CACHE_STOPWORDS:
+                continue
+            stem = next((canonical for prefixes, canonical in SEMANTIC_CACHE_SYNONYMS
+                         if token.startswith(prefixes)), token[:KnowledgeBaseIndex.STEM_LENGTH])
+            if stem not in stems:
+                stems.append(stem)
+        return tuple(stems)
+
+    def key(self, question, language):
+        return (self.content_key(question), language, knowledge_base_version())
+
+    @classmethod
+    def cacheable(cls, question, answer):
+        """Whether an answer is worth caching under the question's content words."""
+        return ResponseCache.cacheable(question, answer) and bool(cls.content_key(question))
+
+# Answers to paraphrased questions, checked after the exact-match cache
+semantic_cache = SemanticCache() if SEMANTIC_CACHE_ENABLED else None
+
+# Quick answers by intent, used when the AI misses its deadline
+FAQ_ANSWERS = {
+    Intent.SERVICE: {
+        "uzbek": """💼 PremiumSoft.uz xizmatlari: veb-saytlar, mobil ilovalar (iOS, Android), Telegram botlar, informatsion tizimlar (CRM, ERP), UX/UI dizayn, hosting va IT-konsalting.
+
+📞 Telefon: +998 73 244 05 35
+📧 Email: info@premiumsoft.uz""",
+        "english": """💼 PremiumSoft.uz services: websites, mobile apps (iOS, Android), Telegram bots, information systems (CRM, ERP), UX/UI design, hosting and IT consulting.
+
+📞 Phone: +998 73 244 05 35
+📧 Email: info@premiumsoft.uz""",
+    },
+    Intent.LOCATION: {
+        "uzbek": """📍 Manzil: Fargʻona, Ahmad Al-Fargʻoniy shoh koʻchasi, 53, 4-qavat
+📞 Telefon: +998 73 244 05 35""",
+        "english": """📍 Address: Fergana, Ahmad Al-Fergani Shah Street, 53, 4th floor
+📞 Phone: +998 73 244 05 35""",
+    },
+}
+
+# Groq calls run here so a stalled completion cannot hold the reply
+_ai_executor = ThreadPoolExecutor(max_workers=max(1, AI_WORKERS), thread_name_prefix="groq")
+
+def ai_deadline():
+    """Seconds a Groq call may take before the fallback is sent.
+
+    AI_DEADLINE_SECONDS, reduced so that AI_REPLY_RESERVE_SECONDS of the
+    invocation budget are left for sending the reply.
+    """
+    deadline = AI_DEADLINE_SECONDS
+    remaining = remaining_budget()
+    if remaining is not None:
+        deadline = min(deadline, remaining - AI_REPLY_RESERVE_SECONDS)
+    return max(0.0, deadline)
+
+def ai_fallback_response(user_message, user_name, user_language, fallback_message):
+    """Best answer without the AI: a cached answer, an FAQ answer for the intent, or fallback_message."""
+    # Another request may have cached the answer meanwhile; the miss was already counted
+    for cache in (ai_response_cache, semantic_cache):
+        if cache is not None:
+            cached = cache.get(user_message, user_language, user_name, count_miss=False)
+            if cached is not None:
+                return cached
+
+    intents = classify_intents(user_message)
+    for intent, answers in FAQ_ANSWERS.items():
+        if intent in intents:
+            return answers.get(user_language, answers["uzbek"])
+    return fallback_message
+
+def _generate_ai_response(user_message, user_name, user_language, on_text, cancelled):
+    """Call Groq and cache the answer, even if it arrives after the deadline."""
+    # Create context with the company information relevant to the question
+    system_prompt = build_system_prompt(user_name, user_language, build_knowledge_context(user_message))
+
+    # Get AI response
+    client = get_groq_client()
+    started = time.monotonic()
+    request = dict(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ],
+        model="llama3-8b-8192",  # Free model
+        max_tokens=500,
+        temperature=0.7,
+        timeout=AI_REQUEST_TIMEOUT
+    )
+    if on_text is None:
+        chat_completion = client.chat.completions.create(**request)
         response = chat_completion.choices[0].message.content
-        return response
+    else:
+        response = ""
+        for chunk in client.chat.completions.create(stream=True, **request):
+            response += chunk.choices[0].delta.content or ""
+            # The fallback owns the message once the deadline has passed
+            if not cancelled.is_set():
+                on_text(response)
+    # Only real answers are cached; the fallbacks never are
+    seconds = time.monotonic() - started
+    for cache in (ai_response_cache, semantic_cache):
+        if cache is not None:
+            cache.put(user_message, user_language, response, user_name, seconds)
+    if cancelled.is_set():
+        logger.info(f"Late AI response cached after {seconds:.1f}s")
+    return response
+
+@metrics.timed("ai_cache_lookup")
+def cached_ai_response(user_message, user_name, user_language):
+    """A cached AI answer from the exact or the paraphrase cache, or None."""
+    for cache in (ai_response_cache, semantic_cache):
+        if cache is not None:
+            cached = cache.get(user_message, user_language, user_name)
+            if cached is not None:
+                return cached
+    return None
+
+@metrics.timed("ai_response")
+def get_ai_response(user_message, user_name="User", user_language="uzbek", on_text=None, check_cache=True):
+    """Get AI response using Groq API in the user's language.
+
+    When `on_text` is given the completion is streamed and it is called with
+    the text generated so far after every chunk. If Groq does not answer
+    within ai_deadline(), the best fallback is returned instead and the late
+    answer is still cached when it arrives. Pass check_cache=False when the
+    caller already looked the question up.
+    """
+    if not get_groq_client():
+        if user_language == "english":
+            return "🤖 AI features are currently unavailable. Please use /info for company information or /help for available commands."
+        else:
+            return "🤖 AI xususiyatlari hozircha mavjud emas. Kompaniya ma'lumotlari uchun /info yoki yordam uchun /help dan foydalaning."
 
+    if check_cache:
+        cached = cached_ai_response(user_message, user_name, user_language)
+        if cached is not None:
+            return cached
+
+    # Language-specific fallback - default to Uzbek
+    if user_language == "english":
+        fallback_message = "🤖 I'm having trouble processing your request right now. Please try again or use /info for company information."
+    else:
+        fallback_message = "🤖 Hozir so'rovingizni qayta ishlay olmayapman. Iltimos, qayta urinib ko'ring yoki kompaniya ma'lumotlari uchun /info dan foydalaning."
+
+    deadline = ai_deadline()
+    cancelled = threading.Event()
+    try:
+        # The Groq thread inherits the caller's deadline for its streamed Bot API calls
+        future = _ai_executor.submit(run_within_budget, remaining_budget(), _generate_ai_response,
+                                     user_message, user_name, user_language, on_text, cancelled)
+        return future.result(timeout=deadline)
+    except FutureTimeoutError:
+        cancelled.set()
+        logger.warning(f"AI response missed its {deadline:.1f}s deadline, sending a fallback")
+        return ai_fallback_response(user_message, user_name, user_language, fallback_message)
     except Exception as e:
         logger.error(f"AI response error: {e}")
         return fallback_message
 
-def handle_lead_collection(chat_id, text, telegram_user, message_thread_id=None, user_language="uzbek"):
+def send_ai_reply(chat_id, question, user_name, user_language, finalize, message_thread_id=None):
+    """Answer a question with AI and send `finalize(answer)`.
+
+    With AI_STREAMING_ENABLED the answer appears in one message while it is
+    generated, and the finalized text (CTA, business hours) is the last edit.
+    """
+    # A cached answer goes out at once; a typing indicator would outlive it
+    cached = cached_ai_response(question, user_name, user_language) if get_groq_client() else None
+    if cached is not None:
+        send_telegram_message(chat_id, finalize(cached), message_thread_id=message_thread_id)
+        return
+
+    # Show typing indicator in the background while the AI works
+    with TypingIndicator(chat_id, message_thread_id):
+        if not AI_STREAMING_ENABLED:
+            ai_response = get_ai_response(question, user_name, user_language, check_cache=False)
+            send_telegram_message(chat_id, finalize(ai_response), message_thread_id=message_thread_id)
+            return
+
+        reply = StreamingReply(chat_id, message_thread_id)
+        ai_response = get_ai_response(question, user_name, user_language, on_text=reply.update, check_cache=False)
+        reply.finish(finalize(ai_response))
+
+def handle_lead_collection(chat_id, text, telegram_user, message_thread_id=None, user_language="uzbek", intents=None):
     """Handle lead generation conversation flow."""
-    user_data = user_states[chat_id]
+    user_data = session_store.get(chat_id) or {'state': UserState.NORMAL}
+    if intents is None:
+        intents = classify_intents(text)
 
     # Check for stop commands
-    stop_keywords = ['stop', 'bekor', 'bekor qilish', 'cancel', 'quit', 'exit', 'chiqish', 'toxta', 'toxtash']
-    if any(keyword in text.lower() for keyword in stop_keywords):
+    if Intent.STOP in intents:
         # Reset user state
-        user_states[chat_id] = {'state': UserState.NORMAL}
+        session_store.set(chat_id, {'state': UserState.NORMAL})
 
         if user_language == "english":
             response = """❌ Order process cancelled.
@@ -764,6 +2942,7 @@ Istalgan vaqtda /order buyrug'i orqali qaytadan boshlashingiz mumkin.
     if user_data['state'] == UserState.COLLECTING_PROJECT:
         user_data['project'] = text
         user_data['state'] = UserState.COLLECTING_NAME
+        session_store.set(chat_id, user_data)
         if user_language == "english":
             response = "Thank you! Now please write your name:\n\n💡 *Tip: You can type 'stop' anytime to cancel*"
         else:
@@ -773,6 +2952,7 @@ Istalgan vaqtda /order buyrug'i orqali qaytadan boshlashingiz mumkin.
     elif user_data['state'] == UserState.COLLECTING_NAME:
         user_data['name'] = text
         user_data['state'] = UserState.COLLECTING_PHONE
+        session_store.set(chat_id, user_data)
         if user_language == "english":
             response = "Great! Now please write your phone number:\n\n💡 *Tip: You can type 'stop' anytime to cancel*"
         else:
@@ -782,6 +2962,7 @@ Istalgan vaqtda /order buyrug'i orqali qaytadan boshlashingiz mumkin.
     elif user_data['state'] == UserState.COLLECTING_PHONE:
         user_data['phone'] = text
         user_data['state'] = UserState.COLLECTING_EMAIL
+        session_store.set(chat_id, user_data)
         if user_language == "english":
             response = "Excellent! Finally, please write your email address:\n\n💡 *Tip: You can type 'stop' anytime to cancel*"
         else:
@@ -791,12 +2972,12 @@ Istalgan vaqtda /order buyrug'i orqali qaytadan boshlashingiz mumkin.
     elif user_data['state'] == UserState.COLLECTING_EMAIL:
         user_data['email'] = text
 
-        # Send lead to group
+        # Save the lead; it is posted to the group after the user is confirmed
         lead_message = format_lead_message(user_data, telegram_user)
-        send_to_group(lead_message, TELEGRAM_TOPIC_ID)
+        queue_lead(lead_message, TELEGRAM_TOPIC_ID)
 
         # Reset user state
-        user_states[chat_id] = {'state': UserState.NORMAL}
+        session_store.set(chat_id, {'state': UserState.NORMAL})
 
         # Confirm to user in their language
         if user_language == "english":
@@ -816,13 +2997,13 @@ Istalgan vaqtda /order buyrug'i orqali qaytadan boshlashingiz mumkin.
 
 def start_lead_collection(chat_id, message_thread_id=None, user_language="uzbek"):
     """Start the lead collection process - Default to Uzbek."""
-    user_states[chat_id] = {
+    session_store.set(chat_id, {
         'state': UserState.COLLECTING_PROJECT,
         'project': '',
         'name': '',
         'phone': '',
         'email': ''
-    }
+    })
 
     # Always default to Uzbek unless explicitly English
     if user_language == "english":
@@ -841,49 +3022,44 @@ def start_lead_collection(chat_id, message_thread_id=None, user_language="uzbek"
 
     send_telegram_message(chat_id, response, message_thread_id=message_thread_id)
 
-def handle_message(message):
-    """Handle a message from Telegram."""
-    chat_id = message.get('chat', {}).get('id')
-    chat_type = message.get('chat', {}).get('type', 'private')
-    text = message.get('text', '')
-    user_name = message.get('from', {}).get('first_name', 'Foydalanuvchi')
-    telegram_user = message.get('from', {})
+class ReplyTemplates:
+    """Static replies rendered once at import, per language and variant.
 
-    # Extract topic/thread information
-    message_thread_id = message.get('message_thread_id')
+    Templates may contain USER_NAME; they are stored split around it, so a
+    reply is built with a single join, or returned as is when it has no name.
+    Any language other than English gets the Uzbek text.
+    """
 
-    if not chat_id:
-        logger.error("Message missing chat_id")
-        return
+    USER_NAME = "\x00user_name\x00"
 
-    # Check if this is a reply to the bot
-    is_reply = is_reply_to_bot(message)
+    def __init__(self):
+        self._parts = {}
 
-    # Group behavior control - respond if mentioned, is a reply to bot, or in private chat
-    if is_group_chat(chat_type) and not is_bot_mentioned(text) and not is_reply:
-        logger.info(f"Ignoring group message without mention or reply: {text}")
-        return
+    def register(self, key, language, text):
+        """Add a rendered reply for a key and language."""
+        self._parts[(key, language)] = tuple(text.split(self.USER_NAME))
 
-    logger.info(f"Received message from {chat_id}: {text}" + (f" in thread {message_thread_id}" if message_thread_id else ""))
+    def render(self, key, language, user_name=""):
+        """Return the reply for a key, with the user's name filled in."""
+        parts = self._parts[(key, "english" if language == "english" else "uzbek")]
+        if len(parts) == 1:
+            return parts[0]
+        return str(user_name).join(parts)
 
-    # Clean command text (remove @botusername)
-    clean_text = clean_command_text(text)
+    def __contains__(self, key):
+        return (key, "uzbek") in self._parts
 
-    # Detect user's language
-    user_language = detect_language(clean_text)
-    logger.info(f"Detected language: {user_language}")
+    def __len__(self):
+        return len(self._parts)
 
-    # Handle lead generation states
-    if chat_id in user_states and user_states[chat_id]['state'] != UserState.NORMAL:
-        handle_lead_collection(chat_id, clean_text, telegram_user, message_thread_id, user_language)
-        return
+def build_reply_templates():
+    """Render /start, /help, /info, /hours, /location, /ai, greetings and thanks with their CTA."""
+    templates = ReplyTemplates()
+    name = ReplyTemplates.USER_NAME
 
-    # Handle /start command - Default to Uzbek
-    if clean_text == '/start':
-        # Always start with Uzbek unless explicitly requested English
-        if user_language == "english" and ("english" in clean_text.lower() or "ingliz" in clean_text.lower()):
-            ai_status = "🤖 AI Chat: ✅ Available" if groq_client else "🤖 AI Chat: ❌ Unavailable"
-            welcome_text = f"""👋 Hello {user_name}!
+    for ai in (True, False):
+        ai_status = "🤖 AI Chat: ✅ Available" if ai else "🤖 AI Chat: ❌ Unavailable"
+        templates.register(("start", ai), "english", add_cta_to_message(f"""👋 Hello {name}!
 
 Welcome to PremiumSoft.uz AI-powered Info Bot!
 
@@ -900,11 +3076,10 @@ Or use these commands:
 • /info - Company overview
 • /help - Available commands
 • /ai - AI chat status
-• /order - Place an order"""
-        else:
-            # Default to Uzbek for all users
-            ai_status = "🤖 AI Suhbat: ✅ Mavjud" if groq_client else "🤖 AI Suhbat: ❌ Mavjud emas"
-            welcome_text = f"""👋 Salom {user_name}!
+• /order - Place an order"""))
+
+        ai_status = "🤖 AI Suhbat: ✅ Mavjud" if ai else "🤖 AI Suhbat: ❌ Mavjud emas"
+        templates.register(("start", ai), "uzbek", add_cta_to_message(f"""👋 Salom {name}!
 
 PremiumSoft.uz AI-powered ma'lumot botiga xush kelibsiz!
 
@@ -923,28 +3098,10 @@ Yoki quyidagi buyruqlardan foydalaning:
 • /ai - AI suhbat holati
 • /order - Buyurtma berish
 
-💡 *Ingliz tilida javob olish uchun "inglizcha" yoki "english" deb yozing*"""
-
-        response_with_cta = add_cta_to_message(welcome_text)
-        send_telegram_message(chat_id, response_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
+💡 *Ingliz tilida javob olish uchun "inglizcha" yoki "english" deb yozing*"""))
 
-    # Handle /info command - Default to Uzbek
-    elif clean_text == '/info':
-        # Only use English if explicitly requested
-        if user_language == "english" and ("english" in text.lower() or "ingliz" in text.lower()):
-            info_text = get_premiumsoft_info_english()
-        else:
-            # Default to Uzbek
-            info_text = get_premiumsoft_info()
-        info_with_cta = add_cta_to_message(info_text)
-        send_telegram_message(chat_id, info_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
-
-    # Handle /help command - Default to Uzbek
-    elif clean_text == '/help':
-        # Only use English if explicitly requested
-        if user_language == "english" and ("english" in text.lower() or "ingliz" in text.lower()):
-            ai_status = "✅ Available - Just ask me anything!" if groq_client else "❌ Currently unavailable"
-            help_text = f"""
+        ai_status = "✅ Available - Just ask me anything!" if ai else "❌ Currently unavailable"
+        templates.register(("help", ai), "english", add_cta_to_message(f"""
 🤖 *PremiumSoft.uz AI Info Bot*
 
 *Available commands:*
@@ -971,10 +3128,10 @@ Just type any question about PremiumSoft.uz and I'll answer using AI!
 • "Who are your team members?"
 • "What technologies do you use?"
 • "How can you help my startup?"
-            """
-        else:
-            ai_status = "✅ Mavjud - Biror narsa so'rang!" if groq_client else "❌ Hozircha mavjud emas"
-            help_text = f"""
+            """.strip()))
+
+        ai_status = "✅ Mavjud - Biror narsa so'rang!" if ai else "❌ Hozircha mavjud emas"
+        templates.register(("help", ai), "uzbek", add_cta_to_message(f"""
 🤖 *PremiumSoft.uz AI Ma'lumot Bot*
 
 *Mavjud buyruqlar:*
@@ -1001,62 +3158,39 @@ PremiumSoft.uz haqida biror savol yozing va men AI yordamida javob beraman!
 • "Jamoa a'zolaringiz kimlar?"
 • "Qanday texnologiyalardan foydalanasiz?"
 • "Mening startupimga qanday yordam bera olasiz?"
-            """
-        help_with_cta = add_cta_to_message(help_text.strip())
-        send_telegram_message(chat_id, help_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
+            """.strip()))
 
-    # Handle /order command
-    elif clean_text == '/order' or 'buyurtma' in clean_text.lower() or 'order' in clean_text.lower():
-        start_lead_collection(chat_id, message_thread_id, user_language)
+    templates.register("info", "english", add_cta_to_message(get_premiumsoft_info_english()))
+    templates.register("info", "uzbek", add_cta_to_message(get_premiumsoft_info()))
 
-    # Handle /hours command
-    elif clean_text == '/hours' or clean_text == '/vaqt':
-        business_hours_msg = get_business_hours_message(user_language)
-
-        if is_business_hours():
-            if user_language == "english":
-                hours_text = f"🟢 *We're currently ONLINE!*{business_hours_msg}\n\n📞 Contact us now for immediate assistance!"
-            else:
-                hours_text = f"🟢 *Hozir ONLAYNMIZ!*{business_hours_msg}\n\n📞 Darhol yordam olish uchun biz bilan bog'laning!"
+    # Online and offline variants; the current one is picked per request
+    for language in ("english", "uzbek"):
+        business_hours_msg = get_business_hours_message(language)
+        if language == "english":
+            online = f"🟢 *We're currently ONLINE!*{business_hours_msg}\n\n📞 Contact us now for immediate assistance!"
+            offline = f"🔴 *We're currently OFFLINE*{business_hours_msg}\n\n📧 Send us a message and we'll respond during business hours!"
         else:
-            if user_language == "english":
-                hours_text = f"🔴 *We're currently OFFLINE*{business_hours_msg}\n\n📧 Send us a message and we'll respond during business hours!"
-            else:
-                hours_text = f"🔴 *Hozir OFFLAYNMIZ*{business_hours_msg}\n\n📧 Xabar yuboring, ish vaqtida javob beramiz!"
-
-        hours_with_cta = add_cta_to_message(hours_text)
-        send_telegram_message(chat_id, hours_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
-
-    # Handle /location command
-    elif clean_text == '/location' or clean_text == '/manzil':
-        send_telegram_location(chat_id, 40.391014, 71.773127, message_thread_id)
+            online = f"🟢 *Hozir ONLAYNMIZ!*{business_hours_msg}\n\n📞 Darhol yordam olish uchun biz bilan bog'laning!"
+            offline = f"🔴 *Hozir OFFLAYNMIZ*{business_hours_msg}\n\n📧 Xabar yuboring, ish vaqtida javob beramiz!"
+        templates.register(("hours", True), language, add_cta_to_message(online))
+        templates.register(("hours", False), language, add_cta_to_message(offline))
 
-        if user_language == "english":
-            location_text = """📍 *PremiumSoft.uz Location*
+    templates.register("location", "english", add_cta_to_message("""📍 *PremiumSoft.uz Location*
 
 🏢 Address: Fergana, Ahmad Al-Fergani Shah Street, 53, 4th floor
 📞 Phone: +998 73 244 05 35
 🏛️ Authority: Fergana Regional Administration
 📧 Email: info@premiumsoft.uz
-🌐 Website: https://premiumsoft.uz"""
-        else:
-            location_text = """📍 *PremiumSoft.uz Manzili*
+🌐 Website: https://premiumsoft.uz"""))
+    templates.register("location", "uzbek", add_cta_to_message("""📍 *PremiumSoft.uz Manzili*
 
 🏢 Manzil: Fargʻona, Ahmad Al-Fargʻoniy shoh koʻchasi, 53, 4-qavat
 📞 Telefon: +998 73 244 05 35
 🏛️ Vakolat: Farg'ona viloyati hokimligi
 📧 Email: info@premiumsoft.uz
-🌐 Veb-sayt: https://premiumsoft.uz"""
+🌐 Veb-sayt: https://premiumsoft.uz"""))
 
-        location_with_cta = add_cta_to_message(location_text)
-        send_telegram_message(chat_id, location_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
-
-    # Handle /ai command - Default to Uzbek
-    elif clean_text == '/ai':
-        # Only use English if explicitly requested
-        if user_language == "english" and ("english" in text.lower() or "ingliz" in text.lower()):
-            if groq_client:
-                ai_text = """🤖 *AI Chat Status: ✅ ACTIVE*
+    templates.register(("ai", True), "english", add_cta_to_message("""🤖 *AI Chat Status: ✅ ACTIVE*
 
 I'm powered by Groq's Llama3 AI model and have comprehensive knowledge about:
 
@@ -1074,9 +3208,8 @@ Just ask me anything! No special commands needed.
 • "Tell me about Muhammadaziz"
 • "How can you help my e-commerce project?"
 • "What's your development process?"
-"""
-            else:
-                ai_text = """🤖 *AI Chat Status: ❌ UNAVAILABLE*
+"""))
+    templates.register(("ai", False), "english", add_cta_to_message("""🤖 *AI Chat Status: ❌ UNAVAILABLE*
 
 AI features are currently disabled. This could be because:
 • Groq API key is not configured
@@ -1087,10 +3220,8 @@ AI features are currently disabled. This could be because:
 • Contact us directly at info@premiumsoft.uz
 • Visit our website: https://premiumsoft.uz
 
-The bot will still work for basic information!"""
-        else:
-            if groq_client:
-                ai_text = """🤖 *AI Suhbat Holati: ✅ FAOL*
+The bot will still work for basic information!"""))
+    templates.register(("ai", True), "uzbek", add_cta_to_message("""🤖 *AI Suhbat Holati: ✅ FAOL*
 
 Men Groq'ning Llama3 AI modeli bilan ishlayman va quyidagilar haqida to'liq ma'lumotga egaman:
 
@@ -1108,9 +3239,8 @@ Shunchaki biror narsa so'rang! Maxsus buyruqlar kerak emas.
 • "Muhammadaziz haqida gapirib bering"
 • "Mening elektron tijorat loyihamga qanday yordam bera olasiz?"
 • "Ishlab chiqish jarayoningiz qanday?"
-"""
-            else:
-                ai_text = """🤖 *AI Suhbat Holati: ❌ MAVJUD EMAS*
+"""))
+    templates.register(("ai", False), "uzbek", add_cta_to_message("""🤖 *AI Suhbat Holati: ❌ MAVJUD EMAS*
 
 AI xususiyatlari hozircha o'chirilgan. Buning sababi:
 • Groq API kaliti sozlanmagan
@@ -1121,73 +3251,151 @@ AI xususiyatlari hozircha o'chirilgan. Buning sababi:
 • To'g'ridan-to'g'ri info@premiumsoft.uz ga murojaat qiling
 • Veb-saytimizga tashrif buyuring: https://premiumsoft.uz
 
-Bot asosiy ma'lumotlar uchun ishlashda davom etadi!"""
+Bot asosiy ma'lumotlar uchun ishlashda davom etadi!"""))
+
+    templates.register("greeting", "english", add_cta_to_message(
+        f"Hello {name}! 👋 Welcome to PremiumSoft.uz! How can I help you today?"))
+    templates.register("greeting", "uzbek", add_cta_to_message(
+        f"Salom {name}! 👋 PremiumSoft.uz ga xush kelibsiz! Bugun sizga qanday yordam bera olaman?"))
+    templates.register("thanks", "english", add_cta_to_message(
+        f"You're welcome, {name}! 😊 Is there anything else I can help you with?"))
+    templates.register("thanks", "uzbek", add_cta_to_message(
+        f"Arzimaydi, {name}! 😊 Yana biror narsada yordam bera olamanmi?"))
+    return templates
+
+# Every static reply, rendered once
+reply_templates = build_reply_templates()
+
+def send_location_reply(chat_id, user_language, message_thread_id=None):
+    """Send the office location pin together with the address card."""
+    location_with_cta = reply_templates.render("location", user_language)
+    # The pin and the address card are independent, so send them together
+    with concurrent_calls():
+        # Ahmad Al-Fergani Street, Fergana coordinates: 40.391014, 71.773127
+        send_telegram_location(chat_id, 40.391014, 71.773127, message_thread_id)
+        send_telegram_message(chat_id, location_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
 
-        ai_with_cta = add_cta_to_message(ai_text)
-        send_telegram_message(chat_id, ai_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
+# Commands counted under their own label; anything else is "other"
+METRIC_COMMANDS = frozenset([
+    "/start", "/help", "/info", "/ai", "/order", "/hours", "/vaqt", "/location", "/manzil",
+])
 
-    # Handle all other messages with AI
+def count_message_metrics(clean_text, intents):
+    """Count a routed message per command and per intent."""
+    if clean_text.startswith('/'):
+        command = clean_text.split(maxsplit=1)[0]
+        metrics.count("telegram_commands_total", command if command in METRIC_COMMANDS else "other")
     else:
-        # Check for location requests
-        location_keywords = ['location', 'manzil', 'address', 'joylashuv', 'where', 'qayerda', 'qayer']
-        if any(keyword in clean_text.lower() for keyword in location_keywords):
-            # Send PremiumSoft location (Ahmad Al-Fergani coordinates)
-            # Ahmad Al-Fergani Street, Fergana coordinates: 40.391014, 71.773127
-            send_telegram_location(chat_id, 40.391014, 71.773127, message_thread_id)
+        metrics.count("telegram_commands_total", "text")
+    for intent in intents or ("none",):
+        metrics.count("telegram_intents_total", intent)
 
-            if user_language == "english":
-                location_text = """📍 *PremiumSoft.uz Location*
+def handle_message(message):
+    """Handle a message from Telegram and send the planned response."""
+    plan = plan_message(message)
+    dispatch_plan(plan)
+    deliver_queued_leads(plan)
 
-🏢 Address: Fergana, Ahmad Al-Fergani Shah Street, 53, 4th floor
-📞 Phone: +998 73 244 05 35
-🏛️ Authority: Fergana Regional Administration
-📧 Email: info@premiumsoft.uz
-🌐 Website: https://premiumsoft.uz"""
-            else:
-                location_text = """📍 *PremiumSoft.uz Manzili*
+def route_message(message):
+    """Route a message to its handler; user-facing sends are added to the active plan."""
+    chat_id = message.get('chat', {}).get('id')
+    chat_type = message.get('chat', {}).get('type', 'private')
+    text = message.get('text', '')
+    user_name = message.get('from', {}).get('first_name', 'Foydalanuvchi')
+    telegram_user = message.get('from', {})
 
-🏢 Manzil: Fargʻona, Ahmad Al-Fargʻoniy shoh koʻchasi, 53, 4-qavat
-📞 Telefon: +998 73 244 05 35
-🏛️ Vakolat: Farg'ona viloyati hokimligi
-📧 Email: info@premiumsoft.uz
-🌐 Veb-sayt: https://premiumsoft.uz"""
+    # Extract topic/thread information
+    message_thread_id = message.get('message_thread_id')
+
+    if not chat_id:
+        logger.error("Message missing chat_id")
+        return
+
+    # Check if this is a reply to the bot
+    is_reply = is_reply_to_bot(message)
+
+    # Group behavior control - respond if mentioned, is a reply to bot, or in private chat
+    if is_group_chat(chat_type) and not is_bot_mentioned(text) and not is_reply:
+        logger.info(f"Ignoring group message without mention or reply: {text}")
+        return
+
+    logger.info(f"Received message from {chat_id}: {text}" + (f" in thread {message_thread_id}" if message_thread_id else ""))
+
+    # Clean command text (remove @botusername)
+    clean_text = clean_command_text(text)
+
+    # Detect user's language
+    with metrics.span("detect_language"):
+        user_language = resolve_language(chat_id, clean_text)
+    logger.info(f"Detected language: {user_language}")
+
+    # Find every intent in the message once; the branches below only look them up
+    intents = classify_intents(clean_text)
+    count_message_metrics(clean_text, intents)
+
+    # Handle lead generation states
+    session = session_store.get(chat_id)
+    if session is not None and session.get('state', UserState.NORMAL) != UserState.NORMAL:
+        handle_lead_collection(chat_id, clean_text, telegram_user, message_thread_id, user_language, intents)
+        return
+
+    # Static replies come pre-rendered from reply_templates; English only if the chat asked for it
+    # Handle /start command - Default to Uzbek
+    if clean_text == '/start':
+        welcome_text = reply_templates.render(("start", ai_enabled()), user_language, user_name)
+        send_telegram_message(chat_id, welcome_text, parse_mode="Markdown", message_thread_id=message_thread_id)
+
+    # Handle /info command - Default to Uzbek
+    elif clean_text == '/info':
+        info_text = reply_templates.render("info", user_language)
+        send_telegram_message(chat_id, info_text, parse_mode="Markdown", message_thread_id=message_thread_id)
 
-            location_with_cta = add_cta_to_message(location_text)
-            send_telegram_message(chat_id, location_with_cta, parse_mode="Markdown", message_thread_id=message_thread_id)
+    # Handle /help command - Default to Uzbek
+    elif clean_text == '/help':
+        help_text = reply_templates.render(("help", ai_enabled()), user_language)
+        send_telegram_message(chat_id, help_text, parse_mode="Markdown", message_thread_id=message_thread_id)
+
+    # Handle /order command
+    elif clean_text == '/order' or Intent.ORDER in intents:
+        start_lead_collection(chat_id, message_thread_id, user_language)
+
+    # Handle /hours command
+    elif clean_text == '/hours' or clean_text == '/vaqt':
+        hours_text = reply_templates.render(("hours", is_business_hours()), user_language)
+        send_telegram_message(chat_id, hours_text, parse_mode="Markdown", message_thread_id=message_thread_id)
+
+    # Handle /location command
+    elif clean_text == '/location' or clean_text == '/manzil':
+        send_location_reply(chat_id, user_language, message_thread_id)
+
+    # Handle /ai command - Default to Uzbek
+    elif clean_text == '/ai':
+        ai_text = reply_templates.render(("ai", ai_enabled()), user_language)
+        send_telegram_message(chat_id, ai_text, parse_mode="Markdown", message_thread_id=message_thread_id)
+
+    # Handle all other messages with AI
+    else:
+        # Check for location requests
+        if Intent.LOCATION in intents:
+            send_location_reply(chat_id, user_language, message_thread_id)
             return
 
         # Check for greeting messages - Default to Uzbek
-        greeting_keywords = ['salom', 'hello', 'hi', 'assalomu alaykum', 'good morning', 'good day', 'xayrli']
-        if any(keyword in clean_text.lower() for keyword in greeting_keywords):
-            # Only use English if explicitly requested
-            if user_language == "english" and ("english" in text.lower() or "ingliz" in text.lower()):
-                greeting_response = f"Hello {user_name}! 👋 Welcome to PremiumSoft.uz! How can I help you today?"
-            else:
-                # Default to Uzbek
-                greeting_response = f"Salom {user_name}! 👋 PremiumSoft.uz ga xush kelibsiz! Bugun sizga qanday yordam bera olaman?"
-
-            greeting_with_cta = add_cta_to_message(greeting_response)
+        if Intent.GREETING in intents:
+            greeting_with_cta = reply_templates.render("greeting", user_language, user_name)
             send_telegram_message(chat_id, greeting_with_cta, message_thread_id=message_thread_id)
             return
 
         # Check for thanks messages - Default to Uzbek
-        thanks_keywords = ['rahmat', 'thank', 'thanks', 'tashakkur', 'grateful']
-        if any(keyword in clean_text.lower() for keyword in thanks_keywords):
-            # Only use English if explicitly requested
-            if user_language == "english" and ("english" in text.lower() or "ingliz" in text.lower()):
-                thanks_response = f"You're welcome, {user_name}! 😊 Is there anything else I can help you with?"
-            else:
-                # Default to Uzbek
-                thanks_response = f"Arzimaydi, {user_name}! 😊 Yana biror narsada yordam bera olamanmi?"
-
-            thanks_with_cta = add_cta_to_message(thanks_response)
+        if Intent.THANKS in intents:
+            thanks_with_cta = reply_templates.render("thanks", user_language, user_name)
             send_telegram_message(chat_id, thanks_with_cta, message_thread_id=message_thread_id)
             return
 
         # Check if it's a command we don't recognize - Default to Uzbek
         if clean_text.startswith('/'):
-            # Only use English if explicitly requested
-            if user_language == "english" and ("english" in text.lower() or "ingliz" in text.lower()):
+            # Use English only if the chat asked for it or clearly writes in English
+            if user_language == "english":
                 response_text = f"❓ Unknown command: {clean_text}\n\nUse /help to see available commands or just ask me anything about PremiumSoft.uz!"
             else:
                 # Default to Uzbek
@@ -1196,51 +3404,713 @@ Bot asosiy ma'lumotlar uchun ishlashda davom etadi!"""
             send_telegram_message(chat_id, response_with_cta, message_thread_id=message_thread_id)
         else:
             # Check for service interest keywords
-            service_keywords = [
-                'xizmat', 'service', 'loyiha', 'project', 'dastur', 'app', 'sayt', 'website',
-                'mobil', 'mobile', 'bot', 'dizayn', 'design', 'ishlab chiqish', 'development',
-                'kerak', 'need', 'qilish', 'make', 'yaratish', 'create', 'buyurtma', 'order',
-                'price', 'narx', 'cost', 'qancha', 'how much', 'budget'
-            ]
-
-            if any(keyword in clean_text.lower() for keyword in service_keywords):
-                # Show typing indicator
-                send_typing_action(chat_id, message_thread_id)
-
+            if Intent.SERVICE in intents:
                 # Trigger lead collection for service inquiries
-                ai_response = get_ai_response(clean_text, user_name, user_language)
-                ai_with_cta = add_cta_to_message(ai_response)
+                def finalize(ai_response):
+                    ai_with_cta = add_cta_to_message(ai_response)
 
-                # Add business hours info if outside business hours
-                if not is_business_hours():
-                    business_hours_msg = get_business_hours_message(user_language)
-                    ai_with_cta += business_hours_msg
+                    # Add business hours info if outside business hours
+                    if not is_business_hours():
+                        business_hours_msg = get_business_hours_message(user_language)
+                        ai_with_cta += business_hours_msg
 
-                # Consolidate order prompt into the main response
-                order_prompt = get_order_prompt(user_language)
-                consolidated_response = ai_with_cta + order_prompt
+                    # Consolidate order prompt into the main response
+                    order_prompt = get_order_prompt(user_language)
+                    return ai_with_cta + order_prompt
 
-                send_telegram_message(chat_id, consolidated_response, message_thread_id=message_thread_id)
+                send_ai_reply(chat_id, clean_text, user_name, user_language, finalize, message_thread_id)
             else:
-                # Show typing indicator for AI processing
-                send_typing_action(chat_id, message_thread_id)
-
                 # Use AI to respond to the message
                 logger.info(f"Processing AI request from {user_name}: {clean_text}")
-                ai_response = get_ai_response(clean_text, user_name, user_language)
-                ai_with_cta = add_cta_to_message(ai_response)
 
-                # Track user stats
-                user_stats = get_user_stats(chat_id)
+                def finalize(ai_response):
+                    ai_with_cta = add_cta_to_message(ai_response)
 
-                # Add personalized touch for frequent users
-                if user_stats.get('message_count', 0) > 5:
-                    if user_language == "english":
-                        ai_with_cta += f"\n\n💫 *Thanks for being an active user, {user_name}!*"
-                    else:
-                        ai_with_cta += f"\n\n💫 *Faol foydalanuvchi bo'lganingiz uchun rahmat, {user_name}!*"
+                    # Track user stats
+                    user_stats = get_user_stats(chat_id)
+
+                    # Add personalized touch for frequent users
+                    if user_stats.get('message_count', 0) > 5:
+                        if user_language == "english":
+                            ai_with_cta += f"\n\n💫 *Thanks for being an active user, {user_name}!*"
+                        else:
+                            ai_with_cta += f"\n\n💫 *Faol foydalanuvchi bo'lganingiz uchun rahmat, {user_name}!*"
+                    return ai_with_cta
+
+                send_ai_reply(chat_id, clean_text, user_name, user_language, finalize, message_thread_id)
+
+class RedisError(Exception):
+    """Error reply returned by a Redis-protocol server."""
+
+class RedisClient:
+    """Minimal Redis-protocol (RESP) client over a plain socket.
+
+    Only what the bot needs is implemented, so no extra dependency is required.
+    Accepts URLs like redis://[:password@]host:port/db.
+    """
+
+    def __init__(self, url, timeout=2.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._command("AUTH", self.password)
+        if self.db:
+            self._command("SELECT", self.db)
+
+    @staticmethod
+    def _encode(args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(f"${len(arg)}\r\n".encode())
+            parts.append(arg)
+            parts.append(b"\r\n")
+        return b"".join(parts)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by Redis server")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode("utf-8")
+        if prefix == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2]
+        if prefix == b"*":
+            count = int(rest)
+            if count < 0:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def _command(self, *args):
+        self._sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    def execute(self, *args):
+        """Run one command, reconnecting once if it could not be sent.
+
+        Errors after the command went out are raised instead of retried: Redis
+        may have run it, and a repeated SET NX would then report a conflict
+        with its own write.
+        """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.sendall(self._encode(args))
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+                    continue
+                try:
+                    return self._read_reply()
+                except OSError:
+                    self.close()
+                    raise
+
+    def close(self):
+        """Close the connection; the next command reconnects."""
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+class RedisDedupStore:
+    """Shared update_id registry so concurrently warm instances see each other's updates."""
+
+    def __init__(self, client, prefix="tg:update:"):
+        self.client = client
+        self.prefix = prefix
+
+    def add_if_absent(self, update_id, ttl):
+        """Record an update_id; returns False if it was already recorded."""
+        return self.client.execute("SET", f"{self.prefix}{update_id}", "1", "NX", "EX", max(1, int(ttl))) == "OK"
+
+    def discard(self, update_id):
+        """Remove an update_id so a redelivery is processed."""
+        self.client.execute("DEL", f"{self.prefix}{update_id}")
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite file in WAL mode, shared by processes on one host.
+
+    Expired rows are skipped on read and deleted every `purge_every` writes.
+    """
+
+    BATCH_SIZE = 500  # stays below SQLite's bound-parameter limit
+
+    def __init__(self, path, ttl=SESSION_TTL_SECONDS, purge_every=1000):
+        self.ttl = ttl
+        self.purge_every = max(1, purge_every)
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(chat_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def get_many(self, chat_ids):
+        keys = {str(chat_id): chat_id for chat_id in chat_ids}
+        found = {}
+        names = list(keys)
+        with self._lock:
+            for start in range(0, len(names), self.BATCH_SIZE):
+                batch = names[start:start + self.BATCH_SIZE]
+                rows = self._conn.execute(
+                    f"SELECT chat_id, data FROM sessions WHERE expires > ? "
+                    f"AND chat_id IN ({','.join('?' * len(batch))})",
+                    [time.time(), *batch],
+                )
+                for key, data in rows:
+                    found[keys[key]] = json.loads(data)
+        return found
+
+    def set(self, chat_id, data):
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (chat_id, data, expires) VALUES (?, ?, ?)",
+                (str(chat_id), self.dumps(data), now + self.ttl),
+            )
+            self._writes += 1
+            if self._writes >= self.purge_every:
+                self._writes = 0
+                self._purge(now)
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE chat_id = ?", (str(chat_id),))
+
+    def _purge(self, now):
+        return self._conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,)).rowcount
+
+    def purge_expired(self):
+        """Drop expired sessions; returns how many were removed."""
+        with self._lock:
+            return self._purge(time.time())
+
+    def close(self):
+        self._conn.close()
+
+class RedisSessionStore(SessionStore):
+    """Sessions shared by every instance through a Redis-protocol server."""
+
+    def __init__(self, client, ttl=SESSION_TTL_SECONDS, prefix="tg:session:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, chat_ids):
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return {}
+        values = self.client.execute("MGET", *(f"{self.prefix}{chat_id}" for chat_id in chat_ids))
+        return {chat_id: json.loads(value) for chat_id, value in zip(chat_ids, values) if value is not None}
+
+    def set(self, chat_id, data):
+        self.client.execute("SET", f"{self.prefix}{chat_id}", self.dumps(data), "EX", max(1, int(self.ttl)))
+
+    def delete(self, chat_id):
+        self.client.execute("DEL", f"{self.prefix}{chat_id}")
+
+class CachedSessionStore(SessionStore):
+    """Write-through local cache in front of a shared session backend.
+
+    Reads are served locally for a few seconds, so the several lookups made
+    while handling one message cost a single round trip, and get_many fetches
+    everything missing in one batch. Writes always go to the backend. If the
+    backend is unreachable the local copy keeps the conversation going.
+    """
+
+    def __init__(self, backend, max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _remember(self, chat_id, data, now):
+        self._entries[chat_id] = (now + self.ttl, data)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_many(self, chat_ids):
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for chat_id in dict.fromkeys(chat_ids):
+                entry = self._entries.get(chat_id)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    if entry[1] is not None:
+                        found[chat_id] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append(chat_id)
+        if not missing:
+            return found
+
+        try:
+            fetched = self.backend.get_many(missing)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Session store unavailable: {e}")
+            with self._lock:
+                for chat_id in missing:
+                    entry = self._entries.get(chat_id)
+                    if entry is not None and entry[1] is not None:
+                        found[chat_id] = entry[1]
+            return found
+
+        with self._lock:
+            for chat_id in missing:
+                data = fetched.get(chat_id)
+                self._remember(chat_id, data, now)
+                if data is not None:
+                    found[chat_id] = data
+        return found
+
+    def set(self, chat_id, data):
+        with self._lock:
+            self._remember(chat_id, data, time.monotonic())
+        try:
+            self.backend.set(chat_id, data)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error saving session for chat {chat_id}: {e}")
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._remember(chat_id, None, time.monotonic())
+        try:
+            self.backend.delete(chat_id)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error deleting session for chat {chat_id}: {e}")
+
+    def clear(self):
+        """Drop the local copies; the backend is untouched."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.errors = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+def create_session_store(kind=SESSION_STORE):
+    """Build the session store selected by SESSION_STORE."""
+    try:
+        if kind == "sqlite":
+            return CachedSessionStore(SQLiteSessionStore(SESSION_SQLITE_PATH))
+        if kind == "redis" and SESSION_REDIS_URL:
+            return CachedSessionStore(RedisSessionStore(RedisClient(SESSION_REDIS_URL)))
+        if kind != "memory":
+            logger.warning(f"Unknown or unconfigured session store {kind!r}, keeping sessions in memory")
+    except Exception as e:
+        logger.error(f"Error opening {kind} session store, keeping sessions in memory: {e}")
+    return user_states
+
+# Lead collection state, shared across instances unless SESSION_STORE is memory
+session_store = create_session_store()
 
-                send_telegram_message(chat_id, ai_with_cta, message_thread_id=message_thread_id)
+def prefetch_sessions(updates):
+    """Load the sessions of a batch of updates with one backend read."""
+    chat_ids = {update_chat_id(update) for update in updates} - {None}
+    if chat_ids:
+        session_store.get_many(chat_ids)
+
+class UpdateDeduplicator:
+    """Bounded, TTL-evicting cache of recently seen update_ids.
+
+    Telegram redelivers an update when the webhook times out or answers 5xx,
+    so every update_id is checked here before any work starts. An optional
+    shared store extends the check across instances; if the store is
+    unreachable the local cache still applies.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL_SECONDS, max_size=DEDUP_MAX_SIZE, store=None):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.store = store
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def _evict(self, now):
+        while self._seen:
+            update_id, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+    def is_new(self, update_id):
+        """Mark an update_id as seen; returns False if it was seen before.
+
+        When the shared store cannot give a definite answer the update counts
+        as new: handling it twice is better than dropping it.
+        """
+        if update_id is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[update_id] = now + self.ttl
+            self._evict(now)
+
+        if self.store is not None:
+            try:
+                if not self.store.add_if_absent(update_id, self.ttl):
+                    with self._lock:
+                        self.duplicates += 1
+                    return False
+            except Exception as e:
+                logger.warning(f"Shared dedup store unavailable: {e}")
+        return True
+
+    def forget(self, update_id):
+        """Unmark an update that was not taken, so Telegram's redelivery is processed."""
+        if update_id is None:
+            return
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.store is not None:
+            try:
+                self.store.discard(update_id)
+            except Exception as e:
+                logger.warning(f"Shared dedup store unavailable: {e}")
+
+    def __len__(self):
+        return len(self._seen)
+
+# Recently seen update_ids, optionally shared through Redis
+update_dedup = UpdateDeduplicator(
+    store=RedisDedupStore(RedisClient(DEDUP_REDIS_URL)) if DEDUP_REDIS_URL else None
+)
+
+def is_duplicate_update(update):
+    """Check whether an update was already received."""
+    update_id = update.get('update_id')
+    if update_dedup.is_new(update_id):
+        return False
+    logger.info(f"Ignoring duplicate update {update_id}")
+    return True
+
+def process_update(update):
+    """Process a single Telegram update within the invocation budget."""
+    with invocation_budget():
+        if 'message' in update:
+            handle_message(update['message'])
+        else:
+            logger.info("Received non-message update (ignored)")
+
+def update_chat_id(update):
+    """Get the chat id an update belongs to, if any."""
+    return update.get('message', {}).get('chat', {}).get('id')
+
+class ChatScheduler:
+    """Thread pool that runs work for different chats in parallel, one chat at a time.
+
+    Work submitted for a chat_id runs strictly in submission order, so two
+    quick messages from the same user never race on their session state,
+    while other chats keep making progress on the remaining workers. Both the
+    per-chat backlog and the total number of pending items are bounded.
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_SIZE,
+                 max_backlog_per_chat=CHAT_BACKLOG_LIMIT, name="chat-worker"):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.max_backlog_per_chat = max(1, max_backlog_per_chat)
+        self.name = name
+        self._queues = {}
+        self._ready = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending = 0
+        self._counts = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._max_chat_depth = 0
+
+    def _ensure_workers(self):
+        """Start worker threads on first use."""
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"{self.name}-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _has_room(self, chat_id):
+        chat_queue = self._queues.get(chat_id)
+        if chat_queue is not None and len(chat_queue) >= self.max_backlog_per_chat:
+            return False
+        return self._pending < self.max_pending
+
+    def submit(self, chat_id, func, *args, block=False, timeout=None):
+        """Queue func(*args) for a chat; returns False if the backlog is full.
+
+        With block=True the caller waits (up to timeout seconds) for room.
+        """
+        self._ensure_workers()
+        with self._changed:
+            if not self._has_room(chat_id):
+                if not block or not self._changed.wait_for(lambda: self._has_room(chat_id), timeout):
+                    self._counts["rejected"] += 1
+                    return False
+
+            chat_queue = self._queues.get(chat_id)
+            schedule = chat_queue is None
+            if schedule:
+                chat_queue = self._queues[chat_id] = deque()
+            chat_queue.append((time.monotonic(), func, args))
+            self._pending += 1
+            self._counts["submitted"] += 1
+            if len(chat_queue) > self._max_chat_depth:
+                self._max_chat_depth = len(chat_queue)
+
+        # A chat is handed to the workers only when it has no work in flight
+        if schedule:
+            self._ready.put(chat_id)
+        return True
+
+    def _worker(self):
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                enqueued_at, func, args = self._queues[chat_id][0]
+                waited = time.monotonic() - enqueued_at
+                self._wait_total += waited
+                if waited > self._wait_max:
+                    self._wait_max = waited
+
+            failed = False
+            try:
+                func(*args)
+            except Exception as e:
+                failed = True
+                logger.error(f"Error processing work for chat {chat_id}: {e}")
+
+            with self._changed:
+                chat_queue = self._queues[chat_id]
+                chat_queue.popleft()
+                self._pending -= 1
+                self._counts["failed" if failed else "completed"] += 1
+                reschedule = bool(chat_queue)
+                if not reschedule:
+                    del self._queues[chat_id]
+                self._changed.notify_all()
+
+            # Requeue behind other ready chats so one busy chat cannot starve the rest
+            if reschedule:
+                self._ready.put(chat_id)
+
+    def join(self, timeout=None):
+        """Block until all submitted work has finished."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self):
+        """Get queue depth, wait time and throughput counters."""
+        with self._lock:
+            started = self._counts["completed"] + self._counts["failed"]
+            snapshot = dict(self._counts)
+            snapshot.update({
+                "pending": self._pending,
+                "active_chats": len(self._queues),
+                "max_chat_depth": self._max_chat_depth,
+                "wait_avg_seconds": self._wait_total / started if started else 0.0,
+                "wait_max_seconds": self._wait_max,
+                "workers": len(self._threads),
+            })
+            return snapshot
+
+class UpdateWorkerPool:
+    """Bounded background processing for ack-first webhook mode.
+
+    Updates are queued on a ChatScheduler (so each chat keeps its order) and
+    the webhook is acknowledged right away. When the queue is full the
+    configured policy decides what happens:
+    - wait: hold the request until there is room (up to WEBHOOK_QUEUE_WAIT
+      seconds, then reject); the ack is slower but nothing is lost
+    - drop: acknowledge and discard the update
+    - reject: answer 503 so Telegram redelivers the update later
+    """
+
+    POLICY_WAIT = "wait"
+    POLICY_DROP = "drop"
+    POLICY_REJECT = "reject"
+
+    def __init__(self, handler, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+                 full_policy=WEBHOOK_QUEUE_FULL_POLICY, chat_backlog=CHAT_BACKLOG_LIMIT,
+                 wait_timeout=WEBHOOK_QUEUE_WAIT):
+        if full_policy not in (self.POLICY_WAIT, self.POLICY_DROP, self.POLICY_REJECT):
+            logger.warning(f"Unknown queue full policy '{full_policy}', using wait")
+            full_policy = self.POLICY_WAIT
+        self.handler = handler
+        self.full_policy = full_policy
+        self.wait_timeout = wait_timeout
+        self.scheduler = ChatScheduler(workers=workers, max_pending=queue_size,
+                                       max_backlog_per_chat=chat_backlog, name="update-worker")
+        self._lock = threading.Lock()
+        self._counts = {"queued": 0, "dropped": 0, "rejected": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def submit(self, update):
+        """Queue an update and return what happened to it.
+
+        Returns one of "queued", "dropped" or "rejected".
+        """
+        chat_id = update_chat_id(update)
+        block = self.full_policy == self.POLICY_WAIT
+        if self.scheduler.submit(chat_id, self.handler, update, block=block, timeout=self.wait_timeout):
+            self._count("queued")
+            return "queued"
+
+        if self.full_policy == self.POLICY_DROP:
+            logger.warning("Update queue full, dropping update")
+            self._count("dropped")
+            return "dropped"
+
+        logger.warning("Update queue full, rejecting update")
+        self._count("rejected")
+        return "rejected"
+
+    def join(self, timeout=None):
+        """Block until every queued update has been processed."""
+        return self.scheduler.join(timeout)
+
+    def stats(self):
+        """Get per-outcome counters plus scheduler queue metrics."""
+        with self._lock:
+            snapshot = dict(self._counts)
+        snapshot["scheduler"] = self.scheduler.stats()
+        return snapshot
+
+# Background workers for ack-first webhook mode
+update_pool = UpdateWorkerPool(process_update)
+
+def component_metrics():
+    """Metric families built from the counters the bot's components already keep.
+
+    Returns (name, type, help, [(labels, value)]) tuples.
+    """
+    api = bot_api.stats()
+    limiter = outbound_limiter.stats()
+    pool = update_pool.stats()
+    families = [
+        ("telegram_bot_api_calls_total", "counter", "Bot API calls per method.",
+         [({"method": method}, stats["calls"]) for method, stats in api.items()]),
+        ("telegram_bot_api_errors_total", "counter", "Failed Bot API calls per method.",
+         [({"method": method}, stats["errors"]) for method, stats in api.items()]),
+        ("telegram_bot_api_retries_total", "counter", "Bot API retries per method.",
+         [({"method": method}, stats["retries"]) for method, stats in api.items()]),
+        ("telegram_rate_limit_sends_total", "counter", "Rate-limited sends per bucket kind.",
+         [({"kind": kind}, stats["sends"]) for kind, stats in limiter.items()]),
+        ("telegram_rate_limit_throttled_total", "counter", "Sends that had to wait per bucket kind.",
+         [({"kind": kind}, stats["throttled"]) for kind, stats in limiter.items()]),
+        ("telegram_rate_limit_dropped_total", "counter", "Sends refused because their slot was past the invocation deadline.",
+         [({"kind": kind}, stats["dropped"]) for kind, stats in limiter.items()]),
+        ("telegram_rate_limit_wait_seconds_total", "counter", "Time spent waiting for rate limits per bucket kind.",
+         [({"kind": kind}, round(stats["wait_total_seconds"], 6)) for kind, stats in limiter.items()]),
+        ("telegram_updates_duplicate_total", "counter", "Redelivered updates that were dropped.",
+         [({}, update_dedup.duplicates)]),
+        ("telegram_webhook_updates_total", "counter", "Ack-first webhook updates per outcome.",
+         [({"outcome": outcome}, pool[outcome]) for outcome in ("queued", "dropped", "rejected")]),
+        ("telegram_webhook_queue_pending", "gauge", "Updates waiting for an ack-first worker.",
+         [({}, pool["scheduler"]["pending"])]),
+    ]
+
+    caches = [("response", ai_response_cache), ("semantic", semantic_cache),
+              ("language", language_preferences), ("session", session_store)]
+    cache_stats = [(name, cache.stats()) for name, cache in caches if hasattr(cache, "stats")]
+    cache_stats = [(name, stats) for name, stats in cache_stats if "hits" in stats]
+    families += [
+        ("telegram_cache_hits_total", "counter", "Cache hits per cache.",
+         [({"cache": name}, stats["hits"]) for name, stats in cache_stats]),
+        ("telegram_cache_misses_total", "counter", "Cache misses per cache.",
+         [({"cache": name}, stats["misses"]) for name, stats in cache_stats]),
+        ("telegram_cache_entries", "gauge", "Entries held per cache.",
+         [({"cache": name}, stats["size"]) for name, stats in cache_stats]),
+    ]
+
+    sessions = user_states.stats()
+    families += [
+        ("telegram_sessions", "gauge", "Chats in the in-memory session table.",
+         [({"state": "all"}, sessions["size"]), ({"state": "lead"}, sessions["leads"])]),
+        ("telegram_session_evictions_total", "counter", "Sessions evicted from the in-memory table.",
+         [({}, sessions["evictions"])]),
+    ]
+
+    if lead_drainer is not None:
+        try:
+            leads = lead_drainer.stats()
+        except Exception as e:
+            logger.error(f"Error reading lead outbox stats: {e}")
+        else:
+            families.append(("telegram_leads", "gauge", "Leads in the outbox per delivery status.",
+                             [({"status": status}, leads[status]) for status in ("pending", "delivered", "failed")]))
+    return families
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = metrics.render()
+    for name, kind, help_text, samples in component_metrics():
+        if not samples:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [format_sample(name, labels, value) for labels, value in samples]
+    return "\n".join(lines) + "\n"
 
 def setup_webhook(host, custom_url=None):
     """Set up webhook for the bot."""
@@ -1258,13 +4128,11 @@ def setup_webhook(host, custom_url=None):
             return {"error": "Webhook URL must use HTTPS"}
 
         # Set the webhook
-        set_webhook_url = f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook"
         params = {
             'url': webhook_url,
             'drop_pending_updates': True
         }
-        response = requests.post(set_webhook_url, json=params, timeout=10)
-        result = response.json()
+        result = bot_api.call("setWebhook", params)
 
         if result.get('ok'):
             logger.info(f"Webhook successfully set to {webhook_url}")
@@ -1283,9 +4151,7 @@ def test_bot():
         return {"error": "Bot token not configured"}
 
     try:
-        get_me_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getMe"
-        response = requests.get(get_me_url, timeout=10)
-        result = response.json()
+        result = bot_api.call("getMe", http_method="get")
 
         if result.get('ok'):
             bot_info = result.get('result', {})
@@ -1302,10 +4168,103 @@ def test_bot():
         logger.error(f"Error testing bot: {e}")
         return {"error": str(e)}
 
+def get_updates(offset=None, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT):
+    """Fetch a batch of updates with getUpdates long polling."""
+    payload = {
+        "limit": limit,
+        "timeout": timeout,
+        "allowed_updates": ["message"]
+    }
+    if offset is not None:
+        payload["offset"] = offset
+
+    # Give the HTTP request room beyond the long-poll timeout
+    return bot_api.call("getUpdates", payload, timeout=timeout + 10)
+
+class PollingRunner:
+    """getUpdates long-polling loop for running the bot outside Vercel.
+
+    Updates are handed to a ChatScheduler: different chats are processed
+    concurrently while updates from the same chat run in order, and polling
+    continues while earlier batches are still being worked on. When the
+    scheduler is full, polling waits for room instead of fetching more.
+    """
+
+    def __init__(self, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT, workers=POLLING_WORKERS,
+                 handler=process_update):
+        self.limit = limit
+        self.timeout = timeout
+        self.handler = handler
+        self.offset = None
+        self.scheduler = ChatScheduler(workers=workers, max_pending=max(limit, 1) * 4,
+                                       max_backlog_per_chat=CHAT_BACKLOG_LIMIT, name="polling")
+        self._stop = threading.Event()
+        self.dispatched = 0
+
+    def dispatch(self, updates):
+        """Queue a batch; chats run concurrently, each chat in order."""
+        updates = [update for update in updates if not is_duplicate_update(update)]
+        prefetch_sessions(updates)
+        for update in updates:
+            while not self.scheduler.submit(update_chat_id(update), self.handler, update, block=True, timeout=1):
+                logger.warning("Polling scheduler full, waiting for room")
+            self.dispatched += 1
+
+    def poll_once(self):
+        """Fetch and queue one batch; returns the number of updates received."""
+        result = get_updates(self.offset, self.limit, self.timeout)
+        if not result.get("ok"):
+            raise RuntimeError(f"getUpdates failed: {result.get('description', 'unknown error')}")
+
+        updates = result.get("result", [])
+        if updates:
+            self.dispatch(updates)
+            self.offset = max(update['update_id'] for update in updates) + 1
+        return len(updates)
+
+    def run(self, delete_webhook=True):
+        """Poll until stop() is called, then finish the queued work."""
+        if not BOT_TOKEN:
+            raise RuntimeError("Bot token not configured")
+
+        if delete_webhook:
+            # getUpdates is refused while a webhook is set
+            bot_api.call("deleteWebhook", {"drop_pending_updates": False})
+
+        logger.info(f"Long polling started (limit={self.limit}, timeout={self.timeout})")
+        if lead_drainer is not None:
+            # Deliver leads left over from a previous run; the thread keeps running from here on
+            lead_drainer.background = True
+            lead_drainer.wake()
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+                backoff = 1
+            except Exception as e:
+                logger.error(f"Polling error: {e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+        self.scheduler.join()
+        logger.info("Long polling stopped")
+
+    def stop(self):
+        """Ask the polling loop to finish after the current batch."""
+        self._stop.set()
+
 class Handler(BaseHTTPRequestHandler):
     def do_GET(self):
         """Handle GET requests."""
         try:
+            if urlparse(self.path).path.rstrip('/').endswith('/metrics'):
+                body = render_metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
             # Send headers
             self.send_response(200)
             self.send_header('Content-Type', 'text/plain')
@@ -1340,33 +4299,60 @@ class Handler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """Handle POST requests (Telegram webhooks)."""
-        try:
-            # Get content length
-            content_length = int(self.headers.get('Content-Length', 0))
-
-            if content_length > 0:
-                # Read request body
-                post_data = self.rfile.read(content_length)
-                update = json.loads(post_data.decode('utf-8'))
-
-                logger.info("Received Telegram update")
-
-                # Process the update
-                if 'message' in update:
-                    handle_message(update['message'])
-                else:
-                    logger.info("Received non-message update (ignored)")
-
-            # Send OK response
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write('OK'.encode())
-
-        except Exception as e:
-            logger.error(f"POST error: {e}")
-            # Still send 200 to prevent Telegram retries
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write('OK'.encode())
+        # Everything triggered by this webhook shares one deadline
+        with invocation_budget(), metrics.span("webhook"):
+            reply = None
+            if lead_drainer is not None:
+                # Retries only run while an invocation keeps the instance awake
+                lead_drainer.wake()
+            try:
+                # Get content length
+                content_length = int(self.headers.get('Content-Length', 0))
+
+                if content_length > 0:
+                    # Read request body
+                    post_data = self.rfile.read(content_length)
+                    with metrics.span("json_decode"):
+                        update = json.loads(post_data.decode('utf-8'))
+
+                    logger.info("Received Telegram update")
+
+                    # Process the update
+                    if is_duplicate_update(update):
+                        # Redelivery of an update we already took; just acknowledge it
+                        pass
+                    elif WEBHOOK_ACK_FIRST:
+                        if update_pool.submit(update) == "rejected":
+                            # Not taken: let the redelivery through the duplicate check
+                            update_dedup.forget(update.get('update_id'))
+                            self.send_response(503)
+                            self.send_header('Content-Type', 'text/plain')
+                            self.end_headers()
+                            self.wfile.write('Busy'.encode())
+                            return
+                    elif WEBHOOK_REPLY_IN_RESPONSE and 'message' in update:
+                        reply = handle_message_with_reply(update['message'])
+                    else:
+                        process_update(update)
+
+                # Answer with the Bot API call in the response body when available
+                if reply:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.end_headers()
+                    self.wfile.write(json.dumps(reply).encode())
+                    return
+
+                # Send OK response
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.end_headers()
+                self.wfile.write('OK'.encode())
+
+            except Exception as e:
+                logger.error(f"POST error: {e}")
+                # Still send 200 to prevent Telegram retries
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.end_headers()
+                self.wfile.write('OK'.encode())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Measure the cold start of the webhook function: the time to import
+api/telegram.py in a fresh interpreter and the time until the first do_POST
+has written its response.
+
+Each run uses a new process, like a cold serverless instance. Replies go in
+the webhook response body (WEBHOOK_REPLY_IN_RESPONSE), so no network is
+needed. Exits with status 1 when a median exceeds its budget.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    "start": {"chat": {"id": 1001, "type": "private"}, "text": "/start"},
+    "group-unmentioned": {"chat": {"id": -1001, "type": "supergroup"}, "text": "Salom hammaga"},
+    "question": {"chat": {"id": 1002, "type": "private"}, "text": "Mobil ilova narxi qancha?"},
+}
+
+# Dependencies that should only be imported when a request needs them
+HEAVY_MODULES = ("requests", "numpy", "groq")
+
+CHILD = r'''
+import io, json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, "api")
+import telegram
+imported = time.perf_counter()
+
+handler = object.__new__(telegram.Handler)
+body = sys.argv[1].encode()
+handler.headers = {"Content-Length": str(len(body))}
+handler.rfile = io.BytesIO(body)
+handler.wfile = io.BytesIO()
+handler.send_response = lambda code: None
+handler.send_header = lambda name, value: None
+handler.end_headers = lambda: None
+handler.do_POST()
+answered = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_response_ms": (answered - started) * 1000,
+    "heavy": [name for name in sys.argv[2].split(",") if name in sys.modules],
+}))
+'''
+
+def run_once(update):
+    """Run one cold start in a fresh interpreter; returns the child's measurements."""
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN=os.environ.get("TELEGRAM_BOT_TOKEN", "123456:bench"),
+               WEBHOOK_REPLY_IN_RESPONSE="true", WEBHOOK_ACK_FIRST="false")
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, json.dumps(update), ",".join(HEAVY_MODULES)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Measure cold-start import and first-response time")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per scenario")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="Scenario to run (default: all)")
+    parser.add_argument("--import-budget-ms", type=float,
+                        default=float(os.environ.get("COLD_START_IMPORT_BUDGET_MS", "150")),
+                        help="Maximum median import time")
+    parser.add_argument("--response-budget-ms", type=float,
+                        default=float(os.environ.get("COLD_START_RESPONSE_BUDGET_MS", "250")),
+                        help="Maximum median time to the first do_POST response, import included")
+    args = parser.parse_args()
+
+    over_budget = False
+    print(f"{'scenario':<20} {'import ms':>10} {'response ms':>12}  heavy modules loaded")
+    for name in args.scenario or sorted(SCENARIOS):
+        message = dict(SCENARIOS[name], message_id=1, **{"from": {"id": 1, "first_name": "Bench"}})
+        runs = [run_once({"update_id": index + 1, "message": message}) for index in range(args.runs)]
+        import_ms = statistics.median(run["import_ms"] for run in runs)
+        response_ms = statistics.median(run["first_response_ms"] for run in runs)
+        heavy = sorted(set().union(*(run["heavy"] for run in runs)))
+        failed = import_ms > args.import_budget_ms or response_ms > args.response_budget_ms
+        over_budget |= failed
+        print(f"{name:<20} {import_ms:>10.1f} {response_ms:>12.1f}  {', '.join(heavy) or '-'}"
+              + ("  ❌ over budget" if failed else ""))
+
+    print(f"\nBudgets: import {args.import_budget_ms:.0f} ms, first response {args.response_budget_ms:.0f} ms")
+    if over_budget:
+        print("❌ Cold-start budget exceeded")
+        return 1
+    print("✅ Within cold-start budget")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Benchmark the compiled language detector against the previous keyword-list
+implementation and check that both make the same decision on a labeled corpus.
+"""
+
+import argparse
+import sys
+import time
+
+sys.path.append('.')
+
+from api.telegram import detect_language
+
+# (text, expected language) - expectations follow the Uzbek-first policy
+CORPUS = [
+    ("", "uzbek"),
+    ("/start", "uzbek"),
+    ("Hello", "uzbek"),
+    ("Thank you", "uzbek"),
+    ("What is your company?", "uzbek"),
+    ("Salom, qanday yordam bera olaman?", "uzbek"),
+    ("Men mobil ilova kerak", "uzbek"),
+    ("Rahmat sizga", "uzbek"),
+    ("Loyiha haqida", "uzbek"),
+    ("Kompaniya haqida gapirib bering", "uzbek"),
+    ("Hello, kompaniya haqida", "uzbek"),
+    ("Sizning jamoangiz kimlardan iborat?", "uzbek"),
+    ("Narxi qancha bo'ladi?", "uzbek"),
+    ("Telegram bot ishlab chiqish uchun nima kerak?", "uzbek"),
+    ("Manzilingiz qayerda?", "uzbek"),
+    ("Ish vaqtingiz qachon?", "uzbek"),
+    ("Veb-sayt yaratish xizmati bormi", "uzbek"),
+    ("Assalomu alaykum, buyurtma bermoqchiman", "uzbek"),
+    ("Здравствуйте, сколько стоит сайт?", "uzbek"),
+    ("Салом, хизматлар ҳақида маълумот беринг", "uzbek"),
+    ("I need a mobile app", "uzbek"),
+    ("About the project", "uzbek"),
+    ("Hello, how can I help you?", "uzbek"),
+    ("Thank you very much", "english"),
+    ("Thank you very much for everything", "english"),
+    ("Hello there, who are you?", "english"),
+    ("Can you tell me about your services?", "english"),
+    ("I would like to know the prices", "english"),
+    ("I need information about mobile development", "uzbek"),
+    ("What can you do for me today?", "english"),
+    ("How can you help me with a website?", "english"),
+    ("Can you tell me about the jamoa?", "uzbek"),
+    ("I would like to know about sayt prices", "uzbek"),
+    ("Please respond in English", "english"),
+    ("Can you speak English?", "english"),
+    ("inglizcha javob bering", "english"),
+    ("switch to english", "english"),
+    ("I would like to speak in English", "english"),
+    ("Ingliz tilida gapiring", "english"),
+    ("ENGLISH please", "english"),
+]
+
+
+def legacy_detect_language(text):
+    """The keyword-list detector that detect_language replaced, kept for comparison."""
+    if not text:
+        return "uzbek"  # Default to Uzbek
+
+    text_lower = text.lower()
+
+    # Uzbek indicators
+    uzbek_keywords = [
+    # --- Salomlashish va xayrlashish ---
+    'salom', 'assalomu alaykum', 'alaykum assalom', 'xayr', 'xayrli tong',
+    'xayrli kun', 'xayrli kech', 'omad', 'tabriklayman', 'marhamat',
+
+    # --- Odob va minnatdorchilik ---
+    'rahmat', 'katta rahmat', 'iltimos', 'iltimos qilaman', 'uzr', 'kechirasiz',
+    'afsus', 'rozi', 'marhamat', 'qabul qildim', 'tasdiq',
+
+    # --- Savollar uchun so'zlar ---
+    'nima', 'qanday', 'qachon', 'qayerda', 'qayerdan', 'kim', 'nega', 'qancha',
+    'qaysi', 'qanaqa', 'qanaqasiga', 'nimaga', 'qayerlik', 'qaysi biri',
+
+    # --- Loyiha va xizmatlar ---
+    'loyiha', 'xizmat', 'dastur', 'sayt', 'vebsayt', 'mobil', 'ilova',
+    'ishlab chiqish', 'dasturlash', 'yordam', 'kompaniya', 'firma', 'jamoa',
+    'zakaz', 'buyurtma', 'texnologiya', 'rivojlantirish', 'yaratish',
+    'qilish', 'tuzish', 'platforma', 'raqamlashtirish', 'startap', 'hamkorlik',
+    'maqsad', 'natija', 'funksiya', 'imkoniyat', 'integratsiya', 'backend',
+    'frontend', 'server', 'ma’lumotlar bazasi',
+
+    # --- Moliyaviy va ish jarayoni ---
+    'narx', 'tekinga', 'shartnoma', 'hisob', 'pul', 'to\'lov', 'muddat',
+    'byudjet', 'arzon', 'qimmat', 'daromad', 'foyda', 'investitsiya',
+
+    # --- Foydalanuvchi uchun so'zlar ---
+    'foydalanuvchi', 'mijoz', 'aloqa', 'savol', 'javob', 'fikr', 'taklif',
+    'so\'rov', 'shikoyat', 'profil', 'akkaunt', 'ro\'yxat', 'kirish', 'chiqish',
+
+    # --- Uzbek tiliga xos belgilar ---
+    'o\'', 'g\'', 'sh', 'ch', 'ng', 'ʼ', '‘', '’', 'yo\'q', 'ha'
+    ]
+
+    # English indicators
+    english_keywords = [
+    # --- Greetings & Polite words ---
+    'hello', 'hi', 'hey', 'good morning', 'good evening', 'good night',
+    'bye', 'goodbye', 'thanks', 'thank', 'thank you', 'please', 'welcome',
+
+    # --- Common requests & needs ---
+    'need', 'want', 'require', 'looking for', 'searching', 'help', 'support',
+    'assist', 'guide', 'show', 'tell', 'explain', 'about',
+
+    # --- Question words ---
+    'what', 'how', 'when', 'where', 'who', 'why', 'which', 'whose',
+
+    # --- Project / Business related ---
+    'project', 'service', 'solution', 'product', 'platform', 'system',
+    'app', 'application', 'website', 'web', 'portal', 'software', 'mobile',
+    'development', 'design', 'build', 'create', 'make', 'deploy', 'launch',
+    'technology', 'digital', 'automation', 'integration', 'startup', 'business',
+
+    # --- Company / Team ---
+    'company', 'team', 'group', 'agency', 'enterprise', 'organization',
+    'partner', 'collaboration', 'client', 'customer', 'user', 'profile',
+
+    # --- Finance & Contract ---
+    'price', 'cost', 'budget', 'payment', 'invoice', 'deal', 'contract',
+    'profit', 'income', 'revenue', 'investment', 'free', 'cheap', 'expensive',
+
+    # --- General small words ---
+    'can', 'could', 'will', 'would', 'shall', 'should',
+    'you', 'your', 'me', 'my', 'i', 'we', 'our', 'they', 'their',
+    'with', 'for', 'and', 'the', 'is', 'are', 'was', 'were', 'very', 'much'
+    ]
+
+    # Check for explicit English requests first
+    explicit_english_requests = [
+        'english', 'ingliz', 'inglizcha', 'in english', 'speak english',
+        'can you speak english', 'switch to english', 'ingliz tilida',
+        'please respond in english', 'answer in english'
+    ]
+
+    if any(phrase in text_lower for phrase in explicit_english_requests):
+        return "english"
+
+    # Very specific English phrases that indicate clear English intent
+    strong_english_phrases = [
+        'hello there', 'thank you very much', 'could you please tell me',
+        'i would like to know', 'can you tell me about', 'i need information about',
+        'what can you do for me', 'how can you help me with', 'please provide information'
+    ]
+
+    # Only switch to English if there's a very specific English phrase AND no Uzbek words
+    has_strong_english = any(phrase in text_lower for phrase in strong_english_phrases)
+
+    # Check for any Uzbek words (even common ones)
+    uzbek_words = [
+        'salom', 'rahmat', 'iltimos', 'kerak', 'nima', 'qanday', 'qachon', 'qayerda',
+        'loyiha', 'xizmat', 'dastur', 'sayt', 'mobil', 'yordam', 'kompaniya', 'jamoa',
+        'haqida', 'uchun', 'bilan', 'qilish', 'berish', 'olish', 'ko\'rish', 'bo\'lish'
+    ]
+    has_uzbek_words = any(word in text_lower for word in uzbek_words)
+
+    # Very strict English detection - only if very specific English phrases and NO Uzbek
+    if has_strong_english and not has_uzbek_words and len(text.split()) >= 4:
+        return "english"
+
+    # Default to Uzbek in ALL other cases
+    return "uzbek"
+
+
+def time_detector(detector, texts, rounds):
+    """Return the mean microseconds per call of detector over texts."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            detector(text)
+    return (time.perf_counter() - start) / (rounds * len(texts)) * 1e6
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Benchmark language detection")
+    parser.add_argument("--rounds", type=int, default=2000, help="Passes over the corpus per detector")
+    args = parser.parse_args()
+
+    mismatches = 0
+    for text, expected in CORPUS:
+        current, legacy = detect_language(text), legacy_detect_language(text)
+        if current != legacy or current != expected:
+            mismatches += 1
+            print(f"❌ {text!r}: compiled={current} legacy={legacy} expected={expected}")
+    print(f"✅ {len(CORPUS) - mismatches}/{len(CORPUS)} samples agree")
+
+    texts = [text for text, _ in CORPUS]
+    legacy_us = time_detector(legacy_detect_language, texts, args.rounds)
+    current_us = time_detector(detect_language, texts, args.rounds)
+    print(f"legacy:   {legacy_us:.2f} µs/message")
+    print(f"compiled: {current_us:.2f} µs/message ({legacy_us / current_us:.1f}x)")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
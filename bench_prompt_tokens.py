@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Compare system prompt sizes with the whole knowledge base against prompts
+that only carry the sections retrieved for each question.
+
+Token counts are estimates (words and punctuation marks), which track the
+Llama tokenizer closely enough to compare the two prompt variants.
+"""
+
+import argparse
+import re
+import sys
+
+sys.path.append('.')
+
+from api.telegram import build_system_prompt, get_knowledge_index, KB_TOP_K
+
+QUESTIONS = [
+    ("Narxlar qancha?", "uzbek"),
+    ("Mobil ilova yaratish xizmatingiz bormi?", "uzbek"),
+    ("Jamoa a'zolari kimlar?", "uzbek"),
+    ("Manzilingiz qayerda?", "uzbek"),
+    ("Qanday loyihalar qilgansiz?", "uzbek"),
+    ("Kompaniya qachon tashkil topgan?", "uzbek"),
+    ("Telegram bot kerak edi", "uzbek"),
+    ("What services do you offer?", "english"),
+    ("Who is the team lead for mobile development?", "english"),
+    ("Tell me about the Med KPI project", "english"),
+    ("What are your business hours?", "english"),
+    ("Salom", "uzbek"),
+]
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    """Approximate token count of text."""
+    return len(TOKEN_PATTERN.findall(text))
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Report prompt tokens before and after knowledge-base retrieval")
+    parser.add_argument("--top-k", type=int, default=KB_TOP_K, help="Sections sent per question")
+    args = parser.parse_args()
+
+    knowledge_index = get_knowledge_index()
+    if knowledge_index is None:
+        print("❌ NumPy is not installed, retrieval is disabled")
+        return 1
+
+    total_before = total_after = 0
+    print(f"{'question':<48} {'before':>7} {'after':>7}  sections")
+    for question, language in QUESTIONS:
+        before = estimate_tokens(build_system_prompt("User", language))
+        context = knowledge_index.context(question, args.top_k)
+        after = estimate_tokens(build_system_prompt("User", language, context))
+        titles = [knowledge_index.sections[i][0] for i in knowledge_index.top_sections(question, args.top_k)]
+        total_before += before
+        total_after += after
+        print(f"{question:<48} {before:>7} {after:>7}  {', '.join(titles) or '(full knowledge base)'}")
+
+    saved = 1 - total_after / total_before
+    print(f"\nAverage prompt: {total_before / len(QUESTIONS):.0f} -> {total_after / len(QUESTIONS):.0f} tokens ({saved:.0%} fewer)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
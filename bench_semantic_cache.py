@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Check the paraphrase cache key on labelled question pairs.
+
+Each pair is either a paraphrase (the cached answer is right for both) or a
+near miss that must not share an answer. The script reports how many
+paraphrases hit and how many near misses would have been served the wrong
+answer.
+"""
+
+import argparse
+import sys
+
+sys.path.append('.')
+
+from api.telegram import SemanticCache
+
+PARAPHRASES = [
+    ("mobil ilova narxi", "mobil ilovalar qancha turadi"),
+    ("Narxlar qancha?", "narxlari qancha"),
+    ("Telegram bot narxi qancha", "telegram bot qancha turadi"),
+    ("Sayt yaratish narxi qancha?", "sayt yaratish qancha turadi"),
+    ("Manzilingiz qayerda?", "manzilingiz qayerda joylashgan"),
+    ("Jamoa a'zolari kimlar?", "jamoangiz a'zolari kimlar"),
+    ("mobil ilova yaratish xizmatingiz bormi", "mobil ilova yaratish xizmati bormi"),
+    ("Ish vaqtingiz qanday?", "ish vaqtlaringiz qanday"),
+    ("Logotip dizayn qilasizmi?", "logotip dizayni qilasizmi"),
+    ("Where is your office?", "Where is your office located?"),
+    ("what services do you offer?", "Which services do you offer"),
+    ("How much does a website cost?", "What is the price of a website?"),
+    ("Do you develop mobile apps?", "Do you build mobile applications?"),
+    ("Who is the team lead?", "who is your team lead"),
+    ("What are your business hours?", "what are the business hours"),
+    ("Tell me about the Med KPI project", "tell me about Med KPI project please"),
+    ("How much is a telegram bot?", "telegram bot price"),
+    ("Do you make websites?", "Can you create a website?"),
+]
+
+NEAR_MISSES = [
+    ("Do you develop iOS applications?", "Do you develop Android applications?"),
+    ("is a website cheaper than a mobile app", "is a mobile app cheaper than a website"),
+    ("mobil ilova narxi qancha", "veb sayt narxi qancha"),
+    ("Telegram bot narxi qancha", "mobil ilova narxi qancha"),
+    ("Manzilingiz qayerda?", "Telefon raqamingiz qanday?"),
+    ("Narxlar qancha?", "Ish vaqtingiz qanday?"),
+    ("Where is your office?", "When is your office open?"),
+    ("Who is the team lead?", "Who is the backend developer?"),
+    ("How much does a website cost?", "How long does a website take?"),
+    ("Tell me about the Med KPI project", "Tell me about the Ahost project"),
+    ("What are your business hours?", "What are your services?"),
+    ("Do you make logos?", "Do you make websites?"),
+    ("Do you work on Saturday?", "Do you work on Sunday?"),
+    ("Can I pay by card?", "Can I pay in cash?"),
+]
+
+def matches(pairs):
+    """Whether both questions of each pair get the same cache key."""
+    result = []
+    for first, second in pairs:
+        key = SemanticCache.content_key(first)
+        result.append(bool(key) and key == SemanticCache.content_key(second))
+    return result
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Report paraphrase cache hits and wrong answers")
+    parser.add_argument("--verbose", action="store_true", help="Print the keys of every pair")
+    args = parser.parse_args()
+
+    if args.verbose:
+        for label, pairs in (("paraphrase", PARAPHRASES), ("near miss", NEAR_MISSES)):
+            for first, second in pairs:
+                print(f"{label:<11} {SemanticCache.content_key(first)} / {SemanticCache.content_key(second)}")
+        print()
+
+    hits, wrong = sum(matches(PARAPHRASES)), sum(matches(NEAR_MISSES))
+    print(f"paraphrases: {hits}/{len(PARAPHRASES)} hit")
+    print(f"near misses: {wrong}/{len(NEAR_MISSES)} served the wrong answer")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
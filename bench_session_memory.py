@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Measure the memory held by per-chat sessions at 1M simulated chats.
+
+Compares the old free-form dict per chat (state, message count and a
+datetime) with the SessionTable records, first with nothing evicted and then
+with the default size cap and idle TTL while chats arrive over a few days.
+"""
+
+import argparse
+import datetime
+import gc
+import sys
+import tracemalloc
+
+sys.path.append('.')
+
+from api.telegram import SessionTable, UserState, SESSION_TABLE_SIZE, SESSION_IDLE_SECONDS
+
+def measure(build):
+    """Return (result, bytes allocated) of build()."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def dict_sessions(chats, lead_every):
+    """Sessions as they were kept before: one dict per chat, never removed."""
+    sessions = {}
+    for chat_id in range(chats):
+        sessions[chat_id] = {'state': UserState.NORMAL, 'message_count': 1,
+                             'last_interaction': datetime.datetime.now()}
+        if chat_id % lead_every == 0:
+            sessions[chat_id] = {'state': UserState.COLLECTING_NAME, 'project': 'Mobile app',
+                                 'name': '', 'phone': '', 'email': ''}
+    return sessions
+
+def table_sessions(chats, lead_every, max_size, idle_ttl, span):
+    """Same traffic through a SessionTable; chats arrive evenly over span seconds."""
+    now = [0.0]
+    table = SessionTable(max_size=max_size, idle_ttl=idle_ttl, clock=lambda: now[0])
+    lead = {'state': UserState.COLLECTING_NAME, 'project': 'Mobile app'}
+    for chat_id in range(chats):
+        now[0] = chat_id * span / chats
+        table.record_message(chat_id)
+        if chat_id % lead_every == 0:
+            table.set(chat_id, lead)
+    return table
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Report session memory per chat")
+    parser.add_argument("--chats", type=int, default=1_000_000, help="Simulated chats")
+    parser.add_argument("--lead-every", type=int, default=100, help="One chat in N is mid-order")
+    parser.add_argument("--days", type=float, default=3, help="Period the chats arrive over")
+    args = parser.parse_args()
+
+    rows = []
+    sessions, size = measure(lambda: dict_sessions(args.chats, args.lead_every))
+    rows.append(("dict per chat (before)", len(sessions), size))
+    del sessions
+
+    table, size = measure(lambda: table_sessions(args.chats, args.lead_every, args.chats, float("inf"), 0))
+    rows.append(("SessionTable, nothing evicted", len(table), size))
+    del table
+
+    table, size = measure(lambda: table_sessions(args.chats, args.lead_every, SESSION_TABLE_SIZE,
+                                                 SESSION_IDLE_SECONDS, args.days * 86400))
+    rows.append((f"SessionTable, cap {SESSION_TABLE_SIZE:,} / idle {SESSION_IDLE_SECONDS:.0f}s", len(table), size))
+    leads = table.stats()["leads"]
+    del table
+
+    print(f"{args.chats:,} chats, one in {args.lead_every} collecting a lead\n")
+    print(f"{'sessions':<40} {'kept':>10} {'MiB':>9} {'bytes/chat':>11}")
+    for name, kept, size in rows:
+        print(f"{name:<40} {kept:>10,} {size / 2**20:>9.1f} {size / max(kept, 1):>11.0f}")
+    print(f"\nLeads still in progress kept by the bounded table: {leads:,}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Run the bot with getUpdates long polling instead of the Vercel webhook.
+Useful for on-prem deployments and local load testing.
+"""
+
+import argparse
+import signal
+import sys
+
+sys.path.append('.')
+
+from api.telegram import PollingRunner, POLLING_LIMIT, POLLING_TIMEOUT, POLLING_WORKERS
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Run the PremiumSoft bot with long polling")
+    parser.add_argument("--limit", type=int, default=POLLING_LIMIT, help="Updates per getUpdates batch (1-100)")
+    parser.add_argument("--timeout", type=int, default=POLLING_TIMEOUT, help="Long-poll timeout in seconds")
+    parser.add_argument("--workers", type=int, default=POLLING_WORKERS, help="Concurrent chats processed per batch")
+    parser.add_argument("--keep-webhook", action="store_true", help="Do not delete the webhook before polling")
+    args = parser.parse_args()
+
+    runner = PollingRunner(limit=args.limit, timeout=args.timeout, workers=args.workers)
+
+    def handle_signal(signum, frame):
+        print("\nStopping after the current batch...")
+        runner.stop()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    print(f"🚀 Long polling (limit={args.limit}, timeout={args.timeout}s, workers={args.workers})")
+    runner.run(delete_webhook=not args.keep_webhook)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
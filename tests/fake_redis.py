@@ -0,0 +1,102 @@
+import socketserver
+import threading
+import time
+
+
+class FakeRedisServer:
+    """In-process Redis-protocol server supporting the commands the bot uses."""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.commands = []
+        self.drop_replies = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    args = server._read_command(self.rfile)
+                    if args is None:
+                        return
+                    reply = server._dispatch(args)
+                    with server.lock:
+                        if server.drop_replies:
+                            # Run the command, then lose the connection before answering
+                            server.drop_replies -= 1
+                            return
+                    self.wfile.write(reply)
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RequestHandler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.url = f"redis://127.0.0.1:{self.port}/0"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(rfile.readline()[1:-2])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    @staticmethod
+    def _bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+
+    def _get(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def _dispatch(self, args):
+        command = args[0].upper().decode()
+        with self.lock:
+            self.commands.append(command)
+            if command == "PING":
+                return b"+PONG\r\n"
+            if command == "SELECT":
+                return b"+OK\r\n"
+            if command == "GET":
+                return self._bulk(self._get(args[1]))
+            if command == "MGET":
+                values = [self._get(key) for key in args[1:]]
+                return b"*" + str(len(values)).encode() + b"\r\n" + b"".join(self._bulk(v) for v in values)
+            if command == "SET":
+                key, value = args[1], args[2]
+                options = [a.upper() for a in args[3:]]
+                if b"NX" in options and self._get(key) is not None:
+                    return b"$-1\r\n"
+                self.data[key] = value
+                self.expires.pop(key, None)
+                if b"EX" in options:
+                    seconds = int(args[3 + options.index(b"EX") + 1])
+                    self.expires[key] = time.monotonic() + seconds
+                return b"+OK\r\n"
+            if command == "DEL":
+                removed = 0
+                for key in args[1:]:
+                    if self._get(key) is not None:
+                        removed += 1
+                    self.data.pop(key, None)
+                    self.expires.pop(key, None)
+                return b":" + str(removed).encode() + b"\r\n"
+            return b"-ERR unknown command '" + command.encode() + b"'\r\n"
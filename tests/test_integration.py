@@ -49,7 +49,8 @@ class TestTelegramBotIntegration(unittest.TestCase):
         handler.headers = {'Host': 'example.vercel.app'}
         handler.path = '/setup-webhook'
         
-        with patch('telegram.requests.post') as mock_post:
+        with patch('telegram.bot_api.session') as mock_session:
+            mock_post = mock_session.post
             mock_response = Mock()
             mock_response.json.return_value = {"ok": True}
             mock_post.return_value = mock_response
@@ -71,7 +72,8 @@ class TestTelegramBotIntegration(unittest.TestCase):
         handler.headers = {'Host': 'example.vercel.app'}
         handler.path = '/setup-webhook=https://custom.domain.com/webhook'
         
-        with patch('telegram.requests.post') as mock_post:
+        with patch('telegram.bot_api.session') as mock_session:
+            mock_post = mock_session.post
             mock_response = Mock()
             mock_response.json.return_value = {"ok": True}
             mock_post.return_value = mock_response
@@ -4,12 +4,31 @@ import os
 from unittest.mock import Mock, patch, MagicMock
 import sys
 import io
+import subprocess
+import tempfile
+import threading
+import time
+import requests
 from http.server import BaseHTTPRequestHandler
 
 # Add the api directory to the path so we can import the module
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'api'))
+sys.path.insert(0, os.path.dirname(__file__))
 
-from telegram import Handler, send_telegram_message, get_premiumsoft_info
+from telegram import (
+    Handler, send_telegram_message, get_premiumsoft_info, TelegramBotClient, UpdateWorkerPool,
+    UpdateDeduplicator, RedisClient, RedisDedupStore, PollingRunner, ChatScheduler,
+    OutboundRateLimiter, TokenBucket, RetryPolicy, invocation_budget, remaining_budget,
+    TypingIndicator, ResponsePlan, handle_message, KeywordMatcher, detect_language,
+    Intent, classify_intents, LanguagePreferences, resolve_language,
+    CharNgramLanguageModel, ResponseCache, get_ai_response,
+    SemanticCache, StreamingReply, SessionTable, SQLiteSessionStore,
+    RedisSessionStore, CachedSessionStore, LeadOutbox, LeadDrainer,
+    ReplyTemplates, reply_templates, add_cta_to_message, get_premiumsoft_info_english,
+    LatencyHistogram, Metrics,
+)
+from fake_redis import FakeRedisServer
+import telegram
 
 
 class TestTelegramBot(unittest.TestCase):
@@ -20,6 +39,8 @@ class TestTelegramBot(unittest.TestCase):
         self.test_bot_token = "test_token_123"
         self.test_chat_id = 12345
         self.test_user_name = "TestUser"
+        telegram.outbound_limiter.reset()
+        telegram.language_preferences.clear()
         
     def test_get_premiumsoft_info(self):
         """Test that premiumsoft info is returned correctly."""
@@ -35,10 +56,11 @@ class TestTelegramBot(unittest.TestCase):
         self.assertIn("Technologies", info)
         self.assertIn("Contact Information", info)
         
-    @patch('telegram.requests.post')
+    @patch('telegram.bot_api.session')
     @patch('telegram.BOT_TOKEN', 'test_token_123')
-    def test_send_telegram_message_success(self, mock_post):
+    def test_send_telegram_message_success(self, mock_session):
         """Test successful message sending."""
+        mock_post = mock_session.post
         # Mock successful response
         mock_response = Mock()
         mock_response.json.return_value = {"ok": True, "result": {"message_id": 1}}
@@ -54,10 +76,11 @@ class TestTelegramBot(unittest.TestCase):
         self.assertEqual(call_args[1]['json']['chat_id'], self.test_chat_id)
         self.assertEqual(call_args[1]['json']['text'], "Test message")
         
-    @patch('telegram.requests.post')
+    @patch('telegram.bot_api.session')
     @patch('telegram.BOT_TOKEN', 'test_token_123')
-    def test_send_telegram_message_with_parse_mode(self, mock_post):
+    def test_send_telegram_message_with_parse_mode(self, mock_session):
         """Test message sending with parse mode."""
+        mock_post = mock_session.post
         mock_response = Mock()
         mock_response.json.return_value = {"ok": True}
         mock_post.return_value = mock_response
@@ -68,10 +91,11 @@ class TestTelegramBot(unittest.TestCase):
         call_args = mock_post.call_args
         self.assertEqual(call_args[1]['json']['parse_mode'], "Markdown")
         
-    @patch('telegram.requests.post')
+    @patch('telegram.bot_api.session')
     @patch('telegram.BOT_TOKEN', 'test_token_123')
-    def test_send_telegram_message_api_error(self, mock_post):
+    def test_send_telegram_message_api_error(self, mock_session):
         """Test handling of Telegram API errors."""
+        mock_post = mock_session.post
         mock_response = Mock()
         mock_response.json.return_value = {"ok": False, "error_code": 400, "description": "Bad Request"}
         mock_post.return_value = mock_response
@@ -80,19 +104,21 @@ class TestTelegramBot(unittest.TestCase):
 
         self.assertFalse(result)
         
-    @patch('telegram.requests.post')
-    def test_send_telegram_message_no_token(self, mock_post):
+    @patch('telegram.bot_api.session')
+    def test_send_telegram_message_no_token(self, mock_session):
         """Test message sending without bot token."""
+        mock_post = mock_session.post
         with patch.dict(os.environ, {}, clear=True):
             result = send_telegram_message(self.test_chat_id, "Test message")
             
         self.assertFalse(result)
         mock_post.assert_not_called()
         
-    @patch('telegram.requests.post')
+    @patch('telegram.bot_api.session')
     @patch('telegram.BOT_TOKEN', 'test_token_123')
-    def test_send_telegram_message_network_error(self, mock_post):
+    def test_send_telegram_message_network_error(self, mock_session):
         """Test handling of network errors."""
+        mock_post = mock_session.post
         mock_post.side_effect = Exception("Network error")
 
         result = send_telegram_message(self.test_chat_id, "Test message")
@@ -100,6 +126,1607 @@ class TestTelegramBot(unittest.TestCase):
         self.assertFalse(result)
 
 
+class TestTelegramBotClient(unittest.TestCase):
+    """Test suite for the shared Bot API client."""
+
+    def test_session_is_pooled_and_reused(self):
+        """Test that one pooled session is created and reused."""
+        client = TelegramBotClient(pool_connections=2, pool_maxsize=8)
+
+        session = client._ensure_session()
+
+        self.assertIs(client._ensure_session(), session)
+        adapter = session.get_adapter("https://api.telegram.org")
+        self.assertEqual(adapter._pool_maxsize, 8)
+
+    @patch('telegram.BOT_TOKEN', 'test_token_123')
+    def test_call_records_stats(self):
+        """Test that calls are counted per method with latency."""
+        client = TelegramBotClient()
+        client.session = Mock()
+        client.session.post.return_value.json.side_effect = [{"ok": True}, {"ok": False}]
+
+        client.call("sendMessage", {"chat_id": 1, "text": "a"})
+        client.call("sendMessage", {"chat_id": 1, "text": "b"})
+
+        stats = client.stats()["sendMessage"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertGreaterEqual(stats["max_seconds"], 0.0)
+        url = client.session.post.call_args[0][0]
+        self.assertTrue(url.endswith("/bottest_token_123/sendMessage"))
+        self.assertEqual(client.session.post.call_args[1]['timeout'], 10)
+
+    @patch('telegram.BOT_TOKEN', 'test_token_123')
+    def test_call_uses_method_timeout(self):
+        """Test that per-method timeouts are applied."""
+        client = TelegramBotClient()
+        client.session = Mock()
+        client.session.post.return_value.json.return_value = {"ok": True}
+
+        client.call("sendChatAction", {"chat_id": 1, "action": "typing"})
+
+        self.assertEqual(client.session.post.call_args[1]['timeout'], 5)
+
+
+class TestBotApiRetries(unittest.TestCase):
+    """Test suite for Bot API retries."""
+
+    def setUp(self):
+        """Set up a client that records sleeps instead of waiting."""
+        self.sleeps = []
+        self.client = TelegramBotClient(retry_policy=RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=8),
+                                        sleep=self.sleeps.append)
+        self.client.session = Mock()
+        self.token_patch = patch('telegram.BOT_TOKEN', 'test_token_123')
+        self.token_patch.start()
+        self.addCleanup(self.token_patch.stop)
+
+    def _responses(self, *bodies):
+        responses = []
+        for body in bodies:
+            response = Mock()
+            response.json.return_value = body
+            responses.append(response)
+        self.client.session.post.side_effect = responses
+
+    def test_retry_after_is_honored_exactly(self):
+        """Test that a 429 is retried after exactly retry_after seconds."""
+        self._responses(
+            {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 3}},
+            {"ok": True, "result": {}},
+        )
+
+        result = self.client.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+        self.assertTrue(result["ok"])
+        self.assertEqual(self.sleeps, [3.0])
+        self.assertEqual(self.client.stats()["sendMessage"]["retries"], 1)
+
+    def test_server_errors_retried_for_idempotent_methods(self):
+        """Test that 5xx responses are retried with backoff for safe methods."""
+        self._responses(
+            {"ok": False, "error_code": 502, "description": "Bad Gateway"},
+            {"ok": False, "error_code": 500, "description": "Internal"},
+            {"ok": True, "result": True},
+        )
+
+        result = self.client.call("sendChatAction", {"chat_id": 1, "action": "typing"})
+
+        self.assertTrue(result["ok"])
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(all(0 <= delay <= 8 for delay in self.sleeps))
+
+    def test_server_errors_not_retried_for_send_message(self):
+        """Test that a possibly delivered sendMessage is not repeated."""
+        self._responses({"ok": False, "error_code": 500, "description": "Internal"})
+
+        result = self.client.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+        self.assertFalse(result["ok"])
+        self.assertEqual(self.sleeps, [])
+
+    def test_connect_timeout_retried_for_send_message(self):
+        """Test that a request that never reached Telegram is retried."""
+        ok = Mock()
+        ok.json.return_value = {"ok": True}
+        self.client.session.post.side_effect = [requests.exceptions.ConnectTimeout("slow"), ok]
+
+        result = self.client.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+        self.assertTrue(result["ok"])
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_read_timeout_not_retried_for_send_message(self):
+        """Test that an ambiguous timeout on sendMessage is raised."""
+        self.client.session.post.side_effect = requests.exceptions.ReadTimeout("slow")
+
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.client.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+    def test_attempts_are_bounded(self):
+        """Test that retries stop after the maximum number of attempts."""
+        self._responses(*[{"ok": False, "error_code": 429, "parameters": {"retry_after": 1}}] * 4)
+
+        result = self.client.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+        self.assertEqual(result["error_code"], 429)
+        self.assertEqual(len(self.sleeps), 3)
+
+    def test_retries_respect_invocation_deadline(self):
+        """Test that no retry is scheduled past the invocation budget."""
+        self._responses({"ok": False, "error_code": 429, "parameters": {"retry_after": 30}})
+
+        with invocation_budget(5):
+            self.assertLessEqual(remaining_budget(), 5)
+            result = self.client.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+        self.assertEqual(result["error_code"], 429)
+        self.assertEqual(self.sleeps, [])
+        self.assertIsNone(remaining_budget())
+
+
+class TestTypingIndicator(unittest.TestCase):
+    """Test suite for the background typing indicator."""
+
+    @patch('telegram.send_typing_action')
+    def test_refreshes_until_stopped(self, mock_typing):
+        """Test that the chat action is repeated until the indicator stops."""
+        indicator = TypingIndicator(12345, interval=0.01).start()
+        threading.Event().wait(0.05)
+        indicator.stop()
+        indicator._thread.join(1)
+
+        self.assertGreaterEqual(mock_typing.call_count, 2)
+        mock_typing.assert_called_with(12345, None)
+
+    @patch('telegram.send_telegram_message')
+    @patch('telegram.get_ai_response')
+    @patch('telegram.send_typing_action')
+    def test_ai_call_does_not_wait_for_chat_action(self, mock_typing, mock_ai, mock_send):
+        """Test that the AI request starts while the chat action is still in flight."""
+        release = threading.Event()
+        released_by_ai = []
+        mock_typing.side_effect = lambda *args: released_by_ai.append(release.wait(2))
+        mock_ai.side_effect = lambda *args, **kwargs: (release.set(), "AI answer")[1]
+
+        handle_message({
+            "chat": {"id": 12345, "type": "private"},
+            "text": "Kompaniya haqida gapirib bering",
+            "from": {"first_name": "TestUser", "id": 12345},
+        })
+
+        mock_ai.assert_called_once()
+        self.assertIn("AI answer", mock_send.call_args[0][1])
+        # The chat action was still pending when the AI request started
+        for _ in range(100):
+            if released_by_ai:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(released_by_ai[0], True)
+
+    @patch('telegram.send_telegram_message')
+    @patch('telegram.get_ai_response')
+    @patch('telegram.send_typing_action')
+    def test_cached_answer_skips_typing(self, mock_typing, mock_ai, mock_send):
+        """Test that a cached answer is sent without starting a typing indicator."""
+        cache = ResponseCache()
+        cache.put("Kompaniya haqida", "uzbek", "Cached answer")
+        with patch.multiple('telegram', groq_client=MagicMock(), ai_response_cache=cache, semantic_cache=None):
+            telegram.send_ai_reply(12345, "kompaniya haqida", "Ali", "uzbek", lambda answer: answer + " CTA")
+
+        mock_send.assert_called_once_with(12345, "Cached answer CTA", message_thread_id=None)
+        mock_typing.assert_not_called()
+        mock_ai.assert_not_called()
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+
+class TestResponsePlan(unittest.TestCase):
+    """Test suite for planned and concurrent outgoing calls."""
+
+    def setUp(self):
+        """Reset rate limiter state."""
+        telegram.outbound_limiter.reset()
+
+    def test_concurrent_block_forms_one_stage(self):
+        """Test that calls inside concurrent() share a stage and others do not."""
+        plan = ResponsePlan()
+        plan.add("sendMessage", {"text": "first"})
+        with plan.concurrent():
+            plan.add("sendLocation", {"latitude": 1})
+            plan.add("sendMessage", {"text": "card"})
+
+        self.assertEqual([len(stage) for stage in plan.stages], [1, 2])
+        self.assertEqual(plan.pop_last(), ("sendMessage", {"text": "card"}))
+        self.assertEqual(len(plan), 2)
+
+    @patch('telegram.BOT_TOKEN', 'test_token_123')
+    def test_location_pin_and_card_are_sent_concurrently(self):
+        """Test that the location pin and address card are in flight at the same time."""
+        barrier = threading.Barrier(2, timeout=2)
+        sent = []
+
+        def fake_call(method, payload=None, **kwargs):
+            # Both calls must reach the barrier for either to finish
+            barrier.wait()
+            sent.append(method)
+            return {"ok": True}
+
+        with patch('telegram.bot_api.call', side_effect=fake_call):
+            handle_message({
+                "chat": {"id": 12345, "type": "private"},
+                "text": "/location",
+                "from": {"first_name": "TestUser", "id": 12345},
+            })
+
+        self.assertEqual(sorted(sent), ["sendLocation", "sendMessage"])
+
+    @patch('telegram.bot_api.call', return_value={"ok": True})
+    @patch('telegram.BOT_TOKEN', 'test_token_123')
+    def test_plan_message_defers_sends(self, mock_call):
+        """Test that planning a message sends nothing until it is dispatched."""
+        plan = telegram.plan_message({
+            "chat": {"id": 12345, "type": "private"},
+            "text": "/location",
+            "from": {"first_name": "TestUser", "id": 12345},
+        })
+
+        mock_call.assert_not_called()
+        self.assertEqual([method for method, _ in plan.calls()], ["sendLocation", "sendMessage"])
+        telegram.dispatch_plan(plan)
+        self.assertEqual(mock_call.call_count, 2)
+
+
+class TestLanguageDetection(unittest.TestCase):
+    """Test suite for the compiled keyword matcher and language detection."""
+
+    def test_matcher_reports_overlapping_keywords(self):
+        """Test that keywords overlapping or prefixing each other are all found."""
+        matcher = KeywordMatcher({"a": ["hello there"], "b": ["there is"], "c": ["hell"]})
+
+        self.assertEqual(matcher.scan("oh hello there is"), {"a", "b", "c"})
+        self.assertEqual(matcher.scan("hello"), {"c"})
+        self.assertEqual(matcher.scan("nothing"), set())
+
+    def test_uzbek_first_decisions(self):
+        """Test that English is chosen only on request or a strong English-only phrase."""
+        cases = [
+            ("", "uzbek"),
+            ("Hello", "uzbek"),
+            ("What is your company?", "uzbek"),
+            ("Please respond in English", "english"),
+            ("inglizcha javob bering", "english"),
+            ("Can you tell me about your services?", "english"),
+            ("Can you tell me about the jamoa?", "uzbek"),
+            ("Thank you very much", "english"),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(detect_language(text), expected)
+
+
+    def test_preference_is_sticky_per_chat(self):
+        """Test that an explicit request sets the chat's language until it asks otherwise."""
+        prefs = telegram.language_preferences
+        prefs.clear()
+
+        self.assertEqual(resolve_language(1, "Hello"), "uzbek")
+        self.assertIsNone(prefs.get(1))
+        self.assertEqual(resolve_language(1, "Please respond in English"), "english")
+        self.assertEqual(resolve_language(1, "Hello"), "english")
+        self.assertEqual(resolve_language(2, "Hello"), "uzbek")
+        self.assertEqual(resolve_language(1, "o'zbekcha yozing"), "uzbek")
+        self.assertEqual(resolve_language(1, "What is your price?"), "uzbek")
+        prefs.clear()
+
+    @patch('telegram.language_matcher')
+    def test_known_chats_skip_full_detection(self, mock_matcher):
+        """Test that a chat with a stored preference is not run through full detection."""
+        prefs = LanguagePreferences()
+        prefs.set(7, "english")
+        with patch('telegram.language_preferences', prefs):
+            self.assertEqual(resolve_language(7, "Tell me about the company"), "english")
+        mock_matcher.scan.assert_not_called()
+
+    def test_preferences_are_bounded_and_expire(self):
+        """Test LRU eviction and TTL expiry of stored preferences."""
+        prefs = LanguagePreferences(max_size=2, ttl=60)
+        prefs.set(1, "english")
+        prefs.set(2, "english")
+        prefs.get(1)
+        prefs.set(3, "english")
+
+        self.assertEqual(len(prefs), 2)
+        self.assertIsNone(prefs.get(2))
+        self.assertEqual(prefs.get(1), "english")
+
+        expired = LanguagePreferences(ttl=0)
+        expired.set(1, "english")
+        self.assertIsNone(expired.get(1))
+
+
+class TestCharNgramLanguageModel(unittest.TestCase):
+    """Test suite for the NumPy character n-gram language model."""
+
+    def test_train_predict_and_roundtrip(self):
+        """Test batch prediction and that a saved model loads back with the same answers."""
+        model = CharNgramLanguageModel.train({
+            "uz_latin": ["salom qalaysiz yaxshimisiz", "rahmat katta rahmat"],
+            "uz_cyrillic": ["салом қалайсиз яхшимисиз", "раҳмат катта раҳмат"],
+            "russian": ["привет как дела", "спасибо большое"],
+            "english": ["hello how are you", "thank you very much"],
+        })
+        texts = ["salom rahmat", "раҳмат салом", "спасибо привет", "thank you hello"]
+
+        predictions = model.predict(texts)
+        self.assertEqual([label for label, _ in predictions], list(CharNgramLanguageModel.LANGUAGES))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.npy")
+            model.save(path)
+            loaded = CharNgramLanguageModel.load(path)
+        self.assertEqual([label for label, _ in loaded.predict(texts)], list(CharNgramLanguageModel.LANGUAGES))
+        self.assertEqual(model.predict([]), [])
+
+    def test_rejects_wrong_shape(self):
+        """Test that a matrix of the wrong shape is refused."""
+        with self.assertRaises(ValueError):
+            CharNgramLanguageModel([[0.0] * 10])
+
+    def test_shipped_model_sets_uzbek_preference_for_cyrillic(self):
+        """Test that confident Cyrillic Uzbek sets a preference without keyword hits."""
+        self.assertIsNotNone(telegram.get_language_model())
+        label, confidence = telegram.get_language_model().identify("Салом, хизматлар ҳақида маълумот беринг")
+        self.assertEqual(label, "uz_cyrillic")
+
+        prefs = LanguagePreferences()
+        with patch('telegram.language_preferences', prefs):
+            self.assertEqual(resolve_language(3, "Салом, хизматлар ҳақида маълумот беринг"), "uzbek")
+            self.assertEqual(resolve_language(4, "Hello"), "uzbek")
+        self.assertEqual(prefs.get(3), "uzbek")
+        self.assertIsNone(prefs.get(4))
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test suite for the AI response cache."""
+
+    def setUp(self):
+        """Set up a fresh cache and a fake Groq client."""
+        self.cache = ResponseCache(max_size=2, ttl=60)
+        self.groq = MagicMock()
+        self.groq.chat.completions.create.return_value.choices = [MagicMock()]
+        self.groq.chat.completions.create.return_value.choices[0].message.content = "Salom Ali! Narxlar loyihaga bog'liq."
+        patcher = patch.multiple('telegram', groq_client=self.groq, ai_response_cache=self.cache, semantic_cache=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_repeated_question_is_served_from_cache(self):
+        """Test that a normalized repeat skips Groq and is personalized for the new user."""
+        first = get_ai_response("Narxlar qancha?", "Ali", "uzbek")
+        second = get_ai_response("  narxlar   QANCHA ", "Vali", "uzbek")
+
+        self.assertEqual(first, "Salom Ali! Narxlar loyihaga bog'liq.")
+        self.assertEqual(second, "Salom Vali! Narxlar loyihaga bog'liq.")
+        self.assertEqual(self.groq.chat.completions.create.call_count, 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_knowledge_base_names_are_not_swapped(self):
+        """Test that an asker named like a team member does not rewrite the team list for others."""
+        self.groq.chat.completions.create.return_value.choices[0].message.content = (
+            "Salom Otabek! Otabek Ahmadjonov — Team Lead, backend dasturchi."
+        )
+        get_ai_response("Jamoa a'zolari kimlar?", "Otabek", "uzbek")
+        answer = get_ai_response("Jamoa a'zolari kimlar?", "Sara", "uzbek")
+
+        self.assertNotIn("Sara Ahmadjonov", answer)
+        self.assertEqual(self.groq.chat.completions.create.call_count, 2)
+        self.assertEqual(ResponseCache.depersonalize("Salom Alisher! Ali", "Ali"), "Salom Alisher! \x00user_name\x00")
+
+    def test_language_and_knowledge_base_are_part_of_the_key(self):
+        """Test that another language or knowledge-base version misses."""
+        get_ai_response("Narxlar qancha?", "Ali", "uzbek")
+        get_ai_response("Narxlar qancha?", "Ali", "english")
+        with patch('telegram._knowledge_base_version', 'changed'):
+            get_ai_response("Narxlar qancha?", "Ali", "uzbek")
+
+        self.assertEqual(self.groq.chat.completions.create.call_count, 3)
+
+    def test_fallback_is_not_cached(self):
+        """Test that an error reply is never stored."""
+        self.groq.chat.completions.create.side_effect = Exception("rate limited")
+        get_ai_response("Narxlar qancha?", "Ali", "uzbek")
+
+        self.assertEqual(len(self.cache), 0)
+
+    def test_size_cap_and_ttl(self):
+        """Test LRU eviction and expiry."""
+        for question in ("a savol", "b savol", "c savol"):
+            self.cache.put(question, "uzbek", "javob")
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get("a savol", "uzbek"))
+
+        expired = ResponseCache(ttl=0)
+        expired.put("savol", "uzbek", "javob")
+        self.assertIsNone(expired.get("savol", "uzbek"))
+
+
+class TestSemanticCache(unittest.TestCase):
+    """Test suite for the paraphrase answer cache."""
+
+    def setUp(self):
+        """Set up a small paraphrase cache."""
+        self.cache = SemanticCache(capacity=2, ttl=60)
+
+    def test_paraphrase_hits_and_different_question_misses(self):
+        """Test that a close paraphrase is served and an unrelated question is not."""
+        self.cache.put("Where is your office?", "english", "In Fergana, Ali.", user_name="Ali")
+
+        self.assertEqual(self.cache.get("Where is your office located?", "english", "Vali"), "In Fergana, Vali.")
+        self.assertIsNone(self.cache.get("Where is your office located?", "uzbek"))
+        self.assertIsNone(self.cache.get("Telegram bot narxi qancha", "english"))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_inflected_paraphrase_hits(self):
+        """Test that inflections and price synonyms share a key."""
+        self.cache.put("mobil ilova narxi", "uzbek", "narx")
+
+        self.assertEqual(self.cache.get("mobil ilovalar qancha turadi", "uzbek"), "narx")
+
+    def test_near_misses_are_not_served(self):
+        """Test that questions differing in one content word or in word order miss."""
+        cache = SemanticCache(capacity=8, ttl=60)
+        cache.put("Do you develop iOS applications?", "english", "iOS")
+        cache.put("is a website cheaper than a mobile app", "english", "website")
+        cache.put("mobil ilova narxi qancha", "uzbek", "ilova")
+        cache.put("Who are you?", "english", "bot")
+
+        self.assertIsNone(cache.get("Do you develop Android applications?", "english"))
+        self.assertIsNone(cache.get("is a mobile app cheaper than a website", "english"))
+        self.assertIsNone(cache.get("veb sayt narxi qancha", "uzbek"))
+        self.assertIsNone(cache.get("who are you", "english"))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get("Do you build iOS apps", "english"), "iOS")
+
+    def test_capacity_evicts_least_recently_used(self):
+        """Test that a full cache replaces its least recently used question."""
+        self.cache.put("mobil ilova narxi qancha", "uzbek", "ilova")
+        self.cache.put("veb sayt narxi qancha", "uzbek", "sayt")
+        self.cache.get("mobil ilova narxi qancha", "uzbek")
+        self.cache.put("telegram bot narxi qancha", "uzbek", "bot")
+
+        self.assertEqual(self.cache.stats()["size"], 2)
+        self.assertEqual(self.cache.get("mobil ilova narxi qancha", "uzbek"), "ilova")
+        self.assertIsNone(self.cache.get("veb sayt narxi qancha", "uzbek"))
+
+    def test_groq_is_skipped_for_paraphrases(self):
+        """Test that get_ai_response answers a paraphrase without calling Groq."""
+        groq = MagicMock()
+        groq.chat.completions.create.return_value.choices = [MagicMock()]
+        groq.chat.completions.create.return_value.choices[0].message.content = "Xizmatlar ro'yxati"
+        with patch.multiple('telegram', groq_client=groq, ai_response_cache=None, semantic_cache=self.cache):
+            get_ai_response("what services do you offer?", "Ali", "english")
+            answer = get_ai_response("Which services do you offer", "Ali", "english")
+
+        self.assertEqual(answer, "Xizmatlar ro'yxati")
+        self.assertEqual(groq.chat.completions.create.call_count, 1)
+
+
+class TestKnowledgeBaseIndex(unittest.TestCase):
+    """Test suite for knowledge-base retrieval in AI prompts."""
+
+    def test_relevant_sections_are_selected(self):
+        """Test that Uzbek and English questions retrieve the matching section."""
+        index = telegram.get_knowledge_index()
+        titles = lambda question: [index.sections[i][0] for i in index.top_sections(question, 3)]
+
+        self.assertEqual(titles("Manzilingiz qayerda?"), ["CONTACT INFORMATION"])
+        self.assertEqual(titles("Jamoa a'zolari kimlar?"), ["TEAM MEMBERS"])
+        self.assertIn("CORE SERVICES", titles("What services do you offer?"))
+
+    def test_no_overlap_falls_back_to_full_knowledge_base(self):
+        """Test that a question sharing no terms gets the whole knowledge base."""
+        self.assertEqual(telegram.get_knowledge_index().context("Salom", 3), telegram.get_company_knowledge_base())
+
+    def test_prompt_carries_only_retrieved_sections(self):
+        """Test that the Groq system prompt is limited to the relevant sections."""
+        groq = MagicMock()
+        groq.chat.completions.create.return_value.choices = [MagicMock()]
+        groq.chat.completions.create.return_value.choices[0].message.content = "Farg'ona"
+        with patch.multiple('telegram', groq_client=groq, ai_response_cache=None, semantic_cache=None):
+            get_ai_response("Manzilingiz qayerda?", "Ali", "uzbek")
+
+        system_prompt = groq.chat.completions.create.call_args[1]['messages'][0]['content']
+        self.assertIn("Ahmad Al-Fergani Shah Street", system_prompt)
+        self.assertNotIn("TEAM MEMBERS", system_prompt)
+        self.assertIn("FAQAT o'zbek tilida", system_prompt)
+
+
+class TestStreamingReply(unittest.TestCase):
+    """Test suite for streamed AI replies."""
+
+    def setUp(self):
+        """Set up a fake Bot API and clock."""
+        self.calls = []
+        self.now = [0.0]
+
+        def fake_call(method, payload=None, **kwargs):
+            self.calls.append((method, dict(payload)))
+            return {"ok": True, "result": {"message_id": 77}}
+
+        patcher = patch('telegram.bot_api.call', side_effect=fake_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_sentence_then_rate_limited_edits(self):
+        """Test that the first sentence is sent and later text is edited at the cadence."""
+        reply = StreamingReply(12345, interval=1.0, clock=lambda: self.now[0])
+        reply.update("Salom")
+        reply.update("Salom! Biz")
+        reply.update("Salom! Biz sayt yaratamiz.")
+        self.now[0] = 1.5
+        reply.update("Salom! Biz sayt yaratamiz. Va")
+        reply.finish("Salom! Biz sayt yaratamiz. Va ilovalar. CTA")
+
+        self.assertEqual(self.calls, [
+            ("sendMessage", {"chat_id": 12345, "text": "Salom!"}),
+            ("editMessageText", {"chat_id": 12345, "message_id": 77, "text": "Salom! Biz sayt yaratamiz."}),
+            ("editMessageText", {"chat_id": 12345, "message_id": 77, "text": "Salom! Biz sayt yaratamiz. Va ilovalar. CTA"}),
+        ])
+
+    def test_finish_waits_for_a_send_in_flight(self):
+        """Test that a fallback after the deadline edits the streamed message instead of sending a second one."""
+        in_flight, release = threading.Event(), threading.Event()
+
+        def slow_call(method, payload=None, **kwargs):
+            if method == "sendMessage":
+                in_flight.set()
+                release.wait(5)
+            self.calls.append((method, dict(payload)))
+            return {"ok": True, "result": {"message_id": 77}}
+
+        reply = StreamingReply(12345, interval=0.0)
+        with patch('telegram.bot_api.call', side_effect=slow_call):
+            streamer = threading.Thread(target=reply.update, args=("Biz sayt yaratamiz. Narx",))
+            streamer.start()
+            self.assertTrue(in_flight.wait(5))
+            finisher = threading.Thread(target=reply.finish, args=("Fallback",))
+            finisher.start()
+            release.set()
+            streamer.join(5)
+            finisher.join(5)
+            reply.update("Biz sayt yaratamiz. Narxi kelishiladi.")
+
+        self.assertEqual([method for method, _ in self.calls], ["sendMessage", "editMessageText"])
+        self.assertEqual(self.calls[-1][1]["text"], "Fallback")
+
+    def test_finish_does_not_wait_past_the_deadline(self):
+        """Test that finish() returns at the deadline and the in-flight send then shows the final text."""
+        in_flight, release = threading.Event(), threading.Event()
+
+        def slow_call(method, payload=None, **kwargs):
+            if method == "sendMessage":
+                in_flight.set()
+                release.wait(5)
+            self.calls.append((method, dict(payload)))
+            return {"ok": True, "result": {"message_id": 77}}
+
+        reply = StreamingReply(12345, interval=0.0)
+        with patch('telegram.bot_api.call', side_effect=slow_call):
+            streamer = threading.Thread(target=reply.update, args=("Biz sayt yaratamiz. Narx",))
+            streamer.start()
+            self.assertTrue(in_flight.wait(5))
+            started = time.monotonic()
+            with invocation_budget(0.1):
+                reply.finish("Fallback")
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(self.calls, [])
+
+            reply.update("Biz sayt yaratamiz. Narxi kelishiladi.")
+            release.set()
+            streamer.join(5)
+
+        self.assertEqual([method for method, _ in self.calls], ["sendMessage", "editMessageText"])
+        self.assertEqual(self.calls[-1][1]["text"], "Fallback")
+
+    def test_lock_is_free_during_bot_api_calls(self):
+        """Test that a slow or retried call does not hold the reply's lock, and overlapping updates are skipped."""
+        in_flight, release, lock_free = threading.Event(), threading.Event(), []
+        reply = StreamingReply(12345, interval=0.0)
+
+        def slow_call(method, payload=None, **kwargs):
+            in_flight.set()
+            release.wait(5)
+            self.calls.append((method, dict(payload)))
+            return {"ok": True, "result": {"message_id": 77}}
+
+        with patch('telegram.bot_api.call', side_effect=slow_call):
+            streamer = threading.Thread(target=reply.update, args=("Biz sayt yaratamiz. Narx",))
+            streamer.start()
+            self.assertTrue(in_flight.wait(5))
+            lock_free.append(reply._idle.acquire(timeout=1))
+            reply._idle.release()
+            reply.update("Biz sayt yaratamiz. Narxi kelishiladi.")
+            release.set()
+            streamer.join(5)
+
+        self.assertEqual(lock_free, [True])
+        self.assertEqual([method for method, _ in self.calls], ["sendMessage"])
+
+    def test_groq_thread_inherits_the_invocation_budget(self):
+        """Test that streamed Bot API calls made on the Groq thread see the caller's deadline."""
+        seen = []
+        groq = MagicMock()
+        chunk = MagicMock()
+        chunk.choices[0].delta.content = "Biz sayt yaratamiz."
+        groq.chat.completions.create.return_value = iter([chunk])
+
+        with patch.multiple('telegram', groq_client=groq, ai_response_cache=None, semantic_cache=None):
+            with invocation_budget(5):
+                get_ai_response("sayt kerak", "Ali", "uzbek", on_text=lambda text: seen.append(telegram.remaining_budget()))
+
+        self.assertEqual(len(seen), 1)
+        self.assertIsNotNone(seen[0])
+        self.assertLessEqual(seen[0], 5)
+
+    def test_streamed_answer_ends_with_suffixes(self):
+        """Test that send_ai_reply streams from Groq and the final edit carries the CTA."""
+        groq = MagicMock()
+        chunks = []
+        for piece in ["Biz ", "sayt yaratamiz.", " Narxi kelishiladi."]:
+            chunk = MagicMock()
+            chunk.choices[0].delta.content = piece
+            chunks.append(chunk)
+        groq.chat.completions.create.return_value = iter(chunks)
+
+        with patch.multiple('telegram', groq_client=groq, ai_response_cache=None, semantic_cache=None,
+                            AI_STREAMING_ENABLED=True, send_typing_action=MagicMock()):
+            telegram.send_ai_reply(12345, "sayt kerak", "Ali", "uzbek", lambda answer: answer + " CTA")
+
+        self.assertTrue(groq.chat.completions.create.call_args[1]["stream"])
+        self.assertEqual(self.calls[0], ("sendMessage", {"chat_id": 12345, "text": "Biz sayt yaratamiz."}))
+        self.assertEqual(self.calls[-1][0], "editMessageText")
+        self.assertEqual(self.calls[-1][1]["text"], "Biz sayt yaratamiz. Narxi kelishiladi. CTA")
+
+
+class TestAiDeadline(unittest.TestCase):
+    """Test suite for deadline-bounded Groq calls."""
+
+    def setUp(self):
+        """Set up a Groq client that stalls until released."""
+        self.release = threading.Event()
+        self.groq = MagicMock()
+
+        def stalled_create(**kwargs):
+            self.release.wait(2)
+            completion = MagicMock()
+            completion.choices[0].message.content = "Late answer"
+            return completion
+
+        self.groq.chat.completions.create.side_effect = stalled_create
+        self.cache = ResponseCache()
+        patcher = patch.multiple('telegram', groq_client=self.groq, ai_response_cache=self.cache,
+                                 semantic_cache=None, AI_DEADLINE_SECONDS=0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.release.set)
+
+    def test_faq_answer_on_deadline_and_late_answer_cached(self):
+        """Test that a stalled call gets the intent's FAQ answer and the late answer is cached."""
+        answer = get_ai_response("Mobil ilova kerak", "Ali", "uzbek")
+        self.assertEqual(answer, telegram.FAQ_ANSWERS[Intent.SERVICE]["uzbek"])
+
+        self.release.set()
+        for _ in range(100):
+            if len(self.cache):
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(get_ai_response("Mobil ilova kerak", "Ali", "uzbek"), "Late answer")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_localized_fallback_without_intent(self):
+        """Test that the localized fallback message is used when nothing better exists."""
+        answer = get_ai_response("Muhammadaziz kim?", "Ali", "english")
+        self.assertIn("I'm having trouble processing your request", answer)
+
+    def test_deadline_leaves_time_to_reply(self):
+        """Test that the deadline is cut to the invocation budget minus the reply reserve."""
+        with patch.multiple('telegram', AI_DEADLINE_SECONDS=7, AI_REPLY_RESERVE_SECONDS=2):
+            self.assertEqual(telegram.ai_deadline(), 7)
+            with invocation_budget(5):
+                self.assertLessEqual(telegram.ai_deadline(), 3)
+            with invocation_budget(1):
+                self.assertEqual(telegram.ai_deadline(), 0)
+
+
+class TestSessionStore(unittest.TestCase):
+    """Test suite for the pluggable session stores."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sessions.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_session_table_round_trip(self):
+        """Test that the in-memory table stores sessions as compact records."""
+        table = SessionTable()
+        lead = {'state': 'collecting_phone', 'project': 'Bot', 'name': 'Ali', 'phone': '', 'email': ''}
+
+        table.set(1, lead)
+        self.assertEqual(table.get_many([1, 2]), {1: lead})
+        self.assertEqual(table[1]['state'], 'collecting_phone')
+        self.assertNotIn(2, table)
+        self.assertFalse(hasattr(table._records[1], '__dict__'))
+        self.assertEqual(table.pop(1), lead)
+        self.assertIsNone(table.get(1))
+
+    def test_session_table_counts_messages(self):
+        """Test that message counts survive state changes and are kept as epoch seconds."""
+        clock = Mock(return_value=1000.0)
+        table = SessionTable(clock=clock)
+
+        table.record_message(1)
+        table.set(1, {'state': 'collecting_project', 'project': ''})
+        stats = table.record_message(1)
+
+        self.assertEqual(stats['message_count'], 2)
+        self.assertEqual(stats['last_interaction'], 1000.0)
+        self.assertEqual(stats['state'], 'collecting_project')
+
+    def test_session_table_evicts_idle_chats(self):
+        """Test that idle chats expire while an order in progress is kept."""
+        now = [0.0]
+        table = SessionTable(idle_ttl=60, lead_ttl=600, clock=lambda: now[0])
+        table.record_message(1)
+        table.set(2, {'state': 'collecting_name', 'project': 'Bot'})
+
+        now[0] = 120.0
+        table.record_message(3)
+
+        self.assertEqual(set(table._records), {2, 3})
+        now[0] = 700.0
+        self.assertIsNone(table.get(2))
+
+    def test_session_table_size_cap_spares_leads(self):
+        """Test that the size cap evicts the oldest idle chats but not leads."""
+        table = SessionTable(max_size=3, idle_ttl=3600, lead_ttl=3600)
+        table.set(1, {'state': 'collecting_email', 'project': 'Bot'})
+        for chat_id in range(2, 7):
+            table.record_message(chat_id)
+
+        self.assertEqual(len(table), 3)
+        self.assertIn(1, table)
+        self.assertEqual(set(table._records), {1, 5, 6})
+        self.assertEqual(table.stats()["evictions"], 3)
+
+    def test_sqlite_store_is_shared_between_connections(self):
+        """Test that two processes' connections to one WAL file see the same sessions."""
+        first = SQLiteSessionStore(self.path, ttl=60)
+        second = SQLiteSessionStore(self.path, ttl=60)
+        try:
+            first.set(10, {'state': 'collecting_name', 'project': 'Bot'})
+            first.set(11, {'state': 'normal'})
+
+            self.assertEqual(second.get(10), {'state': 'collecting_name', 'project': 'Bot'})
+            self.assertEqual(set(second.get_many([10, 11, 12])), {10, 11})
+            mode = second._conn.execute("PRAGMA journal_mode").fetchone()[0]
+            self.assertEqual(mode, "wal")
+        finally:
+            first.close()
+            second.close()
+
+    def test_sqlite_sessions_expire(self):
+        """Test that sessions past their TTL are not returned and can be purged."""
+        store = SQLiteSessionStore(self.path, ttl=-1)
+        try:
+            store.set(1, {'state': 'normal'})
+            self.assertIsNone(store.get(1))
+            self.assertEqual(store.purge_expired(), 1)
+        finally:
+            store.close()
+
+    def test_sqlite_store_purges_while_writing(self):
+        """Test that expired rows are deleted every purge_every writes without an explicit purge."""
+        store = SQLiteSessionStore(self.path, ttl=-1, purge_every=3)
+        try:
+            for chat_id in range(5):
+                store.set(chat_id, {'state': 'normal'})
+            count = lambda: store._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            self.assertEqual(count(), 2)
+            store.set(5, {'state': 'normal'})
+            self.assertEqual(count(), 0)
+        finally:
+            store.close()
+
+    def test_redis_store_batches_reads(self):
+        """Test that get_many reads every chat with a single MGET."""
+        server = FakeRedisServer().start()
+        try:
+            store = RedisSessionStore(RedisClient(server.url), ttl=60)
+            store.set(1, {'state': 'collecting_email', 'name': 'Ali'})
+            store.set(2, {'state': 'normal'})
+            server.commands.clear()
+
+            sessions = store.get_many([1, 2, 3])
+
+            self.assertEqual(sessions, {1: {'state': 'collecting_email', 'name': 'Ali'}, 2: {'state': 'normal'}})
+            self.assertEqual(server.commands, ["MGET"])
+        finally:
+            server.stop()
+
+    def test_cache_is_write_through(self):
+        """Test that writes reach the backend and repeated reads stay local."""
+        backend = SessionTable()
+        backend.get_many = Mock(wraps=backend.get_many)
+        store = CachedSessionStore(backend, ttl=60)
+
+        store.set(1, {'state': 'normal'})
+        self.assertEqual(backend._records[1].to_dict(), {'state': 'normal'})
+        self.assertIsNone(store.get(2))
+        self.assertIsNone(store.get(2))
+        self.assertEqual(store.get(1), {'state': 'normal'})
+
+        backend.get_many.assert_called_once_with([2])
+        self.assertEqual(store.stats()["hits"], 2)
+
+    def test_cache_survives_backend_errors(self):
+        """Test that an unreachable backend falls back to the local copies."""
+        backend = Mock()
+        backend.set.side_effect = OSError("down")
+        backend.get_many.side_effect = OSError("down")
+        store = CachedSessionStore(backend, ttl=0)
+
+        store.set(1, {'state': 'collecting_name'})
+
+        self.assertEqual(store.get(1), {'state': 'collecting_name'})
+        self.assertIsNone(store.get(2))
+        self.assertEqual(store.stats()["errors"], 3)
+
+    @patch('telegram.send_telegram_message')
+    def test_lead_flow_continues_on_another_instance(self, mock_send):
+        """Test that an /order started on one instance continues on another."""
+        server = FakeRedisServer().start()
+        try:
+            first = CachedSessionStore(RedisSessionStore(RedisClient(server.url)))
+            second = CachedSessionStore(RedisSessionStore(RedisClient(server.url)))
+
+            with patch('telegram.session_store', first):
+                telegram.start_lead_collection(77001)
+            with patch('telegram.session_store', second):
+                telegram.handle_lead_collection(77001, "Internet do'kon", {})
+
+            self.assertEqual(second.get(77001)['state'], telegram.UserState.COLLECTING_NAME)
+            self.assertEqual(second.get(77001)['project'], "Internet do'kon")
+        finally:
+            server.stop()
+
+
+class TestLeadOutbox(unittest.TestCase):
+    """Test suite for the durable lead outbox and its drainer."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "leads.db")
+        self.outbox = LeadOutbox(self.path, retry_base_delay=60, max_attempts=3)
+
+    def tearDown(self):
+        self.outbox.close()
+        self.tmpdir.cleanup()
+
+    def test_leads_survive_reopening(self):
+        """Test that a saved lead is still pending after the process restarts."""
+        self.outbox.add("lead one", 3189)
+        reopened = LeadOutbox(self.path)
+        try:
+            self.assertEqual([row[1:] for row in reopened.due()], [("lead one", "3189", 0)])
+        finally:
+            reopened.close()
+
+    def test_delivered_leads_are_stamped(self):
+        """Test that delivery marks the entry instead of deleting it."""
+        send = Mock(return_value=True)
+        drainer = LeadDrainer(self.outbox, send=send)
+        self.outbox.add("lead one", 3189)
+
+        self.assertEqual(drainer.drain_once(), 1)
+
+        send.assert_called_once_with("lead one", "3189")
+        self.assertEqual(self.outbox.due(), [])
+        self.assertEqual(self.outbox.stats(), {"total": 1, "delivered": 1, "pending": 0, "failed": 0})
+
+    def test_failures_are_retried_with_backoff(self):
+        """Test that a failed delivery is rescheduled and given up after max attempts."""
+        send = Mock(side_effect=[False, requests.exceptions.ConnectionError("down"), False])
+        drainer = LeadDrainer(self.outbox, send=send)
+        lead_id = self.outbox.add("lead one")
+
+        self.assertEqual(drainer.drain_once(), 0)
+        self.assertEqual(self.outbox.due(), [])
+        self.assertGreater(self.outbox.next_attempt(), time.time() + 50)
+
+        for _ in range(2):
+            self.outbox._conn.execute("UPDATE leads SET next_attempt = 0 WHERE id = ?", (lead_id,))
+            drainer.drain_once()
+
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(self.outbox.stats()["failed"], 1)
+        self.assertIsNone(self.outbox.next_attempt())
+
+    def test_background_delivery(self):
+        """Test that wake() delivers queued leads on the drainer thread."""
+        delivered = threading.Event()
+        drainer = LeadDrainer(self.outbox, send=lambda message, topic_id: delivered.set() or True)
+        self.outbox.add("lead one")
+
+        try:
+            drainer.wake()
+            self.assertTrue(delivered.wait(5))
+        finally:
+            drainer.stop(5)
+
+    @patch('telegram.send_telegram_message')
+    def test_user_is_confirmed_before_delivery(self, mock_send):
+        """Test that the last lead step saves the lead and confirms without waiting for the group."""
+        send = Mock(return_value=True)
+        drainer = LeadDrainer(self.outbox, send=send)
+        drainer.background = True
+        drainer.wake = Mock()
+        chat_id = 77101
+        telegram.user_states[chat_id] = {'state': telegram.UserState.COLLECTING_EMAIL, 'project': 'Bot',
+                                         'name': 'Ali', 'phone': '+998901234567'}
+        try:
+            with patch('telegram.lead_drainer', drainer):
+                telegram.handle_lead_collection(chat_id, "ali@example.com", {"id": 1, "first_name": "Ali"})
+
+            self.assertIn("Rahmat", mock_send.call_args[0][1])
+            self.assertEqual(telegram.user_states[chat_id]['state'], telegram.UserState.NORMAL)
+            send.assert_not_called()
+            drainer.wake.assert_called_once()
+            (_, message, topic_id, _), = self.outbox.due()
+            self.assertIn("ali@example.com", message)
+            self.assertEqual(topic_id, str(telegram.TELEGRAM_TOPIC_ID))
+        finally:
+            telegram.user_states.pop(chat_id, None)
+
+    def test_webhook_mode_delivers_within_the_invocation(self):
+        """Test that without a long-lived runner the lead is posted before queue_lead returns."""
+        send = Mock(side_effect=[False, True, True])
+        drainer = LeadDrainer(self.outbox, send=send)
+        drainer.wake = Mock()
+
+        with patch('telegram.lead_drainer', drainer):
+            self.assertTrue(telegram.queue_lead("lead one", 3189))
+            send.assert_called_once_with("lead one", "3189")
+            self.assertEqual(self.outbox.stats()["pending"], 1)
+
+            self.outbox._conn.execute("UPDATE leads SET next_attempt = 0")
+            self.assertTrue(telegram.queue_lead("lead two"))
+
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(self.outbox.stats()["delivered"], 2)
+        self.assertEqual(drainer.wake.call_count, 2)
+
+    def test_webhook_mode_confirms_user_before_posting_lead(self):
+        """Test that with background=False the confirmation is sent before the lead goes to the group."""
+        sent = []
+        drainer = LeadDrainer(self.outbox, send=lambda message, topic_id: sent.append("group") or True)
+        drainer.wake = Mock()
+        chat_id = 77102
+        telegram.user_states[chat_id] = {'state': telegram.UserState.COLLECTING_EMAIL, 'project': 'Bot',
+                                         'name': 'Ali', 'phone': '+998901234567'}
+        message = {"chat": {"id": chat_id, "type": "private"}, "from": {"id": 1, "first_name": "Ali"},
+                   "text": "ali@example.com"}
+
+        def fake_call(method, payload=None, **kwargs):
+            sent.append((method, payload["chat_id"]))
+            return {"ok": True, "result": {}}
+
+        try:
+            with patch('telegram.lead_drainer', drainer), \
+                    patch('telegram.bot_api.call', side_effect=fake_call), patch('telegram.BOT_TOKEN', 'token'):
+                self.assertFalse(drainer.background)
+                handle_message(message)
+
+            self.assertEqual(sent, [("sendMessage", chat_id), "group"])
+            self.assertEqual(self.outbox.stats()["delivered"], 1)
+        finally:
+            telegram.user_states.pop(chat_id, None)
+
+    def test_every_webhook_wakes_the_drainer(self):
+        """Test that pending retries get a chance on each invocation, not only when a lead arrives."""
+        drainer = Mock()
+        handler = object.__new__(Handler)
+        handler.send_response = Mock()
+        handler.send_header = Mock()
+        handler.end_headers = Mock()
+        handler.wfile = Mock()
+        handler.headers = {}
+
+        with patch('telegram.lead_drainer', drainer):
+            handler.do_POST()
+
+        drainer.wake.assert_called_once()
+
+
+class TestLazyLoading(unittest.TestCase):
+    """Test suite for deferred imports on the cold-start path."""
+
+    def test_lazy_module_imports_on_first_use(self):
+        """Test that a LazyModule imports its module only when an attribute is read."""
+        sys.modules.pop("colorsys", None)
+        module = telegram.LazyModule("colorsys")
+
+        self.assertFalse(module.loaded)
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(module.rgb_to_hsv(0, 0, 0), (0.0, 0.0, 0.0))
+        self.assertTrue(module.loaded)
+
+    def test_import_skips_heavy_dependencies(self):
+        """Test that importing the webhook module does not import requests, NumPy or Groq."""
+        code = ("import sys; sys.path.insert(0, 'api'); import telegram; "
+                "print(','.join(m for m in ('requests', 'numpy', 'groq') if m in sys.modules))")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+        self.assertEqual(result.stdout.strip(), "")
+
+    def test_groq_client_is_created_on_demand(self):
+        """Test that a configured client is used as is and a missing one is reported without importing."""
+        client = Mock()
+        with patch('telegram.groq_client', client):
+            self.assertIs(telegram.get_groq_client(), client)
+            self.assertTrue(telegram.ai_enabled())
+
+        with patch.multiple('telegram', groq_client=None, GROQ_API_KEY=None):
+            self.assertIsNone(telegram.get_groq_client())
+            self.assertFalse(telegram.ai_enabled())
+
+
+class TestReplyTemplates(unittest.TestCase):
+    """Test suite for pre-rendered static replies."""
+
+    def test_static_replies_are_not_rebuilt(self):
+        """Test that replies without a name are returned as the same pre-rendered string."""
+        first = reply_templates.render("info", "english")
+
+        self.assertIs(reply_templates.render("info", "english"), first)
+        self.assertEqual(first, add_cta_to_message(get_premiumsoft_info_english()))
+        self.assertIs(reply_templates.render(("help", True), "russian"), reply_templates.render(("help", True), "uzbek"))
+
+    def test_user_name_is_filled_in(self):
+        """Test that every occurrence of the name slot gets the user's name."""
+        templates = ReplyTemplates()
+        templates.register("hi", "uzbek", f"Salom {ReplyTemplates.USER_NAME}! {ReplyTemplates.USER_NAME}?")
+
+        self.assertEqual(templates.render("hi", "uzbek", "Ali"), "Salom Ali! Ali?")
+        self.assertIn("Salom Ali!", reply_templates.render("greeting", "uzbek", "Ali"))
+
+    def test_every_variant_is_registered(self):
+        """Test that each static reply exists in both languages and all variants."""
+        for key in ["info", "location", "greeting", "thanks",
+                    *[(name, flag) for name in ("start", "help", "hours", "ai") for flag in (True, False)]]:
+            self.assertIn(key, reply_templates)
+            for language in ("english", "uzbek"):
+                self.assertIn("🤝", reply_templates.render(key, language, "Ali"))
+
+    @patch('telegram.send_telegram_message')
+    def test_start_uses_current_ai_status(self, mock_send):
+        """Test that /start picks the AI status variant at request time."""
+        message = {"chat": {"id": 77201, "type": "private"}, "from": {"first_name": "Ali"}, "text": "/start"}
+        with patch('telegram.ai_enabled', return_value=False):
+            telegram.route_message(message)
+
+        text = mock_send.call_args[0][1]
+        self.assertTrue(text.startswith("👋 Salom Ali!"))
+        self.assertIn("❌ Mavjud emas", text)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test suite for latency histograms and the metrics endpoint."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        telegram.metrics.reset()
+
+    def test_histogram_buckets_are_contiguous(self):
+        """Test that every duration falls in the bucket whose bounds contain it."""
+        for micros in list(range(200)) + [999, 1000, 12345, 10**6, 3 * 10**7]:
+            index = LatencyHistogram.index(micros)
+            lower = LatencyHistogram.upper_bound(index - 1) if index else 0
+            self.assertLessEqual(lower, micros)
+            self.assertLess(micros, LatencyHistogram.upper_bound(index))
+
+    def test_quantiles_are_close(self):
+        """Test that quantiles stay within the histogram's relative error."""
+        histogram = LatencyHistogram()
+        for millis in range(1, 1001):
+            histogram.record(millis / 1000)
+
+        counts, count, total, maximum = histogram.snapshot()
+        self.assertEqual(count, 1000)
+        self.assertAlmostEqual(total, 500.5)
+        for q, expected in [(0.5, 0.5), (0.9, 0.9), (0.99, 0.99)]:
+            self.assertAlmostEqual(LatencyHistogram.quantile(counts, count, maximum, q), expected, delta=expected * 0.07)
+        below, everything = LatencyHistogram.cumulative(counts, (0.1, 10))
+        self.assertAlmostEqual(below, 100, delta=7)
+        self.assertEqual(everything, 1000)
+
+    def test_spans_and_timed_functions_are_recorded(self):
+        """Test that spans and decorated functions add one observation per call."""
+        metrics = Metrics(enabled=True)
+
+        @metrics.timed("work")
+        def work():
+            return 42
+
+        with metrics.span("block"):
+            pass
+        self.assertEqual(work(), 42)
+        self.assertEqual(work(), 42)
+        metrics.observe("sendMessage", 0.2, "telegram_bot_api_duration_seconds")
+
+        self.assertEqual(metrics.histogram("telegram_stage_duration_seconds", "work").count, 2)
+        self.assertEqual(metrics.histogram("telegram_stage_duration_seconds", "block").count, 1)
+        self.assertEqual(metrics.histogram("telegram_bot_api_duration_seconds", "sendMessage").max, 0.2)
+
+    def test_ai_response_stage_times_the_groq_call(self):
+        """Test that ai_response covers the Groq call and the cache lookup has its own stage."""
+        groq = MagicMock()
+
+        def slow_create(**kwargs):
+            time.sleep(0.2)
+            completion = MagicMock()
+            completion.choices[0].message.content = "Javob"
+            return completion
+
+        groq.chat.completions.create.side_effect = slow_create
+        with patch.multiple('telegram', groq_client=groq, ai_response_cache=ResponseCache(), semantic_cache=None,
+                            AI_STREAMING_ENABLED=False, send_telegram_message=MagicMock(),
+                            send_typing_action=MagicMock()):
+            telegram.send_ai_reply(12345, "sayt kerak", "Ali", "uzbek", lambda answer: answer)
+
+        stage = lambda name: telegram.metrics.histogram("telegram_stage_duration_seconds", name)
+        self.assertEqual(stage("ai_response").count, 1)
+        self.assertGreaterEqual(stage("ai_response").max, 0.2)
+        self.assertEqual(stage("ai_cache_lookup").count, 1)
+        self.assertLess(stage("ai_cache_lookup").max, 0.2)
+
+    def test_disabled_metrics_record_nothing(self):
+        """Test that METRICS_ENABLED=false turns spans and counters into no-ops."""
+        metrics = Metrics(enabled=False)
+        with metrics.span("block"):
+            pass
+        metrics.count("telegram_commands_total", "/start")
+
+        self.assertEqual(metrics.render(), [])
+
+    def test_render_prometheus_format(self):
+        """Test histogram, quantile and counter lines with escaped labels."""
+        metrics = Metrics(enabled=True)
+        metrics.observe("route", 0.003)
+        metrics.count("telegram_intents_total", 'say "hi"')
+
+        lines = metrics.render()
+        self.assertIn("# TYPE telegram_stage_duration_seconds histogram", lines)
+        self.assertIn('telegram_stage_duration_seconds_bucket{stage="route",le="0.0025"} 0', lines)
+        self.assertIn('telegram_stage_duration_seconds_bucket{stage="route",le="0.005"} 1', lines)
+        self.assertIn('telegram_stage_duration_seconds_bucket{stage="route",le="+Inf"} 1', lines)
+        self.assertIn('telegram_stage_duration_seconds_count{stage="route"} 1', lines)
+        self.assertIn('telegram_stage_duration_quantile_seconds{stage="route",quantile="0.5"} 0.003', lines)
+        self.assertIn('telegram_intents_total{intent="say \\"hi\\""} 1', lines)
+
+    @patch('telegram.send_telegram_message')
+    def test_messages_are_counted_per_command_and_intent(self, mock_send):
+        """Test that routed messages update the command and intent counters."""
+        for text in ["/start", "/start", "/unknown", "Manzilingiz qayerda?"]:
+            telegram.route_message({"chat": {"id": 77301, "type": "private"},
+                                    "from": {"first_name": "Ali"}, "text": text})
+
+        self.assertEqual(telegram.metrics.counter("telegram_commands_total", "/start"), 2)
+        self.assertEqual(telegram.metrics.counter("telegram_commands_total", "other"), 1)
+        self.assertEqual(telegram.metrics.counter("telegram_commands_total", "text"), 1)
+        self.assertEqual(telegram.metrics.counter("telegram_intents_total", "location"), 1)
+        self.assertEqual(telegram.metrics.histogram("telegram_stage_duration_seconds", "detect_language").count, 4)
+
+    def test_metrics_endpoint(self):
+        """Test that GET /api/telegram/metrics serves the Prometheus text format."""
+        telegram.metrics.observe("webhook", 0.01)
+        handler = object.__new__(Handler)
+        handler.send_response = Mock()
+        handler.send_header = Mock()
+        handler.end_headers = Mock()
+        handler.wfile = Mock()
+        handler.path = '/api/telegram/metrics'
+
+        handler.do_GET()
+
+        handler.send_response.assert_called_with(200)
+        handler.send_header.assert_called_with('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        body = handler.wfile.write.call_args[0][0].decode()
+        self.assertIn('telegram_stage_duration_seconds_count{stage="webhook"} 1', body)
+        self.assertIn('# TYPE telegram_sessions gauge', body)
+
+
+class TestIntentClassifier(unittest.TestCase):
+    """Test suite for the tokenizing intent classifier."""
+
+    def test_short_keywords_match_whole_words(self):
+        """Test that 'hi' does not fire inside other words."""
+        self.assertEqual(classify_intents("hi"), {Intent.GREETING})
+        self.assertEqual(classify_intents("Is this the one which works?"), set())
+
+    def test_stems_and_apostrophes(self):
+        """Test that inflected words and apostrophe variants are recognized."""
+        self.assertEqual(classify_intents("Manzilingiz qayerda?"), {Intent.LOCATION})
+        self.assertEqual(classify_intents("to‘xta"), {Intent.STOP})
+        self.assertEqual(classify_intents("Buyurtma bermoqchiman"), {Intent.ORDER, Intent.SERVICE})
+
+    @patch('telegram.send_telegram_message')
+    def test_phrases_consume_their_words(self, mock_send):
+        """Test that 'ishlab chiqish' in project details does not cancel an order."""
+        self.assertEqual(classify_intents("ishlab chiqish"), {Intent.SERVICE})
+
+        chat_id = 55501
+        telegram.user_states[chat_id] = {'state': telegram.UserState.COLLECTING_PROJECT}
+        try:
+            telegram.handle_lead_collection(chat_id, "Mobil ilova ishlab chiqish", {})
+            self.assertEqual(telegram.user_states[chat_id]['state'], telegram.UserState.COLLECTING_NAME)
+        finally:
+            telegram.user_states.pop(chat_id, None)
+
+
+class TestOutboundRateLimiter(unittest.TestCase):
+    """Test suite for the outbound token-bucket rate limiter."""
+
+    def setUp(self):
+        """Set up a limiter that records waits instead of sleeping."""
+        self.sleeps = []
+        self.limiter = OutboundRateLimiter(global_per_second=30, private_per_second=1, private_burst=2,
+                                           group_per_minute=20, lead_per_minute=20, sleep=self.sleeps.append)
+
+    def test_token_bucket_queues_excess(self):
+        """Test that reservations past capacity are queued, not refused."""
+        bucket = TokenBucket(rate=1, capacity=2)
+        now = bucket.updated
+
+        self.assertEqual(bucket.reserve(now), 0.0)
+        self.assertEqual(bucket.reserve(now), 0.0)
+        self.assertAlmostEqual(bucket.reserve(now), 1.0)
+        self.assertAlmostEqual(bucket.reserve(now), 2.0)
+
+    def test_private_chat_budget(self):
+        """Test that a private chat is throttled after its burst."""
+        for _ in range(3):
+            self.limiter.acquire("sendMessage", {"chat_id": 12345, "text": "x"})
+
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertAlmostEqual(self.sleeps[0], 1.0, places=1)
+        stats = self.limiter.stats()["private"]
+        self.assertEqual(stats["sends"], 3)
+        self.assertEqual(stats["throttled"], 1)
+
+    def test_chats_have_separate_budgets(self):
+        """Test that one chat's traffic does not throttle another chat."""
+        for chat_id in range(10):
+            self.limiter.acquire("sendMessage", {"chat_id": chat_id, "text": "x"})
+
+        self.assertEqual(self.sleeps, [])
+
+    @patch('telegram.TELEGRAM_CHAT_ID', '-100500')
+    @patch('telegram.TELEGRAM_TOPIC_ID', '77')
+    def test_group_and_lead_topic_budgets(self):
+        """Test that groups run at per-minute rates and the lead topic has its own bucket."""
+        for _ in range(4):
+            self.limiter.acquire("sendMessage", {"chat_id": -100500, "text": "x"})
+        self.limiter.acquire("sendMessage", {"chat_id": "-100500", "message_thread_id": 77, "text": "lead"})
+
+        stats = self.limiter.stats()
+        self.assertEqual(stats["group"]["throttled"], 1)
+        self.assertAlmostEqual(self.sleeps[0], 3.0, places=1)
+        self.assertEqual(stats["lead"]["throttled"], 0)
+
+    def test_waits_past_the_deadline_are_refused(self):
+        """Test that a send whose slot is after the invocation deadline fails instead of sleeping."""
+        with invocation_budget(10):
+            waits = [self.limiter.acquire("sendMessage", {"chat_id": -100600, "text": "x"}) for _ in range(8)]
+
+        self.assertEqual(waits[:3], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(waits[3], 3.0, places=1)
+        self.assertAlmostEqual(waits[5], 9.0, places=1)
+        self.assertEqual(waits[6:], [None, None])
+        self.assertTrue(all(wait < 10 for wait in self.sleeps))
+        stats = self.limiter.stats()["group"]
+        self.assertEqual((stats["sends"], stats["dropped"]), (6, 2))
+
+        # The refused slots were given back
+        self.assertAlmostEqual(self.limiter.acquire("sendMessage", {"chat_id": -100600, "text": "x"}), 12.0, places=1)
+
+    @patch('telegram.BOT_TOKEN', 'test_token')
+    def test_refused_send_is_not_posted(self):
+        """Test that the client reports a refused send as a failed result without calling Telegram."""
+        client = TelegramBotClient(rate_limiter=self.limiter, retry_policy=RetryPolicy(max_attempts=3))
+        client.session = Mock()
+        self.limiter.acquire = Mock(return_value=None)
+
+        result = client.call("sendMessage", {"chat_id": -100600, "text": "x"})
+
+        self.assertFalse(result["ok"])
+        client.session.post.assert_not_called()
+        self.limiter.acquire.assert_called_once()
+
+    def test_chat_actions_are_not_throttled(self):
+        """Test that only message sends consume budget."""
+        for _ in range(5):
+            self.limiter.acquire("sendChatAction", {"chat_id": 1, "action": "typing"})
+
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(self.limiter.stats(), {})
+
+
+class TestChatScheduler(unittest.TestCase):
+    """Test suite for the per-chat ordered scheduler."""
+
+    def test_same_chat_runs_in_order(self):
+        """Test that work for one chat never overlaps and keeps its order."""
+        scheduler = ChatScheduler(workers=4, max_pending=100, max_backlog_per_chat=100)
+        handled = []
+        running = []
+        overlaps = []
+
+        def work(item):
+            if running:
+                overlaps.append(item)
+            running.append(item)
+            threading.Event().wait(0.002)
+            handled.append(item)
+            running.pop()
+
+        for item in range(20):
+            self.assertTrue(scheduler.submit("chat", work, item))
+        scheduler.join(5)
+
+        self.assertEqual(handled, list(range(20)))
+        self.assertEqual(overlaps, [])
+
+    def test_different_chats_run_in_parallel(self):
+        """Test that a slow chat does not block other chats."""
+        scheduler = ChatScheduler(workers=2, max_pending=10, max_backlog_per_chat=10)
+        release = threading.Event()
+        done = threading.Event()
+
+        scheduler.submit(1, release.wait, 5)
+        scheduler.submit(2, done.set)
+
+        self.assertTrue(done.wait(2))
+        release.set()
+        scheduler.join(5)
+
+    def test_backlog_limits_and_metrics(self):
+        """Test bounded per-chat backlog and queue metrics."""
+        scheduler = ChatScheduler(workers=1, max_pending=10, max_backlog_per_chat=2)
+        release = threading.Event()
+
+        self.assertTrue(scheduler.submit(1, release.wait, 5))
+        self.assertTrue(scheduler.submit(1, lambda: None))
+        self.assertFalse(scheduler.submit(1, lambda: None))
+        self.assertTrue(scheduler.submit(2, lambda: None))
+
+        stats = scheduler.stats()
+        self.assertEqual(stats["pending"], 3)
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["max_chat_depth"], 2)
+
+        release.set()
+        scheduler.join(5)
+        stats = scheduler.stats()
+        self.assertEqual(stats["completed"], 3)
+        self.assertGreater(stats["wait_max_seconds"], 0.0)
+
+
+class TestUpdateWorkerPool(unittest.TestCase):
+    """Test suite for the ack-first update worker pool."""
+
+    def _update(self, update_id, chat_id=1):
+        return {"update_id": update_id, "message": {"chat": {"id": chat_id}}}
+
+    def test_updates_are_processed_in_background(self):
+        """Test that queued updates are handled by worker threads."""
+        handled = []
+        pool = UpdateWorkerPool(handled.append, workers=2, queue_size=10)
+
+        for update_id in range(5):
+            self.assertEqual(pool.submit(self._update(update_id, chat_id=update_id % 2)), "queued")
+        pool.join(5)
+
+        self.assertEqual(sorted(u["update_id"] for u in handled), [0, 1, 2, 3, 4])
+        self.assertEqual(pool.stats()["scheduler"]["completed"], 5)
+
+    def _blocked_pool(self, policy):
+        release = threading.Event()
+        handled = []
+
+        def handler(update):
+            release.wait(5)
+            handled.append(update)
+
+        pool = UpdateWorkerPool(handler, workers=1, queue_size=2, full_policy=policy, wait_timeout=0.05)
+        pool.submit(self._update(1))
+        pool.submit(self._update(2))
+        return pool, release, handled
+
+    def test_full_queue_drop_policy(self):
+        """Test that the drop policy discards updates when the queue is full."""
+        pool, release, handled = self._blocked_pool("drop")
+
+        self.assertEqual(pool.submit(self._update(3)), "dropped")
+        release.set()
+        pool.join(5)
+
+        self.assertEqual([u["update_id"] for u in handled], [1, 2])
+        self.assertEqual(pool.stats()["dropped"], 1)
+
+    def test_full_queue_reject_policy(self):
+        """Test that the reject policy reports the update as rejected."""
+        pool, release, handled = self._blocked_pool("reject")
+
+        self.assertEqual(pool.submit(self._update(3)), "rejected")
+        release.set()
+        pool.join(5)
+
+    def test_full_queue_wait_policy(self):
+        """Test that the wait policy holds the caller until there is room."""
+        pool, release, handled = self._blocked_pool("wait")
+        threading.Timer(0.02, release.set).start()
+        pool.wait_timeout = 5
+
+        self.assertEqual(pool.submit(self._update(3)), "queued")
+        pool.join(5)
+
+        self.assertEqual([u["update_id"] for u in handled], [1, 2, 3])
+
+
+class TestUpdateDeduplicator(unittest.TestCase):
+    """Test suite for update_id deduplication."""
+
+    def test_duplicate_update_ids_are_rejected(self):
+        """Test that a redelivered update_id is reported as seen."""
+        dedup = UpdateDeduplicator(ttl=60, max_size=10)
+
+        self.assertTrue(dedup.is_new(100))
+        self.assertFalse(dedup.is_new(100))
+        self.assertTrue(dedup.is_new(101))
+        self.assertEqual(dedup.duplicates, 1)
+
+    def test_cache_is_bounded(self):
+        """Test that the oldest ids are evicted past the size cap."""
+        dedup = UpdateDeduplicator(ttl=60, max_size=3)
+
+        for update_id in range(5):
+            dedup.is_new(update_id)
+
+        self.assertEqual(len(dedup), 3)
+        self.assertTrue(dedup.is_new(0))
+
+    def test_entries_expire(self):
+        """Test that ids are forgotten after the TTL."""
+        dedup = UpdateDeduplicator(ttl=0, max_size=10)
+
+        self.assertTrue(dedup.is_new(5))
+        self.assertTrue(dedup.is_new(5))
+
+    def test_shared_store_across_instances(self):
+        """Test that two instances sharing a Redis store see each other's updates."""
+        server = FakeRedisServer().start()
+        try:
+            first = UpdateDeduplicator(store=RedisDedupStore(RedisClient(server.url)))
+            second = UpdateDeduplicator(store=RedisDedupStore(RedisClient(server.url)))
+
+            self.assertTrue(first.is_new(42))
+            self.assertFalse(second.is_new(42))
+        finally:
+            server.stop()
+
+    def test_unreachable_store_falls_back_to_local(self):
+        """Test that store errors do not block update processing."""
+        store = Mock()
+        store.add_if_absent.side_effect = OSError("down")
+        dedup = UpdateDeduplicator(store=store)
+
+        self.assertTrue(dedup.is_new(1))
+        self.assertFalse(dedup.is_new(1))
+
+    def test_lost_reply_counts_as_new(self):
+        """Test that a SET NX whose reply is lost is not retried into a false duplicate."""
+        server = FakeRedisServer().start()
+        try:
+            client = RedisClient(server.url)
+            dedup = UpdateDeduplicator(store=RedisDedupStore(client))
+            client.execute("PING")
+            server.drop_replies = 1
+
+            self.assertTrue(dedup.is_new(44))
+            self.assertEqual(server.commands.count("SET"), 1)
+            self.assertEqual(dedup.duplicates, 0)
+            # The next command reconnects
+            self.assertEqual(client.execute("PING"), "PONG")
+        finally:
+            server.stop()
+
+    def test_forgotten_update_is_new_again(self):
+        """Test that forget() clears an update_id locally and in the shared store."""
+        server = FakeRedisServer().start()
+        try:
+            dedup = UpdateDeduplicator(store=RedisDedupStore(RedisClient(server.url)))
+
+            self.assertTrue(dedup.is_new(43))
+            dedup.forget(43)
+            self.assertTrue(dedup.is_new(43))
+            self.assertFalse(dedup.is_new(43))
+        finally:
+            server.stop()
+
+
+class TestPollingRunner(unittest.TestCase):
+    """Test suite for the long-polling runner."""
+
+    def _update(self, update_id, chat_id, text):
+        return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text}}
+
+    @patch('telegram.get_updates')
+    def test_poll_once_advances_offset(self, mock_get_updates):
+        """Test that the offset moves past the last processed update."""
+        handled = []
+        runner = PollingRunner(limit=10, timeout=0, workers=2, handler=handled.append)
+        mock_get_updates.return_value = {"ok": True, "result": [
+            self._update(880001, 1, "a"),
+            self._update(880002, 2, "b"),
+        ]}
+
+        self.assertEqual(runner.poll_once(), 2)
+        runner.scheduler.join(5)
+
+        self.assertEqual(runner.offset, 880003)
+        self.assertEqual(len(handled), 2)
+        mock_get_updates.assert_called_once_with(None, 10, 0)
+
+    def test_dispatch_keeps_per_chat_order(self):
+        """Test that updates from one chat run in order while chats run concurrently."""
+        handled = []
+        lock = threading.Lock()
+
+        def handler(update):
+            if update["message"]["chat"]["id"] == 1:
+                threading.Event().wait(0.01)
+            with lock:
+                handled.append(update["update_id"])
+
+        runner = PollingRunner(workers=4, handler=handler)
+        runner.dispatch([
+            self._update(881001, 1, "first"),
+            self._update(881002, 2, "other"),
+            self._update(881003, 1, "second"),
+            self._update(881004, 1, "third"),
+        ])
+        runner.scheduler.join(5)
+
+        chat_one = [u for u in handled if u in (881001, 881003, 881004)]
+        self.assertEqual(chat_one, [881001, 881003, 881004])
+        self.assertEqual(runner.dispatched, 4)
+
+    def test_dispatch_skips_duplicates(self):
+        """Test that redelivered updates are not processed twice."""
+        handled = []
+        runner = PollingRunner(workers=1, handler=handled.append)
+
+        runner.dispatch([self._update(882001, 1, "a")])
+        runner.dispatch([self._update(882001, 1, "a")])
+        runner.scheduler.join(5)
+
+        self.assertEqual(len(handled), 1)
+
+
 class TestTelegramHandler(unittest.TestCase):
     """Test suite for the Telegram webhook handler."""
 
@@ -113,6 +1740,8 @@ class TestTelegramHandler(unittest.TestCase):
         self.handler.wfile = Mock()
         self.handler.headers = {}
         self.handler.path = '/'
+        telegram.outbound_limiter.reset()
+        telegram.language_preferences.clear()
         
     @patch.dict(os.environ, {'TELEGRAM_BOT_TOKEN': 'test_token_123'})
     def test_do_get_basic(self):
@@ -137,9 +1766,10 @@ class TestTelegramHandler(unittest.TestCase):
         warning_found = any("WARNING: Bot token is not configured!" in call for call in write_calls)
         self.assertTrue(warning_found)
         
-    @patch('telegram.requests.post')
-    def test_webhook_setup(self, mock_post):
+    @patch('telegram.bot_api.session')
+    def test_webhook_setup(self, mock_session):
         """Test webhook setup functionality."""
+        mock_post = mock_session.post
         mock_response = Mock()
         mock_response.json.return_value = {"ok": True, "result": True}
         mock_post.return_value = mock_response
@@ -257,6 +1887,117 @@ class TestTelegramHandler(unittest.TestCase):
         self.assertEqual(call_args[0][0], 12345)
         self.assertIn("Hello TestUser", call_args[0][1])
         
+    @patch('telegram.bot_api.session')
+    @patch('telegram.WEBHOOK_REPLY_IN_RESPONSE', True)
+    @patch('telegram.BOT_TOKEN', 'test_token_123')
+    def test_do_post_reply_in_response(self, mock_session):
+        """Test that a single reply is returned in the webhook response body."""
+        update = {
+            "message": {
+                "chat": {"id": 12345},
+                "text": "/info",
+                "from": {"first_name": "TestUser"}
+            }
+        }
+
+        update_json = json.dumps(update)
+        self.handler.headers = {'Content-Length': str(len(update_json))}
+        self.handler.rfile = io.BytesIO(update_json.encode())
+
+        self.handler.do_POST()
+
+        mock_session.post.assert_not_called()
+        self.handler.send_header.assert_called_with('Content-Type', 'application/json')
+        body = json.loads(self.handler.wfile.write.call_args[0][0].decode())
+        self.assertEqual(body['method'], 'sendMessage')
+        self.assertEqual(body['chat_id'], 12345)
+        self.assertIn("PremiumSoft.uz", body['text'])
+
+    @patch('telegram.bot_api.session')
+    @patch('telegram.WEBHOOK_REPLY_IN_RESPONSE', True)
+    @patch('telegram.BOT_TOKEN', 'test_token_123')
+    def test_do_post_reply_in_response_sends_earlier_calls(self, mock_session):
+        """Test that earlier calls go through the client and the last one is the reply."""
+        mock_session.post.return_value.json.return_value = {"ok": True}
+        update = {
+            "message": {
+                "chat": {"id": 12345},
+                "text": "/location",
+                "from": {"first_name": "TestUser"}
+            }
+        }
+
+        update_json = json.dumps(update)
+        self.handler.headers = {'Content-Length': str(len(update_json))}
+        self.handler.rfile = io.BytesIO(update_json.encode())
+
+        self.handler.do_POST()
+
+        mock_session.post.assert_called_once()
+        self.assertIn('sendLocation', mock_session.post.call_args[0][0])
+        body = json.loads(self.handler.wfile.write.call_args[0][0].decode())
+        self.assertEqual(body['method'], 'sendMessage')
+
+    @patch('telegram.WEBHOOK_ACK_FIRST', True)
+    def test_do_post_ack_first(self):
+        """Test that ack-first mode answers before the update is processed."""
+        update = {"update_id": 7, "message": {"chat": {"id": 12345}, "text": "/info"}}
+        update_json = json.dumps(update)
+        self.handler.headers = {'Content-Length': str(len(update_json))}
+        self.handler.rfile = io.BytesIO(update_json.encode())
+
+        with patch('telegram.update_pool') as mock_pool:
+            mock_pool.submit.return_value = "queued"
+            with patch('telegram.handle_message') as mock_handle:
+                self.handler.do_POST()
+
+        mock_pool.submit.assert_called_once_with(update)
+        mock_handle.assert_not_called()
+        self.handler.send_response.assert_called_with(200)
+
+    @patch('telegram.WEBHOOK_ACK_FIRST', True)
+    def test_do_post_ack_first_rejected(self):
+        """Test that a rejected update is answered with 503."""
+        update_json = json.dumps({"update_id": 8, "message": {"chat": {"id": 12345}, "text": "hi"}})
+        self.handler.headers = {'Content-Length': str(len(update_json))}
+        self.handler.rfile = io.BytesIO(update_json.encode())
+
+        with patch('telegram.update_pool') as mock_pool:
+            mock_pool.submit.return_value = "rejected"
+            self.handler.do_POST()
+
+        self.handler.send_response.assert_called_with(503)
+
+    @patch('telegram.WEBHOOK_ACK_FIRST', True)
+    def test_do_post_rejected_update_is_processed_on_redelivery(self):
+        """Test that Telegram's redelivery of a rejected update is handled, not dropped as a duplicate."""
+        update = {"update_id": 990002, "message": {"chat": {"id": 12345}, "text": "hi"}}
+        update_json = json.dumps(update)
+
+        with patch('telegram.update_pool') as mock_pool:
+            mock_pool.submit.side_effect = ["rejected", "queued"]
+            for _ in range(2):
+                self.handler.headers = {'Content-Length': str(len(update_json))}
+                self.handler.rfile = io.BytesIO(update_json.encode())
+                self.handler.do_POST()
+
+        self.assertEqual(mock_pool.submit.call_count, 2)
+        mock_pool.submit.assert_called_with(update)
+        self.handler.send_response.assert_called_with(200)
+
+    @patch('telegram.handle_message')
+    def test_do_post_ignores_redelivered_update(self, mock_handle):
+        """Test that a redelivered update is acknowledged without processing."""
+        update_json = json.dumps({"update_id": 990001, "message": {"chat": {"id": 12345}, "text": "hi"}})
+
+        for _ in range(2):
+            self.handler.headers = {'Content-Length': str(len(update_json))}
+            self.handler.rfile = io.BytesIO(update_json.encode())
+            self.handler.do_POST()
+
+        mock_handle.assert_called_once()
+        self.handler.send_response.assert_called_with(200)
+
     def test_do_post_invalid_json(self):
         """Test handling of invalid JSON in POST request."""
         invalid_json = "invalid json"
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Train the character-trigram language model used by the bot and write it to
+api/language_model.npy. Also reports held-out accuracy and batch throughput.
+
+The Uzbek Cyrillic corpus is produced by transliterating the Uzbek Latin one.
+"""
+
+import argparse
+import sys
+import time
+
+sys.path.append('.')
+
+from api.telegram import CharNgramLanguageModel, LANGUAGE_MODEL_PATH, get_premiumsoft_info
+
+UZ_LATIN = [
+    "Assalomu alaykum, sizlarning xizmatlaringiz haqida ma'lumot bersangiz.",
+    "Salom, qanday yordam bera olaman?",
+    "Menga mobil ilova kerak, narxi qancha bo'ladi?",
+    "Telegram bot ishlab chiqish uchun qancha vaqt ketadi?",
+    "Kompaniyangiz qayerda joylashgan?",
+    "Rahmat, juda yaxshi javob berdingiz.",
+    "Bizning do'konimiz uchun internet magazin kerak edi.",
+    "Ish vaqtingiz qachondan qachongacha?",
+    "Men o'z biznesim uchun veb-sayt yaratmoqchiman.",
+    "Loyihani qachon boshlashingiz mumkin?",
+    "Iltimos, telefon raqamingizni yozib qoldiring.",
+    "Sizlar bilan hamkorlik qilmoqchimiz.",
+    "Dasturchilaringiz qaysi texnologiyalardan foydalanadi?",
+    "Buyurtma berish uchun nima qilishim kerak?",
+    "Ertaga ofisingizga kelsam bo'ladimi?",
+    "Xayrli kun, savolim bor edi.",
+    "Bu ilova Android va iOS uchun ham ishlaydimi?",
+    "To'lovni qanday amalga oshirsa bo'ladi?",
+    "Shartnoma tuzish uchun qanday hujjatlar kerak?",
+    "Oldingi ishlaringizdan namunalar ko'rsata olasizmi?",
+    "Bizga CRM tizimi kerak, xodimlar ishini nazorat qilish uchun.",
+    "Yaxshi, men o'ylab ko'rib sizga qayta yozaman.",
+    "Javobingiz uchun katta rahmat, omad tilayman!",
+    "Kechirasiz, hozir band emasmisiz?",
+    "Farg'ona shahrida ofisingiz bormi?",
+    "Dizayn ham sizlar tomonidan qilinadimi yoki o'zimiz berishimiz kerakmi?",
+    "Saytni qo'llab-quvvatlash xizmati ham bormi?",
+    "Men talabaman, sizlarda amaliyot o'tasa bo'ladimi?",
+]
+
+RUSSIAN = [
+    "Здравствуйте, расскажите, пожалуйста, о ваших услугах.",
+    "Сколько стоит разработка мобильного приложения?",
+    "Где находится ваш офис?",
+    "Спасибо за быстрый ответ!",
+    "Нам нужен интернет-магазин для нашей компании.",
+    "Какие технологии вы используете в разработке?",
+    "Можно ли заказать телеграм-бота для записи клиентов?",
+    "Когда вы сможете начать работу над проектом?",
+    "Оставьте, пожалуйста, ваш номер телефона.",
+    "Мы хотим сотрудничать с вашей командой.",
+    "Сколько времени займет создание сайта?",
+    "У вас есть примеры выполненных работ?",
+    "Как можно оплатить ваши услуги?",
+    "Какие документы нужны для заключения договора?",
+    "Добрый день, у меня есть вопрос по поводу сайта.",
+    "Вы делаете дизайн или его нужно предоставить?",
+    "Есть ли у вас техническая поддержка после запуска?",
+    "Нам нужна система учета для склада и сотрудников.",
+    "Я подумаю и напишу вам позже.",
+    "Извините, вы сейчас работаете?",
+    "Работает ли приложение на Android и iOS?",
+    "Можно приехать к вам в офис завтра?",
+    "Какой у вас график работы?",
+    "Хорошо, договорились, жду вашего звонка.",
+    "Я студент, можно ли пройти у вас практику?",
+]
+
+ENGLISH = [
+    "Hello, could you tell me about your services?",
+    "How much does it cost to build a mobile app?",
+    "Where is your office located?",
+    "Thank you for the quick reply!",
+    "We need an online store for our company.",
+    "Which technologies do you use for development?",
+    "Can I order a Telegram bot for booking clients?",
+    "When can you start working on the project?",
+    "Please leave your phone number and we will call you back.",
+    "We would like to work together with your team.",
+    "How long does it take to create a website?",
+    "Do you have examples of your previous work?",
+    "How can I pay for your services?",
+    "What documents are needed to sign a contract?",
+    "Good afternoon, I have a question about my website.",
+    "Do you also do the design or should we provide it?",
+    "Is there technical support after the launch?",
+    "We need an accounting system for our warehouse and staff.",
+    "I will think about it and write to you later.",
+    "Sorry, are you open right now?",
+    "Does the app work on both Android and iOS?",
+    "Can I visit your office tomorrow?",
+    "What are your working hours?",
+    "Great, it's a deal, I am waiting for your call.",
+    "I am a student, can I do an internship with you?",
+    "Please respond in English.",
+]
+
+# Uzbek Latin to Cyrillic, digraphs first
+TRANSLITERATION = [
+    ("o'", "ў"), ("g'", "ғ"), ("sh", "ш"), ("ch", "ч"), ("yo", "ё"), ("yu", "ю"), ("ya", "я"),
+    ("a", "а"), ("b", "б"), ("d", "д"), ("e", "е"), ("f", "ф"), ("g", "г"), ("h", "ҳ"), ("i", "и"),
+    ("j", "ж"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"), ("q", "қ"),
+    ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"), ("v", "в"), ("x", "х"), ("y", "й"), ("z", "з"),
+    ("'", "ъ"),
+]
+
+def to_cyrillic(text):
+    """Transliterate Uzbek Latin text to Uzbek Cyrillic (lowercase)."""
+    text = CharNgramLanguageModel.normalize(text).strip()
+    for latin, cyrillic in TRANSLITERATION:
+        text = text.replace(latin, cyrillic)
+    return text
+
+def knowledge_base_sentences():
+    """Split the Uzbek knowledge base into sentence-sized lines."""
+    return [line.strip("•✅ *") for line in get_premiumsoft_info().splitlines() if len(line.strip()) > 20]
+
+def build_corpora():
+    """Return {language: [texts]} for training."""
+    uz_latin = UZ_LATIN + knowledge_base_sentences()
+    return {
+        "uz_latin": uz_latin,
+        "uz_cyrillic": [to_cyrillic(text) for text in uz_latin],
+        "russian": RUSSIAN,
+        "english": ENGLISH,
+    }
+
+def split(corpora, every=5):
+    """Hold out every n-th text of each language for evaluation."""
+    train, held_out = {}, []
+    for language, texts in corpora.items():
+        train[language] = [text for i, text in enumerate(texts) if i % every]
+        held_out += [(text, language) for i, text in enumerate(texts) if not i % every]
+    return train, held_out
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Train the character n-gram language model")
+    parser.add_argument("--output", default=LANGUAGE_MODEL_PATH, help="Where to write the .npy model")
+    parser.add_argument("--alpha", type=float, default=0.5, help="Additive smoothing")
+    args = parser.parse_args()
+
+    corpora = build_corpora()
+
+    train, held_out = split(corpora)
+    model = CharNgramLanguageModel.train(train, alpha=args.alpha)
+    predictions = model.predict([text for text, _ in held_out])
+    correct = sum(label == language for (label, _), (_, language) in zip(predictions, held_out))
+    print(f"Held-out accuracy: {correct}/{len(held_out)}")
+    for (label, confidence), (text, language) in zip(predictions, held_out):
+        if label != language:
+            print(f"  ❌ {text[:60]!r}: {label} ({confidence:.2f}), expected {language}")
+
+    texts = [text for text, _ in held_out] * 200
+    start = time.perf_counter()
+    model.predict(texts)
+    batch_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for text in texts[:1000]:
+        model.identify(text)
+    single_seconds = (time.perf_counter() - start) / 1000 * len(texts)
+    print(f"Batch: {len(texts) / batch_seconds:,.0f} texts/s, one at a time: {len(texts) / single_seconds:,.0f} texts/s")
+
+    model = CharNgramLanguageModel.train(corpora, alpha=args.alpha)
+    model.save(args.output)
+    print(f"✅ Saved {args.output}")
+
+if __name__ == "__main__":
+    main()